@@ -1,24 +1,45 @@
 """
 This is the script for extracting audio from video with/without filtering speech.
+Files are converted in parallel, and converted files are recorded in the manifest of the output directory,
+so reruns skip them (see `ConversionManifest`).
 """
 
+import sys
+
+sys.path.append('src')
+
 import os
+import json
 import wave
-import shutil
 import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+import numpy as np
 from tqdm import tqdm
 
+from audio.data.waveform_cache import WaveformCache
+
+
+MANIFEST_FILENAME = 'conversion_manifest.json'
+SPLEETER_SR = 44100
+
 
 def get_duration(file_path: str) -> float:
     """Return duration of the audio file
 
     Args:
-        file_path (str): The path to the file
+        file_path (str): The path to the file (wav file or `.npy` file of audio store)
 
     Returns:
         float: Duration of the file in seconds
     """
+    if file_path.endswith('.npy'):
+        with open(file_path.replace('.npy', '.sr'), 'r') as f:
+            sr = int(f.read())
+
+        return np.load(file_path, mmap_mode='r').shape[-1] / sr
+
     duration_seconds = 0
     with wave.open(file_path) as wav:
         duration_seconds = wav.getnframes() / wav.getframerate()
@@ -26,133 +47,352 @@ def get_duration(file_path: str) -> float:
     return duration_seconds
 
 
-def convert_without_filtering(inp_path: str, 
-                              out_path: str, 
-                              checking: bool = True) -> None:
-    """Convert video to audio using ffmpeg
+def decode_audio(inp_path: str, sr: int = 16000, channels: int = 1, dtype: str = 'int16') -> np.ndarray:
+    """Decode audio stream of the video with ffmpeg straight to memory, without intermediate files
 
     Args:
         inp_path (str): Input file path
+        sr (int, optional): Sample rate. Defaults to 16000.
+        channels (int, optional): Number of channels. Defaults to 1.
+        dtype (str, optional): Sample type. Can be 'int16' or 'float32'. Defaults to 'int16'.
+
+    Returns:
+        np.ndarray: Waveform with shape (channels, samples)
+    """
+    sample_fmt = {'int16': 's16le', 'float32': 'f32le'}[dtype]
+    command = ['ffmpeg', '-v', 'error', '-i', inp_path, '-async', '1', '-vn',
+               '-ar', str(sr), '-ac', str(channels), '-f', sample_fmt, 'pipe:1']
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(output, dtype=dtype).reshape(-1, channels).T
+
+
+def resample_audio(a_data: np.ndarray, inp_sr: int, sr: int = 16000) -> np.ndarray:
+    """Resample float32 waveform and mix it to mono int16 with ffmpeg
+
+    Args:
+        a_data (np.ndarray): Float32 waveform with shape (samples, channels)
+        inp_sr (int): Sample rate of the waveform
+        sr (int, optional): Output sample rate. Defaults to 16000.
+
+    Returns:
+        np.ndarray: Int16 waveform with shape (1, samples)
+    """
+    command = ['ffmpeg', '-v', 'error', '-f', 'f32le', '-ar', str(inp_sr), '-ac', str(a_data.shape[1]), '-i', 'pipe:0',
+               '-ar', str(sr), '-ac', '1', '-f', 's16le', 'pipe:1']
+    output = subprocess.run(command, input=np.ascontiguousarray(a_data, dtype=np.float32).tobytes(),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(output, dtype=np.int16)[np.newaxis, :]
+
+
+def save_audio(a_data: np.ndarray, sr: int, out_path: str) -> float:
+    """Save int16 waveform as wav file, or as `.npy` file of audio store if `out_path` ends with `.npy`.
+    Audio store file is int16 array with shape (1, samples) with sample rate in `<name>.sr` file next to it.
+    `WaveformCache.load('<name>.wav')` opens it as memory-mapped array instead of decoding the wav file,
+    so the store directory is used as `audio_root` of the datasets. Header of the store file is checked after writing.
+    Files are written to temporary files first and renamed, so interrupted runs never leave partial files
+
+    Args:
+        a_data (np.ndarray): Int16 waveform with shape (1, samples)
+        sr (int): Sample rate
         out_path (str): Output file path
-        checking (bool, optional): Used for checking paths of the ffmpeg command. Defaults to True.
+
+    Returns:
+        float: Duration of the saved file in seconds
     """
-    out_dirname = os.path.dirname(out_path)
-    os.makedirs(out_dirname, exist_ok=True)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_suffix = '.{0}.tmp'.format(os.getpid())
 
-    # sample rate 16000
-    command = f"ffmpeg -y -i {inp_path} -async 1 -vn -acodec pcm_s16le -ar 16000 -ac 1 {out_path}"
-       
-    if checking:
-        print(command)
+    if out_path.endswith('.npy'):
+        sr_path = out_path.replace('.npy', '.sr')
+        with open(out_path + tmp_suffix, 'wb') as f:
+            np.save(f, a_data)
+
+        with open(sr_path + tmp_suffix, 'w') as f:
+            f.write(str(sr))
+
+        os.replace(sr_path + tmp_suffix, sr_path)
     else:
-        _ = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
+        with wave.open(out_path + tmp_suffix, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sr)
+            wav.writeframes(a_data.tobytes())
 
+    os.replace(out_path + tmp_suffix, out_path)
+    if out_path.endswith('.npy'):
+        check_store_file(a_data, sr, out_path)
 
-def convert_with_filtering(inp_path: str, 
-                           out_path: str, 
-                           checking: bool = True) -> None:
-    """Extract speech from the video file using Spleeter and ffmpeg
+    return a_data.shape[-1] / sr
+
+
+def check_store_file(a_data: np.ndarray, sr: int, out_path: str) -> None:
+    """Check that audio store file is found by `WaveformCache` with the written shape, dtype and sample rate.
+    Only the header of `.npy` file is read (memory-mapped), the samples are not loaded again
+
+    Args:
+        a_data (np.ndarray): Written int16 waveform with shape (1, samples)
+        sr (int): Written sample rate
+        out_path (str): Path of `.npy` file of audio store
+
+    Raises:
+        ValueError: Raises error if the stored shape, dtype or sample rate differs
+    """
+    npy_path, sr_path = WaveformCache.get_store_paths(out_path.replace('.npy', '.wav'))
+    stored = np.load(npy_path, mmap_mode='r')
+    with open(sr_path, 'r') as f:
+        stored_sr = int(f.read())
+
+    if stored_sr != sr or stored.dtype != np.int16 or stored.shape != a_data.shape:
+        raise ValueError('Audio store file is not written correctly: {0}'.format(out_path))
+
+
+class ConversionManifest:
+    """Manifest of converted files, stored as json file in the output directory.
+    For each input file (relative path) it keeps size and modification time of the input file
+    and duration of the output file, or the error if the conversion failed. File is converted again if the input file
+    is changed, the conversion failed, the output file is missing, or its duration differs from the manifest
+    (f.e. it was overwritten)
+
+    Args:
+        out_root (str): Output directory
+    """
+    def __init__(self, out_root: str) -> None:
+        self.manifest_path = os.path.join(out_root, MANIFEST_FILENAME)
+        self.files = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.files = json.load(f)
+
+    def is_converted(self, key: str, inp_path: str, out_path: str) -> bool:
+        """Check if the input file is already converted
+
+        Args:
+            key (str): Relative path of the input file
+            inp_path (str): Input file path
+            out_path (str): Output file path
+
+        Returns:
+            bool: True if the input file is not changed and the output file is valid
+        """
+        entry = self.files.get(key, None)
+        if entry is None or 'error' in entry or not os.path.exists(out_path):
+            return False
+
+        stat = os.stat(inp_path)
+        if (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            return False
+
+        try:
+            return abs(get_duration(out_path) - entry['duration']) < 1e-4
+        except (OSError, ValueError, EOFError, wave.Error):
+            return False
+
+    def update(self, key: str, inp_path: str, duration: float) -> None:
+        """Record converted file and save manifest atomically
+
+        Args:
+            key (str): Relative path of the input file
+            inp_path (str): Input file path
+            duration (float): Duration of the output file in seconds
+        """
+        stat = os.stat(inp_path)
+        self.files[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'duration': duration}
+        self.save()
+
+    def update_failed(self, key: str, inp_path: str, error: Exception) -> None:
+        """Record failed conversion and save manifest atomically. Failed files are converted again on the next run
+
+        Args:
+            key (str): Relative path of the input file
+            inp_path (str): Input file path
+            error (Exception): Error of the conversion
+        """
+        message = '{0}: {1}'.format(type(error).__name__, error)
+        if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+            message += '\n' + error.stderr.decode(errors='ignore')
+
+        print(f"Error {inp_path}")
+        print(message)
+        stat = os.stat(inp_path)
+        self.files[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'error': message}
+        self.save()
+
+    def save(self) -> None:
+        """Save manifest atomically"""
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = '{0}.{1}.tmp'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.files, f, indent=1)
+
+        os.replace(tmp_path, self.manifest_path)
+
+
+def get_conversion_jobs(files_root: str, out_root: str, ext: str = '.wav') -> list[tuple[str, str, str]]:
+    """Loop through the directory and form paths of output files. Hidden files (f.e. video metadata index) are skipped
+
+    Args:
+        files_root (str): Input directory
+        out_root (str): Output directory
+        ext (str, optional): Extension of output files. Defaults to '.wav'.
+
+    Returns:
+        list[tuple[str, str, str]]: Relative path, input file path and output file path for each video file
+    """
+    jobs = []
+    for dn, _, fns in os.walk(files_root):
+        for fn in sorted(fns):
+            if fn.startswith('.'):
+                continue
+
+            inp_path = os.path.join(dn, fn)
+            key = os.path.relpath(inp_path, files_root)
+            jobs.append((key, inp_path, os.path.join(out_root, os.path.splitext(key)[0] + ext)))
+
+    return jobs
+
+
+def convert_without_filtering(inp_path: str, out_path: str) -> float:
+    """Convert video to 16 kHz mono audio using ffmpeg
 
     Args:
         inp_path (str): Input file path
-        out_path (str): Output file path
-        checking (bool, optional): Used for checking paths of the spleeter/ffmpeg commands. Defaults to True.
+        out_path (str): Output file path (wav file or `.npy` file of audio store)
+
+    Returns:
+        float: Duration of the output file in seconds
     """
-    out_dirname = os.path.dirname(out_path)
-    os.makedirs(out_dirname, exist_ok=True)
+    return save_audio(decode_audio(inp_path, sr=16000), sr=16000, out_path=out_path)
 
-    # 44100 for spleeter
-    command = f"ffmpeg -y -i {inp_path} -async 1 -vn -acodec pcm_s16le -ar 44100 {out_path}"
-       
-    if checking:
-        print(command)
-    else:
-        _ = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
 
-    inp_duration = get_duration(out_path)
+def separate_vocals(separator, inp_path: str, a_data: np.ndarray, out_path: str) -> float:
+    """Extract speech from the decoded waveform using Spleeter, convert it to 16 kHz mono and save
 
-    # extract speech using spleeter
-    command = f"spleeter separate -o {out_dirname} {out_path} -d 1620" # d 1620 - maximum length in seconds
-    if checking:
-        print(command)
-    else:
-        _ = subprocess.check_output(
-            command, shell=True, stderr=subprocess.STDOUT, env=os.environ.copy()
-        )
-
-    spleeter_duration = get_duration(out_path)
-
-    # convert 44100 to 16000
-    command = "ffmpeg -y -i {0} -async 1 -ar 16000 -ac 1 {1}".format(
-        os.path.join(
-            out_dirname, os.path.basename(out_path).split(".")[0], "vocals.wav"
-        ),
-        out_path,
-    )
-    
-    if checking:
-        print(command)
-    else:
-        _ = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
-        
-        shutil.rmtree(
-            os.path.join(out_dirname, os.path.basename(out_path).split(".")[0])
-        )
+    Args:
+        separator (spleeter.separator.Separator): Loaded Spleeter model
+        inp_path (str): Input file path, used for error messages
+        a_data (np.ndarray): Float32 44.1 kHz stereo waveform with shape (2, samples)
+        out_path (str): Output file path (wav file or `.npy` file of audio store)
+
+    Returns:
+        float: Duration of the output file in seconds
+    """
+    vocals = separator.separate(a_data.T)['vocals']
+    final_duration = save_audio(resample_audio(vocals, inp_sr=SPLEETER_SR), sr=16000, out_path=out_path)
 
     # check results for errors
-    final_duration = get_duration(out_path)
-    if (abs(inp_duration - spleeter_duration) < 1e-4) and (abs(inp_duration - final_duration) < 1e-4):
-        pass
-    else:
+    inp_duration = a_data.shape[1] / SPLEETER_SR
+    spleeter_duration = vocals.shape[0] / SPLEETER_SR
+    if not ((abs(inp_duration - spleeter_duration) < 1e-4) and (abs(inp_duration - final_duration) < 1e-4)):
         print(f"Error {inp_path}")
         print(inp_duration, spleeter_duration, final_duration)
 
+    return final_duration
+
+
+def convert_with_filtering(jobs: list[tuple[str, str, str]],
+                           manifest: ConversionManifest,
+                           num_workers: int,
+                           prefetch: int = 2) -> None:
+    """Extract speech from the video files using Spleeter and ffmpeg.
+    Spleeter model is loaded once for all files. Files are decoded to memory in background threads
+    (ffmpeg runs in subprocesses) while the current file is separated,
+    so only `prefetch` decoded waveforms are kept in memory
+
+    Args:
+        jobs (list[tuple[str, str, str]]): Relative path, input file path and output file path for each video file
+        manifest (ConversionManifest): Manifest of output directory
+        num_workers (int): Number of background threads
+        prefetch (int, optional): Number of files decoded ahead. Defaults to 2.
+    """
+    from spleeter.separator import Separator
+
+    separator = Separator('spleeter:2stems', multiprocess=False)
+
+    total = len(jobs)
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, tqdm(total=total) as pbar:
+        decoding = deque()
+        def submit_next() -> None:
+            job = next(jobs, None)
+            if job:
+                decoding.append((job, executor.submit(decode_audio, job[1], sr=SPLEETER_SR, channels=2, dtype='float32')))
 
-def convert_video_to_audio(files_root: str, 
+        for _ in range(prefetch):
+            submit_next()
+
+        while decoding:
+            (key, inp_path, out_path), future = decoding.popleft()
+            submit_next()
+            try:
+                duration = separate_vocals(separator, inp_path, future.result(), out_path)
+                manifest.update(key, inp_path, duration)
+            except Exception as e:
+                # the failure is recorded and the remaining files are converted
+                manifest.update_failed(key, inp_path, e)
+
+            pbar.update(1)
+
+
+def convert_video_to_audio(files_root: str,
                            wavs_root: str = 'wavs',
                            vocals_root: str = 'vocals',
                            filtering: bool = False,
+                           store: bool = False,
+                           num_workers: int = None,
                            checking: bool = True) -> None:
     """Loop through the directory, and extract speech from each video file using Spleeter and ffmpeg.
+    Files recorded in the manifests of the output directories are skipped
 
     Args:
         files_root (str): Input directory
-        checking (bool, optional): Used for checking paths of the spleeter/ffmpeg commands. Defaults to True.
+        wavs_root (str, optional): Name of output directory for audio. Defaults to 'wavs'.
+        vocals_root (str, optional): Name of output directory for filtered audio. Defaults to 'vocals'.
+        filtering (bool, optional): Extract speech using Spleeter. Defaults to False.
+        store (bool, optional): Save 16 kHz int16 audio as memory-mapped `.npy` files instead of wav files. Defaults to False.
+        num_workers (int, optional): Number of processes for conversion. If None, number of CPU cores is used. Defaults to None.
+        checking (bool, optional): Used for checking paths of the files to convert. Defaults to True.
     """
     # run on CPU
     os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
+    num_workers = num_workers if num_workers else os.cpu_count()
+    ext = '.npy' if store else '.wav'
+
     out_wavs_root = os.path.join(os.path.dirname(files_root), wavs_root)
     out_vocals_root = os.path.join(os.path.dirname(files_root), vocals_root)
 
-    for dn, _, fns in os.walk(os.path.join(files_root)):
-        if not fns:
-            continue
-
-        for fn in tqdm(fns):
-            convert_without_filtering(
-                inp_path=os.path.join(dn, fn),
-                out_path=os.path.join(
-                    dn.replace(files_root, out_wavs_root),
-                    fn.replace("mp4", "wav").replace("avi", "wav"),
-                ),
-                checking=checking,
-            )
-            
-            if filtering:
-                convert_with_filtering(
-                    inp_path=os.path.join(dn, fn),
-                    out_path=os.path.join(
-                        dn.replace(files_root, out_vocals_root),
-                        fn.replace("mp4", "wav").replace("avi", "wav"),
-                    ),
-                    checking=checking,
-                )
+    manifest = ConversionManifest(out_wavs_root)
+    jobs = [job for job in get_conversion_jobs(files_root, out_wavs_root, ext) if not manifest.is_converted(*job)]
+    if checking:
+        for _, inp_path, out_path in jobs:
+            print(f"{inp_path} -> {out_path}")
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(convert_without_filtering, inp_path, out_path): (key, inp_path)
+                       for key, inp_path, out_path in jobs}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                key, inp_path = futures[future]
+                try:
+                    manifest.update(key, inp_path, future.result())
+                except Exception as e:
+                    # the failure is recorded and the remaining files are converted
+                    manifest.update_failed(key, inp_path, e)
+
+    if not filtering:
+        return
+
+    manifest = ConversionManifest(out_vocals_root)
+    jobs = [job for job in get_conversion_jobs(files_root, out_vocals_root, ext) if not manifest.is_converted(*job)]
+    if checking:
+        for _, inp_path, out_path in jobs:
+            print(f"{inp_path} -> {out_path} (spleeter)")
+    else:
+        convert_with_filtering(jobs, manifest, num_workers=num_workers)
 
 
 if __name__ == "__main__":
     files_root =  '/data/videos' # TODO
-    
-    convert_video_to_audio(files_root=files_root, 
+
+    convert_video_to_audio(files_root=files_root,
                            filtering=False,
                            checking=False)
@@ -8,16 +8,18 @@ from enum import Enum
 import numpy as np
 import pandas as pd
 
-import cv2
 import torch
-import torchaudio
 import torchvision
 
 from torch.utils.data import Dataset
-from transformers import Wav2Vec2Processor
 
 from audio.config import *
-from audio.utils.common_utils import round_math, array_to_bytes, bytes_to_array
+from audio.data.waveform_cache import WaveformCache
+from audio.data.wav2vec2_collator import Wav2Vec2Collator
+from audio.data.windowing import get_downsampled_frames, get_windows, mode_rows
+from audio.utils.common_utils import round_math
+
+from video.preprocessing.video_metadata_index import VideoMetadataIndex
 
 
 class VAEGrouping(Enum):
@@ -48,7 +50,10 @@ class AbawFEDataset(Dataset):
         va_frames_grouping (VAEGrouping, optional): Grouping method for VA. Defaults to VAEGrouping.F2F.
         expr_frames_grouping (VAEGrouping, optional): Grouping method for VA. Defaults to VAEGrouping.F2W.
         multitask (bool, optional): Is multitask dataset?. Defaults to True.
-        processor_name (str, optional): Name of model in transformers library. Defaults to 'audeering/wav2vec2-large-robust-12-ft-emotion-msp-dim'.
+        waveform_cache_root (str, optional): Root dir for decoded waveforms. If None, waveforms are cached in RAM only. Defaults to None.
+        waveform_cache_dtype (str, optional): Storage type of decoded waveforms. Can be 'float32' or 'int16'. Windows are returned in this type. Defaults to 'int16'.
+        pad_waves (bool, optional): Pad windows with zeros to `max_w_len` seconds. If False, windows have real lengths
+                                    and are padded by `Wav2Vec2Collator(max_length=...)` with attention mask. Defaults to True.
 
         Raises:
             ValueError: Raises error if both labels_va_root and labels_expr_root are not null, and multitask is False.
@@ -69,7 +74,9 @@ class AbawFEDataset(Dataset):
                  va_frames_grouping: VAEGrouping = VAEGrouping.F2F, 
                  expr_frames_grouping: VAEGrouping = VAEGrouping.F2W, 
                  multitask: bool = True,
-                 processor_name: str = 'audeering/wav2vec2-large-robust-12-ft-emotion-msp-dim') -> None:
+                 waveform_cache_root: str = None,
+                 waveform_cache_dtype: str = 'int16',
+                 pad_waves: bool = True) -> None:
         self.audio_root = audio_root
         self.video_root = video_root
         self.labels_va_root = labels_va_root
@@ -87,6 +94,7 @@ class AbawFEDataset(Dataset):
         self.va_frames_grouping = va_frames_grouping
         self.expr_frames_grouping = expr_frames_grouping
         self.multitask = multitask
+        self.pad_waves = pad_waves
         if not self.multitask and self.labels_va_root and self.labels_expr_root:
             raise ValueError('This dataset shold be multitask')
         
@@ -95,7 +103,8 @@ class AbawFEDataset(Dataset):
         self.new_fps = 5 # downsampling to fps per second
         self.expr_labels_counts = []
 
-        self.processor = Wav2Vec2Processor.from_pretrained(processor_name)
+        self.waveform_cache = WaveformCache(cache_root=waveform_cache_root, dtype=waveform_cache_dtype)
+        self.video_index = VideoMetadataIndex(self.video_root)
         
         self.prepare_data()
     
@@ -104,13 +113,14 @@ class AbawFEDataset(Dataset):
                        lab_filename: str) -> tuple[list[dict], list[np.ndarray]]:
         """Creates windows with `shift`, `max_w_len`, `min_w_len` in the following steps:
         - Gets FPS and number of frames 
-        - Pads labels values to `max_w_len` seconds
-        - Downsamples to `self.new_fps`. Removes several labels
-        - Drops `timings` duplicates:
+        - Splits frames on windows and drops duplicates of windows using `get_windows`:
             f.e. frame_rate = 30, len(seq) = 76, max_w_len = 4 * 30. In this case we 
             will have only 3 seconds of VA.
             seg 0: frames 0 - 60 extended to 4 * 30 and converted to 0 - 76
             seg 1: frames 60 - 76 extended to 4 * 30 and converted to 0 - 76
+        - Pads labels values to `max_w_len` seconds
+        - Downsamples to `self.new_fps`. Removes several labels
+        All windows of file are processed at once as arrays
                 
         Args:
             lab_feat_df (pd.core.frame.DataFrame): Features with labels dataframe
@@ -125,10 +135,10 @@ class AbawFEDataset(Dataset):
         max_w_len = self.max_w_len * round_math(frame_rate)
         min_w_len = self.min_w_len * round_math(frame_rate)
         
-        timings = []
-        
-        frames = lab_feat_df['lab_id'].astype(int).to_list() # lab_id is the same as frame
+        frames = lab_feat_df['lab_id'].astype(int).values # lab_id is the same as frame
         mouth_open = lab_feat_df['mouth_open'].astype(int).values # lab_id is the same as frame
+        if len(frames) == 0:
+            return [], []
 
         if self.labels_va_root:
             va_values = lab_feat_df[['valence', 'arousal']].values
@@ -140,26 +150,14 @@ class AbawFEDataset(Dataset):
         else:
             exprs = np.full(len(frames), -1)
 
-        for seg in range(0, len(frames), shift):
-            va_window = va_values[seg: seg + max_w_len, :]
-            expr_window = exprs[seg: seg + max_w_len]
-            mouth_open_window = mouth_open[seg: seg + max_w_len]
-                
-            start = frames[seg]
-            end_idx = seg + len(expr_window)
-            end = frames[end_idx - 1] if end_idx > len(frames) - 1 else frames[end_idx] # skip last frame
-                
-            if len(expr_window) < max_w_len: # if less than max_w_len: get last -max_w_len elements
-                va_window = va_values[-max_w_len:, :]
-                expr_window = exprs[-max_w_len:]
-                mouth_open_window = mouth_open[-max_w_len:]
-
-                start = frames[max(0, len(frames) - max_w_len)] # 0 or frame[-max_w_len]
-                end = frames[-1]
-                    
-            val, m_o = self.pad_labels(va_window, mouth_open_window, frame_rate)
-            exprl, m_o = self.pad_labels(expr_window, mouth_open_window, frame_rate)
-            
+        starts, ends = get_windows(frames, shift=shift, max_w_len=max_w_len)
+
+        va, m_o = self.pad_labels(va_values, mouth_open, starts, frame_rate)
+        expr, m_o = self.pad_labels(exprs, mouth_open, starts, frame_rate)
+
+        timings = []
+        expr_labels = []
+        for idx, (start, end) in enumerate(zip(frames[starts].tolist(), frames[ends].tolist())):
             timings.append({
                 'lab_filename': lab_filename,
                 'fps': frame_rate,
@@ -167,33 +165,19 @@ class AbawFEDataset(Dataset):
                 'end_t': end / round_math(frame_rate),
                 'start_f': start,
                 'end_f': end,
-                'mouth_open': array_to_bytes(m_o),
-                'va': array_to_bytes(val),
-                'expr': array_to_bytes(exprl)
+                'mouth_open': m_o[idx, ...],
+                'va': va[idx, ...],
+                'expr': expr[idx, ...]
             })
-
-        # check duplicates
-        # f.e. frame_rate = 30, len(seq) = 76, max_w_len = 4 * 30. In this case we will have only 3 seconds of VA.
-        # seg 0: frames 0 - 60 extended to 4 * 30 and converted to 0 - 76
-        # seg 1: frames 60 - 76 extended to 4 * 30 and converted to 0 - 76
-        timings = [dict(t) for t in {tuple(d.items()) for d in timings}]
-        timings = sorted(timings, key=lambda d: d['start_t'])
-        
-        expr_labels = []
-        for t in timings:
-            t['va'] = bytes_to_array(t['va'])
-            t['expr'] = bytes_to_array(t['expr'])
-            t['mouth_open'] = bytes_to_array(t['mouth_open'])
-            expr_labels.append(t['expr'])
+            expr_labels.append(timings[-1]['expr'])
         
         return timings, expr_labels
 
     def find_corresponding_video_info(self, lab_filename: str) -> tuple[float, float]:
         """Finds video info with corresponding label file in the following steps:
         - Removes extension of file, '_left', '_right' prefixes from label filename
-        - Forms list with corresponding video files (with duplicates)
-        - Picks first video from video files candidates
-        - Gets FPS and total number of frames of video file
+        - Picks first video from video files candidates using video metadata index
+        - Gets FPS and total number of frames of video file from video metadata index
 
         Args:
             lab_filename (str): Label filename
@@ -203,14 +187,8 @@ class AbawFEDataset(Dataset):
         """
         lab_filename = lab_filename.split('.')[0]
         lab_fns = [lab_filename.split(postfix)[0] for postfix in ['_right', '_left']]
-        res = []
-        for l_fn in lab_fns:
-            res.extend([v for v in os.listdir(self.video_root) if l_fn == v.split('.')[0]])
-
-        vidcap = cv2.VideoCapture(os.path.join(self.video_root, list(set(res))[0]))
-        fps = vidcap.get(cv2.CAP_PROP_FPS)
-        num_frames = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
-        return fps, num_frames
+        video_info = next(v_info for v_info in map(self.video_index.find, lab_fns) if v_info)
+        return video_info['fps'], video_info['num_frames']
         
     def prepare_data(self) -> None:
         """
@@ -264,8 +242,9 @@ class AbawFEDataset(Dataset):
 
         self.expr_labels_counts = np.unique(np.asarray(self.expr_labels), return_counts=True)[1]
 
-    def pad_labels(self, targets: np.ndarray, mouth_open: np.ndarray, frame_rate: float) -> torch.LongTensor:
-        """Pads targets for va or expr with mouth open and applies downsampling with `self.new_fps`
+    def pad_labels(self, targets: np.ndarray, mouth_open: np.ndarray, starts: np.ndarray, frame_rate: float) -> tuple[np.ndarray, np.ndarray]:
+        """Forms windows of targets for va or expr with mouth open, pads them and applies downsampling with `self.new_fps`.
+        Windows are processed at once using downsampled index table (rows `starts` + downsampled frames)
         VAEGrouping.F2F: 
             Pads va or expr to `round_math(frame_rate)` * `self.max_w_len` length
             Transform va and expr values
@@ -280,84 +259,73 @@ class AbawFEDataset(Dataset):
             Calculates frame-wise mean for va. Transform va values.
             Calculates second-wise moda for expr.
         Args:
-            targets (np.ndarray): Input targets
-            mouth_open (np.ndarray): Mouth open array
+            targets (np.ndarray): Input targets of whole file
+            mouth_open (np.ndarray): Mouth open array of whole file
+            starts (np.ndarray): Rows of window starts
             frame_rate (float): FPS value
 
         Raises:
             ValueError: Raise if ndim of targets more than 2
 
         Returns:
-            torch.LongTensor: Padded targets
+            tuple[np.ndarray, np.ndarray]: Padded targets and mouth open with windows in the first dimension
         """
-        downsampled_frames = list(map(round_math, np.arange(0, 
-                                                            round_math(frame_rate) * self.max_w_len - 1, 
-                                                            round_math(frame_rate) / self.new_fps, dtype=float)))
+        num_frames = len(targets)
+        max_w_len = round_math(frame_rate) * self.max_w_len
+        downsampled_frames = get_downsampled_frames(round_math(frame_rate), self.max_w_len, self.new_fps)
         
-        mouth_open = np.pad(mouth_open, (0, max(0, round_math(frame_rate) * self.max_w_len - len(mouth_open))), 'edge')
-        mouth_open = mouth_open[downsampled_frames]
+        # windows shorter than max_w_len are padded with the edge values
+        rows = starts[:, np.newaxis] + downsampled_frames[np.newaxis, :]
+        padded_rows = np.minimum(rows, num_frames - 1)
+        mouth_open = mouth_open[padded_rows]
 
         if targets.ndim == 2:
-            targets = np.pad(targets, 
-                             [(0, max(0, round_math(frame_rate) * self.max_w_len - len(targets))), (0, 0)], 
-                             'edge')
-
-            targets = targets[downsampled_frames, :]
+            targets = targets[padded_rows, :]
             if self.va_frames_grouping == VAEGrouping.F2S:
-                targets_w = np.split(targets, np.arange(self.new_fps, len(targets), self.new_fps))
-                targets = np.asarray(targets).reshape(2, -1, self.new_fps)
+                targets = targets.reshape(len(targets), 2, -1, self.new_fps)
             elif self.va_frames_grouping == VAEGrouping.F2W:
-                targets_w = np.split(targets, np.arange(self.new_fps, len(targets), self.new_fps))
-                targets = np.asarray([np.mean(i, axis=0) for i in targets_w]).T
+                targets_w = np.split(targets, np.arange(self.new_fps, targets.shape[1], self.new_fps), axis=1)
+                targets = np.stack([t.mean(axis=1) for t in targets_w], axis=2)
                 
         elif targets.ndim == 1:
-            tar_v, tar_c = np.unique(targets, return_counts=True)
-            targets = np.pad(targets, 
-                             (0, max(0, round_math(frame_rate) * self.max_w_len - len(targets))), 
-                             'constant', 
-                             constant_values=tar_v[np.argmax(tar_c)])
+            if num_frames < max_w_len: # the only window is padded with moda
+                tar_v, tar_c = np.unique(targets, return_counts=True)
+                targets = np.where(rows < num_frames, targets[padded_rows], tar_v[np.argmax(tar_c)])
+            else:
+                targets = targets[padded_rows]
 
-            targets = targets[downsampled_frames]
             if self.expr_frames_grouping == VAEGrouping.F2S:
-                targets_w = np.split(targets, np.arange(self.new_fps, len(targets), self.new_fps))
-                targets = np.asarray([max(set(i), key=list(i).count) for i in targets_w]).T
+                targets_w = np.split(targets, np.arange(self.new_fps, targets.shape[1], self.new_fps), axis=1)
+                targets = np.stack([mode_rows(t) for t in targets_w], axis=1)
             elif self.expr_frames_grouping == VAEGrouping.F2W:
-                targets = max(set(targets), key=list(targets).count)
+                targets = mode_rows(targets)
         else:
             raise ValueError('Targets dimension > 2')
         
         return targets, mouth_open
 
-    def __getitem__(self, index: int) -> tuple[torch.Tensor, list[np.ndarray, np.ndarray], list[dict]]:
-        """Gets sample from dataset:
-        - Reads audio
-        - Selects indexes of audio according to metadata
-        - Pads the obtained wav
-        - Augments the obtained window
-        - Extracts preliminary wav2vec features
-        - Drops channel dimension
+    def get_wav_path(self, index: int) -> str:
+        """Gets path of audio file of sample. Left and right label files share the same audio file
 
         Args:
             index (int): Index of sample from metadata
 
         Returns:
-            tuple[torch.FloatTensor, list[np.ndarray, np.ndarray], list[dict]]: x, Y, sample_info as list for dataloader
+            str: Audio file path
         """
-        data = self.meta[index]
+        wav_path = self.meta[index]['lab_filename'].replace('_right', '').replace('_left', '').replace('txt', 'wav')
+        return os.path.join(self.audio_root, wav_path)
 
-        wav_path = data['lab_filename'].replace('_right', '').replace('_left', '').replace('txt', 'wav')        
-        a_data, a_data_sr = torchaudio.load(os.path.join(self.audio_root, wav_path))
-        a_data = a_data[:, round(a_data_sr * data['start_t']): min(round(a_data_sr * data['end_t']), 
-                                                                a_data_sr * (data['end_t'] + self.max_w_len))] # Due to rounding error fps - cut off window end
-        a_data = torch.nn.functional.pad(a_data, 
-                                         (0, max(0, self.max_w_len * a_data_sr - a_data.shape[1])), 
-                                         mode='constant')
-        
-        if self.transform:
-            a_data = self.transform(a_data)
+    def get_targets_and_info(self, index: int) -> tuple[list[np.ndarray, np.ndarray], list[dict]]:
+        """Gets labels and sample_info of sample without reading audio
+
+        Args:
+            index (int): Index of sample from metadata
 
-        wave = self.processor(a_data, sampling_rate=a_data_sr)
-        wave = wave['input_values'][0].squeeze()
+        Returns:
+            tuple[list[np.ndarray, np.ndarray], list[dict]]: Y, sample_info as list for dataloader
+        """
+        data = self.meta[index]
 
         sample_info = {
             'filename': os.path.basename(data['lab_filename']),
@@ -380,8 +348,64 @@ class AbawFEDataset(Dataset):
             elif not self.labels_va_root and self.labels_expr_root:
                 y = y_expr
 
-        return torch.FloatTensor(wave), y, [sample_info]
+        return y, [sample_info]
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, list[np.ndarray, np.ndarray], list[dict]]:
+        """Gets sample from dataset:
+        - Reads audio from waveform cache
+        - Selects indexes of audio according to metadata (zero-copy slice of cached waveform)
+        - Pads the obtained wav if `pad_waves`
+        - Augments the obtained window (converted to float32)
+        - Drops channel dimension
+        Wave is not normalized, use `Wav2Vec2Collator` in dataloader
+
+
+        Args:
+            index (int): Index of sample from metadata
+
+        Returns:
+            tuple[torch.Tensor, list[np.ndarray, np.ndarray], list[dict]]: x (raw int16 or float32 wave), Y, sample_info as list for dataloader
+        """
+        data = self.meta[index]
+
+        a_data, a_data_sr = self.waveform_cache.load(self.get_wav_path(index))
+        a_data = a_data[:, round(a_data_sr * data['start_t']): min(round(a_data_sr * data['end_t']), 
+                                                                a_data_sr * (data['end_t'] + self.max_w_len))] # Due to rounding error fps - cut off window end
+        if self.pad_waves:
+            a_data = torch.nn.functional.pad(a_data, 
+                                             (0, max(0, self.max_w_len * a_data_sr - a_data.shape[1])), 
+                                             mode='constant')
+        
+        if self.transform:
+            a_data = self.transform(self.waveform_cache.to_float(a_data))
+
+        wave = a_data.squeeze(0)
+
+        y, sample_info = self.get_targets_and_info(index)
+        return wave, y, sample_info
             
+    def get_window_lengths(self) -> np.ndarray:
+        """Calculates real (not padded) lengths of windows in samples using metadata, without reading audio.
+        Lengths are used for grouping windows with `LengthBucketBatchSampler`
+
+        Returns:
+            np.ndarray: Lengths of windows with shape (len(self),)
+        """
+        start_t = np.asarray([data['start_t'] for data in self.meta], dtype=float)
+        end_t = np.asarray([data['end_t'] for data in self.meta], dtype=float)
+        lengths = np.round(self.sr * end_t) - np.round(self.sr * start_t)
+        return np.clip(lengths, 0, self.max_w_len * self.sr).astype(int)
+
+    def get_open_mouth_indexes(self) -> np.ndarray:
+        """Gets indexes of windows with at least one (downsampled) frame with open mouth.
+        Windows with closed mouth only are replaced with mean features in fusion datasets,
+        so they can be skipped in feature extraction
+
+        Returns:
+            np.ndarray: Indexes of windows
+        """
+        return np.asarray([idx for idx, data in enumerate(self.meta) if np.any(data['mouth_open'])], dtype=int)
+
     def __len__(self) -> int:
         """Return number of all samples in dataset
 
@@ -419,7 +443,7 @@ if __name__ == "__main__":
                              multitask=False,
                              shift=2, min_w_len=2, max_w_len=4)
 
-        dl = torch.utils.data.DataLoader(afed, batch_size=8, shuffle=False, num_workers=8)
+        dl = torch.utils.data.DataLoader(afed, batch_size=8, shuffle=False, num_workers=8, collate_fn=Wav2Vec2Collator())
 
         for d in dl:
             pass
@@ -440,7 +464,7 @@ if __name__ == "__main__":
                              multitask=False,
                              shift=2, min_w_len=2, max_w_len=4)
 
-        dl = torch.utils.data.DataLoader(afed, batch_size=8, shuffle=False, num_workers=8)
+        dl = torch.utils.data.DataLoader(afed, batch_size=8, shuffle=False, num_workers=8, collate_fn=Wav2Vec2Collator())
 
         for d in dl:
             pass
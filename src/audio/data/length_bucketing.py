@@ -0,0 +1,90 @@
+import numpy as np
+
+import torch
+
+from torch.utils.data import ConcatDataset, Sampler
+
+
+def get_window_lengths(dataset: torch.utils.data.Dataset) -> np.ndarray:
+    """Gets real (not padded) lengths of windows of dataset in samples.
+    Lengths of `ConcatDataset` are concatenated in the order of its datasets
+
+    Args:
+        dataset (torch.utils.data.Dataset): Audio dataset with `get_window_lengths` or ConcatDataset of them
+
+    Returns:
+        np.ndarray: Lengths of windows with shape (len(dataset),)
+    """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([get_window_lengths(ds) for ds in dataset.datasets])
+
+    return dataset.get_window_lengths()
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler, which groups windows of similar length.
+    Together with `Wav2Vec2Collator(max_length=...)` batches of short windows (end-of-file windows, `min_w_len` windows)
+    are cut to the longest window of the batch instead of `max_w_len`:
+    - Indexes are split on buckets of `bucket_size` batches (shuffled first if `shuffle`)
+    - Windows of each bucket are sorted by length (stable) and split on batches
+    - Order of batches is shuffled if `shuffle`, otherwise buckets keep the order of dataset,
+      so windows of the same file stay close to each other
+
+    Args:
+        lengths (np.ndarray): Real lengths of windows, see `get_window_lengths`
+        batch_size (int): Number of windows in batch
+        shuffle (bool, optional): Shuffle windows and batches on every iteration. Defaults to False.
+        bucket_size (int, optional): Number of batches in bucket. Defaults to 100.
+        drop_last (bool, optional): Drop the last incomplete batch of each bucket. Defaults to False.
+        seed (int, optional): Seed of random generator. Defaults to 0.
+    """
+    def __init__(self,
+                 lengths: np.ndarray,
+                 batch_size: int,
+                 shuffle: bool = False,
+                 bucket_size: int = 100,
+                 drop_last: bool = False,
+                 seed: int = 0) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+
+    def get_batches(self) -> list[np.ndarray]:
+        """Forms batches of indexes. Every call gives new order if `shuffle`
+
+        Returns:
+            list[np.ndarray]: Batches of indexes
+        """
+        indexes = self.rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        bucket_len = self.bucket_size * self.batch_size
+
+        batches = []
+        for start in range(0, len(indexes), bucket_len):
+            bucket = indexes[start: start + bucket_len]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            for b_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[b_start: b_start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[idx] for idx in self.rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        bucket_len = self.bucket_size * self.batch_size
+        num_full_buckets, rest = divmod(len(self.lengths), bucket_len)
+        if self.drop_last:
+            return num_full_buckets * self.bucket_size + rest // self.batch_size
+
+        return num_full_buckets * self.bucket_size + (rest + self.batch_size - 1) // self.batch_size
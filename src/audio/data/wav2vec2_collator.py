@@ -0,0 +1,96 @@
+import torch
+
+from torch.utils.data import default_collate
+from transformers import Wav2Vec2FeatureExtractor
+
+from audio.data.waveform_cache import WaveformCache
+
+
+class Wav2Vec2Collator:
+    """Collates raw waves from audio datasets and normalizes them for wav2vec2 as a batch.
+    Repeats the zero-mean/unit-variance normalization of Wav2Vec2Processor
+    with one vectorized tensor operation over the whole batch:
+    - int16 waves are converted to float32 after stacking, so workers send int16 windows
+    - Other items of samples (labels, sample_info) are collated with `default_collate`
+    - If `max_length` is set, waves of different lengths (not padded by dataset) are padded with zeros to `max_length`,
+      normalized over their real samples, and returned with `attention_mask`,
+      the same way as Wav2Vec2FeatureExtractor(..., return_attention_mask=True) does it
+
+    Args:
+        processor_name (str, optional): Name of model in transformers library.
+                                        If set, `do_normalize` is taken from its feature extractor. Defaults to None.
+        do_normalize (bool, optional): Apply zero-mean/unit-variance normalization. Defaults to True.
+        max_length (int, optional): Length of padded waves in samples (f.e. max_w_len * sr).
+                                    Enables attention mask mode if the value is set. Defaults to None.
+    """
+    def __init__(self, processor_name: str = None, do_normalize: bool = True, max_length: int = None) -> None:
+        self.do_normalize = do_normalize
+        self.max_length = max_length
+        if processor_name:
+            self.do_normalize = Wav2Vec2FeatureExtractor.from_pretrained(processor_name).do_normalize
+
+    def normalize(self, waves: torch.Tensor, attention_mask: torch.Tensor = None) -> torch.Tensor:
+        """Normalizes each wave to zero mean and unit variance, the same way as Wav2Vec2FeatureExtractor.
+        If `attention_mask` is set, statistics are calculated over real samples and padding is set to zero
+
+        Args:
+            waves (torch.Tensor): Float32 waves with shape (bs, samples)
+            attention_mask (torch.Tensor, optional): Mask of real samples with shape (bs, samples). Defaults to None.
+
+        Returns:
+            torch.Tensor: Normalized waves
+        """
+        if attention_mask is None:
+            var, mean = torch.var_mean(waves, dim=1, unbiased=False, keepdim=True)
+            return (waves - mean) / torch.sqrt(var + 1e-7)
+
+        mask = attention_mask.to(waves.dtype)
+        lengths = mask.sum(dim=1, keepdim=True).clamp(min=1)
+        mean = (waves * mask).sum(dim=1, keepdim=True) / lengths
+        var = (((waves - mean) * mask) ** 2).sum(dim=1, keepdim=True) / lengths
+        return (waves - mean) / torch.sqrt(var + 1e-7) * mask
+
+    def pad(self, waves: list[torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
+        """Pads waves with zeros to `max_length` and forms attention mask
+
+        Args:
+            waves (list[torch.Tensor]): Float32 waves of different lengths
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Padded waves with shape (bs, max_length) and attention mask (long)
+        """
+        padded_waves = torch.zeros((len(waves), self.max_length), dtype=torch.float32)
+        attention_mask = torch.zeros((len(waves), self.max_length), dtype=torch.long)
+        for idx, wave in enumerate(waves):
+            wave = wave[:self.max_length]
+            padded_waves[idx, :len(wave)] = wave
+            attention_mask[idx, :len(wave)] = 1
+
+        return padded_waves, attention_mask
+
+    def __call__(self, batch: list[tuple]) -> list:
+        """Collates batch of samples
+
+        Args:
+            batch (list[tuple]): Samples of dataset: raw wave, labels, sample_info
+
+        Returns:
+            list: Normalized waves with shape (bs, samples), collated labels and sample_info.
+                  In attention mask mode waves are returned as dict with `input_values` and `attention_mask`
+        """
+        waves = [sample[0] for sample in batch]
+        if self.max_length:
+            waves, attention_mask = self.pad([WaveformCache.to_float(w) for w in waves])
+            if self.do_normalize:
+                waves = self.normalize(waves, attention_mask)
+
+            return [{'input_values': waves, 'attention_mask': attention_mask}, *default_collate([sample[1:] for sample in batch])]
+
+        if len(set(w.dtype for w in waves)) > 1: # augmented waves are float32
+            waves = [WaveformCache.to_float(w) for w in waves]
+
+        waves = WaveformCache.to_float(torch.stack(waves))
+        if self.do_normalize:
+            waves = self.normalize(waves)
+
+        return [waves, *default_collate([sample[1:] for sample in batch])]
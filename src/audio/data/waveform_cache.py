@@ -0,0 +1,238 @@
+import os
+import mmap
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+import torchaudio
+
+
+class WaveformCache:
+    """Decoded waveform cache shared by audio datasets
+    Each audio file is decoded only once:
+    - If `cache_root` is set, decoded waveform is stored on disk as `.npy` file and
+      is opened as memory-mapped array. Pages of memory-mapped files are kept in the OS page cache,
+      so they are shared between DataLoader workers
+    - Opened (or decoded) waveforms are kept in LRU in-RAM layer of size `max_items`.
+      Waveforms in process memory (decoded without `cache_root`, or converted to float32) are also bounded by `max_bytes`
+      per process (each DataLoader worker has its own layer). Memory-mapped waveforms are not counted:
+      their pages belong to the shared OS page cache. The last loaded waveform is always kept
+    - Slices of returned waveforms are views, so windows are cut without copying.
+      Use `to_float` to convert int16 windows
+    - If the audio store file `<name>.npy` (with `<name>.sr`) written by `convert_video_to_audio(store=True)`
+      lies next to the requested `<name>.wav`, it is opened directly as memory-mapped int16 array instead of decoding
+      (for any `dtype`, windows are converted with `to_float`). The store is ignored if `<name>.wav` exists
+      and is modified later than the store file, otherwise the store must be regenerated if the audio is changed
+
+    Args:
+        cache_root (str, optional): Root dir for decoded waveforms. If None, only in-RAM layer is used. Defaults to None.
+        dtype (str, optional): Storage type of decoded waveforms. Can be 'float32' or 'int16'. Defaults to 'float32'.
+        max_items (int, optional): Maximum number of waveforms in LRU in-RAM layer. Defaults to 32.
+        max_bytes (int, optional): Maximum size of waveforms in process memory in LRU in-RAM layer. Defaults to 512 MB.
+
+    Raises:
+        ValueError: Raises error if dtype is not 'float32' or 'int16'
+    """
+    def __init__(self, cache_root: str = None, dtype: str = 'float32', max_items: int = 32, max_bytes: int = 512 * 2 ** 20) -> None:
+        if dtype not in ['float32', 'int16']:
+            raise ValueError('Unsupported waveform dtype: {0}'.format(dtype))
+
+        self.cache_root = cache_root
+        self.dtype = dtype
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.waveforms = OrderedDict()
+        self.waveform_sizes = {}
+        self.num_bytes = 0
+
+        if self.cache_root:
+            os.makedirs(self.cache_root, exist_ok=True)
+
+    def get_cache_path(self, wav_path: str) -> str:
+        """Forms path of decoded waveform.
+        Hash includes absolute path, size and modification time of audio file,
+        so the cache is invalidated if audio file is changed
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            str: Path of decoded waveform
+        """
+        stat = os.stat(wav_path)
+        key = '{0}:{1}:{2}:{3}'.format(os.path.abspath(wav_path), stat.st_size, stat.st_mtime_ns, self.dtype)
+        return os.path.join(self.cache_root, '{0}_{1}.npy'.format(
+            os.path.basename(wav_path).split('.')[0],
+            hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def decode(self, wav_path: str) -> tuple[np.ndarray, int]:
+        """Decodes audio file with torchaudio and converts it to storage type
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            tuple[np.ndarray, int]: Waveform with shape (channels, samples) and sample rate
+        """
+        a_data, a_data_sr = torchaudio.load(wav_path)
+        a_data = a_data.numpy()
+        if self.dtype == 'int16':
+            a_data = np.clip(np.round(a_data * 32768), -32768, 32767).astype(np.int16)
+
+        return a_data, a_data_sr
+
+    def load_from_disk(self, wav_path: str) -> tuple[np.ndarray, int]:
+        """Opens decoded waveform as memory-mapped array. Decodes and stores audio file if needed.
+        Sample rate is stored in the separate `.sr` file next to the waveform.
+        Waveform is written to temporary file first and renamed,
+        so concurrent workers never read partially written files
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            tuple[np.ndarray, int]: Memory-mapped waveform with shape (channels, samples) and sample rate
+        """
+        cache_path = self.get_cache_path(wav_path)
+        sr_path = cache_path.replace('.npy', '.sr')
+
+        if not (os.path.exists(cache_path) and os.path.exists(sr_path)):
+            a_data, a_data_sr = self.decode(wav_path)
+            tmp_suffix = '.{0}.tmp'.format(os.getpid())
+
+            with open(cache_path + tmp_suffix, 'wb') as f:
+                np.save(f, a_data)
+
+            with open(sr_path + tmp_suffix, 'w') as f:
+                f.write(str(a_data_sr))
+
+            os.replace(sr_path + tmp_suffix, sr_path)
+            os.replace(cache_path + tmp_suffix, cache_path)
+
+        with open(sr_path, 'r') as f:
+            a_data_sr = int(f.read())
+
+        # copy-on-write mode returns writeable array without copying the data
+        return np.load(cache_path, mmap_mode='c'), a_data_sr
+
+    @staticmethod
+    def get_store_paths(wav_path: str) -> tuple[str, str]:
+        """Forms paths of the audio store file and its sample rate file for audio file
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            tuple[str, str]: Paths of `<name>.npy` and `<name>.sr` next to the audio file
+        """
+        name = os.path.splitext(wav_path)[0]
+        return name + '.npy', name + '.sr'
+
+    def is_store_valid(self, wav_path: str) -> bool:
+        """Checks that the audio store file exists and is not older than the audio file (if it exists)
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            bool: True if the waveform should be loaded from the audio store
+        """
+        store_path, sr_path = self.get_store_paths(wav_path)
+        if not (os.path.exists(store_path) and os.path.exists(sr_path)):
+            return False
+
+        return not os.path.exists(wav_path) or os.stat(wav_path).st_mtime_ns <= os.stat(store_path).st_mtime_ns
+
+    def load_from_store(self, wav_path: str) -> tuple[np.ndarray, int]:
+        """Opens int16 waveform of the audio store as memory-mapped array.
+        The waveform is not converted to float32 to avoid copying of the whole file, use `to_float` for its windows
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            tuple[np.ndarray, int]: Waveform with shape (channels, samples) and sample rate
+        """
+        store_path, sr_path = self.get_store_paths(wav_path)
+        with open(sr_path, 'r') as f:
+            a_data_sr = int(f.read())
+
+        return np.load(store_path, mmap_mode='c'), a_data_sr
+
+    def load(self, wav_path: str) -> tuple[torch.Tensor, int]:
+        """Gets waveform from LRU in-RAM layer, from audio store, from disk, or decodes it
+
+        Args:
+            wav_path (str): Audio file path
+
+        Returns:
+            tuple[torch.Tensor, int]: Waveform with shape (channels, samples) and sample rate.
+                                      The waveform is float32 tensor if dtype is 'float32', else int16 tensor.
+                                      Waveforms of the audio store are always int16 tensors
+        """
+        if wav_path in self.waveforms:
+            self.waveforms.move_to_end(wav_path)
+            return self.waveforms[wav_path]
+
+        if self.is_store_valid(wav_path):
+            a_data, a_data_sr = self.load_from_store(wav_path)
+        elif self.cache_root:
+            a_data, a_data_sr = self.load_from_disk(wav_path)
+        else:
+            a_data, a_data_sr = self.decode(wav_path)
+
+        res = (torch.from_numpy(a_data), a_data_sr)
+        self.waveforms[wav_path] = res
+        self.waveform_sizes[wav_path] = self.get_memory_size(a_data)
+        self.num_bytes += self.waveform_sizes[wav_path]
+        while len(self.waveforms) > 1 and (len(self.waveforms) > self.max_items or self.num_bytes > self.max_bytes):
+            evicted_path, _ = self.waveforms.popitem(last=False)
+            self.num_bytes -= self.waveform_sizes.pop(evicted_path)
+
+        return res
+
+    @staticmethod
+    def get_memory_size(a_data: np.ndarray) -> int:
+        """Calculates size of waveform in process memory. Memory-mapped waveforms take no process memory
+
+        Args:
+            a_data (np.ndarray): Waveform
+
+        Returns:
+            int: Size in bytes
+        """
+        base = a_data
+        while isinstance(base, np.ndarray) and not isinstance(base, np.memmap) and base.base is not None:
+            base = base.base
+
+        return 0 if isinstance(base, (np.memmap, mmap.mmap)) else a_data.nbytes
+
+    @staticmethod
+    def to_float(a_data: torch.Tensor) -> torch.Tensor:
+        """Converts int16 waveform (or window of it) to float32 the same way as torchaudio.load does it.
+        Float32 waveforms are returned without changes
+
+        Args:
+            a_data (torch.Tensor): Input waveform
+
+        Returns:
+            torch.Tensor: Float32 waveform
+        """
+        if a_data.dtype == torch.int16:
+            a_data = a_data.float() / 32768
+
+        return a_data
+
+    def __getstate__(self) -> dict:
+        """Drops opened waveforms when cache is pickled to DataLoader workers
+
+        Returns:
+            dict: State of cache
+        """
+        state = self.__dict__.copy()
+        state['waveforms'] = OrderedDict()
+        state['waveform_sizes'] = {}
+        state['num_bytes'] = 0
+        return state
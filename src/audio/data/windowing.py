@@ -0,0 +1,67 @@
+import functools
+
+import numpy as np
+
+from audio.utils.common_utils import round_math
+
+
+@functools.lru_cache(maxsize=None)
+def get_downsampled_frames(frame_rate: int, max_w_len: int, new_fps: int) -> np.ndarray:
+    """Forms indexes of frames of window after downsampling to `new_fps`.
+    The table is computed once per FPS value
+
+    Args:
+        frame_rate (int): Rounded FPS value
+        max_w_len (int): Maximum window length in seconds
+        new_fps (int): FPS after downsampling
+
+    Returns:
+        np.ndarray: Indexes of frames of window. Should not be modified
+    """
+    res = np.asarray(list(map(round_math, np.arange(0, frame_rate * max_w_len - 1, frame_rate / new_fps, dtype=float))))
+    res.flags.writeable = False
+    return res
+
+
+def get_windows(frames: np.ndarray, shift: int, max_w_len: int) -> tuple[np.ndarray, np.ndarray]:
+    """Splits sequence of frames on windows with `shift` and `max_w_len` (both in frames):
+    - `starts` - first row of window, iterates from 0 to len of sequence with step of `shift`
+    - `ends` - row of the last frame number of window (first row after window, or the last row of sequence)
+    - if the window is shorter than `max_w_len` it is replaced with the last `max_w_len` rows of sequence
+    - drops duplicates of windows using (frames[starts], frames[ends]) keys.
+      Windows are sorted by keys
+        f.e. frame_rate = 30, len(seq) = 76, max_w_len = 4 * 30. In this case we will have only 3 seconds of VA.
+        seg 0: frames 0 - 60 extended to 4 * 30 and converted to 0 - 76
+        seg 1: frames 60 - 76 extended to 4 * 30 and converted to 0 - 76
+
+    Args:
+        frames (np.ndarray): Frame numbers of sequence
+        shift (int): Window shift in frames
+        max_w_len (int): Maximum window length in frames
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Rows of window starts and rows of window ends
+    """
+    num_frames = len(frames)
+    segs = np.arange(0, num_frames, shift)
+
+    starts = np.where(segs + max_w_len > num_frames, max(0, num_frames - max_w_len), segs)
+    ends = np.minimum(segs + max_w_len, num_frames - 1)
+
+    _, unique_idx = np.unique(np.stack([frames[starts], frames[ends]], axis=1), axis=0, return_index=True)
+    return starts[unique_idx], ends[unique_idx]
+
+
+def mode_rows(rows: np.ndarray) -> np.ndarray:
+    """Calculates moda for each row. Ties are resolved as in `max(set(row), key=list(row).count)`.
+    Moda is calculated only once for each unique row
+
+    Args:
+        rows (np.ndarray): Array with shape (num_rows, row_len)
+
+    Returns:
+        np.ndarray: Moda values with shape (num_rows,)
+    """
+    unique_rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+    modes = np.asarray([max(set(r), key=list(r).count) for r in unique_rows])
+    return modes[inverse.reshape(-1)]
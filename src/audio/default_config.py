@@ -12,6 +12,12 @@ config_expr: dict = {
     'VIDEO_ROOT': '',
     'LABELS_ROOT': '',
     'FEATURES_ROOT': '',
+    'WAVEFORM_CACHE_ROOT': None,
+    'FROZEN_PREFIX_CACHE_ROOT': None,
+    'LENGTH_BUCKETING': False,
+    'LONG_FORM_EXTRACTION': False,
+    'LONG_FORM_CHUNK_SIZE': 60,
+    'MOUTH_OPEN_GATING': False,
     
     ###
     'LOGS_ROOT': '',
@@ -33,6 +39,12 @@ config_va: dict = {
     'VIDEO_ROOT': '',
     'LABELS_ROOT': '',
     'FEATURES_ROOT': '',
+    'WAVEFORM_CACHE_ROOT': None,
+    'FROZEN_PREFIX_CACHE_ROOT': None,
+    'LENGTH_BUCKETING': False,
+    'LONG_FORM_EXTRACTION': False,
+    'LONG_FORM_CHUNK_SIZE': 60,
+    'MOUTH_OPEN_GATING': False,
     
     ###
     'LOGS_ROOT': '',
@@ -55,6 +67,9 @@ config_vae: dict = {
     'LABELS_VA_ROOT': '',
     'LABELS_EXPR_ROOT': '',
     'FEATURES_ROOT': '',
+    'WAVEFORM_CACHE_ROOT': None,
+    'FROZEN_PREFIX_CACHE_ROOT': None,
+    'LENGTH_BUCKETING': False,
     
     ###
     'LOGS_ROOT': '',
@@ -10,9 +10,15 @@ import numpy as np
 
 import torch
 
+from torch.utils.data import default_collate
+
 from audio.config import config_expr, config_va
 
 from audio.data.abaw_fe_dataset import AbawFEDataset, VAEGrouping
+from audio.data.wav2vec2_collator import Wav2Vec2Collator
+from audio.data.length_bucketing import LengthBucketBatchSampler, get_window_lengths
+
+from audio.models.long_form_wav2vec2 import LongFormWav2Vec2, LongFormBatches
 
 from audio.net_trainer.net_trainer import NetTrainer, ProblemType
 
@@ -25,6 +31,10 @@ from audio.utils.common_utils import define_seed
 
 def feature_extraction(model_params: dict, config: dict, problem_type: ProblemType) -> None:
     audio_root = config['FILTERED_WAV_ROOT'] if config['FILTERED'] else config['WAV_ROOT']
+    waveform_cache_root = config.get('WAVEFORM_CACHE_ROOT', None)
+    long_form_extraction = config.get('LONG_FORM_EXTRACTION', False)
+    length_bucketing = config.get('LENGTH_BUCKETING', False) and not long_form_extraction
+    mouth_open_gating = config.get('MOUTH_OPEN_GATING', False)
     video_root = config['VIDEO_ROOT']
     labels_root = config['LABELS_ROOT']
     features_root = config['FEATURES_ROOT']
@@ -69,7 +79,9 @@ def feature_extraction(model_params: dict, config: dict, problem_type: ProblemTy
                                      va_frames_grouping=None if problem_type == ProblemType.CLASSIFICATION else VAEGrouping.F2F,
                                      expr_frames_grouping=None if problem_type == ProblemType.REGRESSION else VAEGrouping.F2S,
                                      multitask=False,
-                                     shift=2, min_w_len=2, max_w_len=4, processor_name=model_name,
+                                     shift=2, min_w_len=2, max_w_len=4,
+                                     waveform_cache_root=waveform_cache_root,
+                                     pad_waves=not length_bucketing,
                                      transform=None)
 
     define_seed(0)
@@ -86,18 +98,45 @@ def feature_extraction(model_params: dict, config: dict, problem_type: ProblemTy
                              group_predicts_fn=None,
                              source_code=None)
         
+    collate_fn = Wav2Vec2Collator(processor_name=model_name, max_length=4 * 16000 if length_bucketing else None)
+    long_form = LongFormWav2Vec2(collate_fn, chunk_size=config.get('LONG_FORM_CHUNK_SIZE', 60)) if long_form_extraction else None
     dataloaders = {}
+    gated_indexes = {}
     for ds in ds_names:
+        indexes = np.arange(len(datasets[ds]))
+        gated_indexes[ds] = []
+        if mouth_open_gating:
+            # only windows with open mouth are passed through the model
+            indexes = datasets[ds].get_open_mouth_indexes()
+            gated_indexes[ds] = np.setdiff1d(np.arange(len(datasets[ds])), indexes).tolist()
+
+        if long_form:
+            # CNN feature encoder is computed once per file instead of once per window
+            dataloaders[ds] = LongFormBatches(long_form, datasets[ds], batch_size=batch_size, indexes=indexes.tolist())
+            continue
+
+        if length_bucketing:
+            # windows are padded in batch and wav2vec2 gets attention mask
+            dataloaders[ds] = torch.utils.data.DataLoader(
+                torch.utils.data.Subset(datasets[ds], indexes.tolist()),
+                batch_sampler=LengthBucketBatchSampler(get_window_lengths(datasets[ds])[indexes], batch_size=batch_size),
+                num_workers=8,
+                collate_fn=collate_fn)
+            continue
+
         dataloaders[ds] = torch.utils.data.DataLoader(
-            datasets[ds],
+            torch.utils.data.Subset(datasets[ds], indexes.tolist()),
             batch_size=batch_size,
             shuffle=False,
-            num_workers=8)
+            num_workers=8,
+            collate_fn=collate_fn)
     
     model = model_params['model_cls'].from_pretrained(model_name)
     model.load_state_dict(torch.load(os.path.join(model_params['root_path'], 'epoch_{}.pth'.format(model_params['epoch'])))['model_state_dict'])
     
     model.to(device)
+    if long_form:
+        long_form.attach(model)
     
     net_trainer.optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
     net_trainer.model = model
@@ -115,8 +154,19 @@ def feature_extraction(model_params: dict, config: dict, problem_type: ProblemTy
         targets, predicts, features, sample_info = net_trainer.extract_features(phase='test', 
                                                                                 dataloader=v,
                                                                                 verbose=True)
+        gated = [False] * len(predicts)
+
+        if gated_indexes[ds]:
+            # windows with closed mouth are not passed through the model: predicts and features are None
+            gated_targets, gated_sample_info = default_collate([datasets[ds].get_targets_and_info(idx) for idx in gated_indexes[ds]])
+            targets.extend(gated_targets.numpy())
+            predicts.extend([None] * len(gated_indexes[ds]))
+            features.extend([None] * len(gated_indexes[ds]))
+            gated.extend([True] * len(gated_indexes[ds]))
+            sample_info.extend(gated_sample_info)
 
         new_sample_info = {}
+        offset = 0 # batches of batch sampler can be incomplete
         for s_idx, si in enumerate(sample_info):            
             for idx, fn in enumerate(si['filename']):
                 if fn not in new_sample_info:
@@ -124,15 +174,17 @@ def feature_extraction(model_params: dict, config: dict, problem_type: ProblemTy
                     new_sample_info[fn]['targets'] = []
                     new_sample_info[fn]['predicts'] = []
                     new_sample_info[fn]['features'] = []
+                    new_sample_info[fn]['gated'] = []
                     for k in si.keys():
                         if 'filename' in k:
                             continue
 
                         new_sample_info[fn][keys_mapping[k]] = []
 
-                new_sample_info[fn]['targets'].append(targets[idx + s_idx * batch_size])
-                new_sample_info[fn]['predicts'].append(predicts[idx + s_idx * batch_size])
-                new_sample_info[fn]['features'].append(features[idx + s_idx * batch_size])
+                new_sample_info[fn]['targets'].append(targets[offset + idx])
+                new_sample_info[fn]['predicts'].append(predicts[offset + idx])
+                new_sample_info[fn]['features'].append(features[offset + idx])
+                new_sample_info[fn]['gated'].append(gated[offset + idx])
                 for k in si.keys():
                     if 'filename' in k:
                         continue
@@ -144,11 +196,24 @@ def feature_extraction(model_params: dict, config: dict, problem_type: ProblemTy
                     else:
                         new_sample_info[fn][keys_mapping[k]].append(si[k][idx].numpy())
 
+            offset += len(si['filename'])
+
+        if length_bucketing or mouth_open_gating:
+            # restore the order of windows of dataset (windows of file are sorted by frames)
+            for fn in new_sample_info:
+                order = sorted(range(len(new_sample_info[fn]['frame_start'])),
+                               key=lambda i: (new_sample_info[fn]['frame_start'][i], new_sample_info[fn]['frame_end'][i]))
+                for k in new_sample_info[fn]:
+                    new_sample_info[fn][k] = [new_sample_info[fn][k][i] for i in order]
+
         with open(os.path.join(logs_root, 
                                '{0}_{1}.pickle'.format('expr' if problem_type == ProblemType.CLASSIFICATION else 'va', ds)), 
                   'wb') as handle:
             pickle.dump(new_sample_info, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    if long_form:
+        long_form.detach(model)
+
 
 if __name__ == '__main__':
     # EXPR model - wCELSa-ExprModelV3-2024.03.02-09.24.44, spleeter
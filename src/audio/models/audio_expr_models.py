@@ -14,6 +14,7 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
  
 
 from audio.models.attention_layers import TransformerLayer
+from audio.models.masked_wav2vec2 import forward_wav2vec2
 
 
 class ExprModelV1(Wav2Vec2PreTrainedModel):
@@ -53,10 +54,10 @@ class ExprModelV1(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
  
-    def forward(self, x):
-        outputs = self.wav2vec2(x)
+    def forward(self, x, attention_mask=None):
+        outputs = forward_wav2vec2(self.wav2vec2, x, attention_mask)
  
-        x, h = self.gru(outputs[0])
+        x, h = self.gru(outputs)
 
         x = x.permute(0, 2, 1)
         x = self.time_downsample(x)
@@ -103,8 +104,8 @@ class ExprModelV2(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -159,8 +160,8 @@ class ExprModelV3(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def get_features(self, x):
-        x = self.wav2vec2(x)[0]
+    def get_features(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -172,8 +173,8 @@ class ExprModelV3(Wav2Vec2PreTrainedModel):
         x = self.feature_downsample(features)
         return x, features
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
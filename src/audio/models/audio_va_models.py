@@ -13,6 +13,7 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
 )
 
 from audio.models.attention_layers import TransformerLayer
+from audio.models.masked_wav2vec2 import forward_wav2vec2
 
 
 class VAModelV1(Wav2Vec2PreTrainedModel):
@@ -47,9 +48,9 @@ class VAModelV1(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def forward(self, x):
-        outputs = self.wav2vec2(x)
-        x, h = self.gru(outputs[0])
+    def forward(self, x, attention_mask=None):
+        outputs = forward_wav2vec2(self.wav2vec2, x, attention_mask)
+        x, h = self.gru(outputs)
 
         x = x.permute(0, 2, 1)
         x = self.time_downsample(x)
@@ -93,8 +94,8 @@ class VAModelV2(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -146,8 +147,8 @@ class VAModelV3(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def get_features(self, x):
-        x = self.wav2vec2(x)[0]
+    def get_features(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -160,8 +161,8 @@ class VAModelV3(Wav2Vec2PreTrainedModel):
         x = self.tanh_va(x)
         return x, features
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
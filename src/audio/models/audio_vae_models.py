@@ -14,6 +14,7 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
  
 
 from audio.models.attention_layers import TransformerLayer
+from audio.models.masked_wav2vec2 import forward_wav2vec2
 
 
 class VAEModelV1(Wav2Vec2PreTrainedModel):
@@ -57,7 +58,7 @@ class VAEModelV1(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
  
-    def forward(self, x: torch.Tensor) -> list[torch.Tensor]:
+    def forward(self, x: torch.Tensor, attention_mask: torch.Tensor = None) -> list[torch.Tensor]:
         """Forward pass
         wav2vec2 (bs, 199, 256) => x_va (bs, 20, 256) => x_e (bs, 4, 256)
                                    x_va (bs, 20, 2)      x_e (bs, 4, 8)
@@ -65,13 +66,14 @@ class VAEModelV1(Wav2Vec2PreTrainedModel):
         
         Args:
             x (torch.Tensor): Tensor of shape (bs, 64000), where 64000 = 16000 * 4 sec.
+            attention_mask (torch.Tensor, optional): Mask of real samples of shape (bs, 64000). Defaults to None.
 
         Returns:
             list[torch.Tensor]: Return valence/arousal values and expression probability (without softmax)
         """
-        outputs = self.wav2vec2(x)
+        outputs = forward_wav2vec2(self.wav2vec2, x, attention_mask)
  
-        x, h = self.gru(outputs[0])
+        x, h = self.gru(outputs)
 
         x = x.permute(0, 2, 1)
         x_va = self.time_downsample_va(x)
@@ -128,8 +130,8 @@ class VAEModelV2(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -194,8 +196,8 @@ class VAEModelV3(Wav2Vec2PreTrainedModel):
             for param in self.wav2vec2.encoder.layers[-1 * (i + 1)].parameters():
                 param.requires_grad = True
 
-    def forward(self, x):
-        x = self.wav2vec2(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = forward_wav2vec2(self.wav2vec2, x, attention_mask)
 
         x = self.tl1(query=x, key=x, value=x)
         x = self.tl2(query=x, key=x, value=x)
@@ -0,0 +1,224 @@
+import os
+import hashlib
+
+import numpy as np
+import torch
+
+from transformers.models.wav2vec2.modeling_wav2vec2 import Wav2Vec2Model
+
+
+def count_frozen_layers(wav2vec2: Wav2Vec2Model) -> int:
+    """Counts leading transformer blocks of wav2vec2 without trainable parameters.
+    Feature encoder, feature projection and positional embedding should be frozen too,
+    otherwise there is no frozen prefix
+
+    Args:
+        wav2vec2 (Wav2Vec2Model): Wav2vec2 model
+
+    Returns:
+        int: Number of frozen transformer blocks
+    """
+    frozen_modules = [wav2vec2.feature_extractor, wav2vec2.feature_projection, wav2vec2.encoder.pos_conv_embed]
+    if not wav2vec2.config.do_stable_layer_norm:
+        frozen_modules.append(wav2vec2.encoder.layer_norm)
+
+    if any(param.requires_grad for m in frozen_modules for param in m.parameters()):
+        return 0
+
+    num_layers = 0
+    for layer in wav2vec2.encoder.layers:
+        if any(param.requires_grad for param in layer.parameters()):
+            break
+
+        num_layers += 1
+
+    return num_layers
+
+
+class FrozenPrefixCache:
+    """Caches outputs of the frozen part of wav2vec2 (frozen prefix):
+    CNN feature encoder, feature projection, positional embedding and frozen transformer blocks.
+    Models call `unfreeze_last_n_blocks`, so only the last blocks (tail) are trained,
+    and the frozen prefix is computed only once per window.
+
+    - `attach` replaces forward of model.wav2vec2 with forward of the tail.
+      After that the model takes cached hidden states instead of waves. State dict of the model is not changed
+    - `__call__` gets hidden states of frozen prefix for batch of waves:
+      reads them from disk, or computes and stores them in fp16.
+      Key of window is a content hash of wave and frozen prefix.
+      Augmented waves are never stored (cache is valid only for augmentation=None)
+    - `detach` restores original forward of model.wav2vec2
+
+    ! Note ! Frozen prefix is computed in eval mode, so dropout/LayerDrop/time masking are not applied to it
+
+    Args:
+        cache_root (str): Root dir for hidden states
+    """
+    def __init__(self, cache_root: str) -> None:
+        self.cache_root = cache_root
+        self.wav2vec2 = None
+        self.num_frozen_layers = 0
+        self.prefix_id = None
+
+        os.makedirs(self.cache_root, exist_ok=True)
+
+    def attach(self, model: torch.nn.Module) -> None:
+        """Switches model to frozen prefix mode
+
+        Args:
+            model (torch.nn.Module): Model with wav2vec2 backbone
+
+        Raises:
+            ValueError: Raises error if wav2vec2 has no frozen transformer blocks
+        """
+        self.num_frozen_layers = count_frozen_layers(model.wav2vec2)
+        if self.num_frozen_layers == 0:
+            raise ValueError('Model has no frozen prefix')
+
+        self.wav2vec2 = model.wav2vec2
+        self.prefix_id = '{0}:{1}:{2}'.format(self.wav2vec2.config._name_or_path,
+                                              type(self.wav2vec2.encoder).__name__,
+                                              self.num_frozen_layers)
+        self.wav2vec2.forward = self.forward_tail
+
+    def detach(self, model: torch.nn.Module) -> None:
+        """Switches model back to original mode
+
+        Args:
+            model (torch.nn.Module): Model with wav2vec2 backbone
+        """
+        if 'forward' in model.wav2vec2.__dict__:
+            del model.wav2vec2.forward
+
+        self.wav2vec2 = None
+
+    @staticmethod
+    def forward_layer(layer: torch.nn.Module, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Computes one transformer block of wav2vec2.
+        Depending on transformers version the block returns tuple or tensor
+
+        Args:
+            layer (torch.nn.Module): Transformer block
+            hidden_states (torch.Tensor): Input hidden states
+
+        Returns:
+            torch.Tensor: Output hidden states
+        """
+        layer_outputs = layer(hidden_states)
+        return layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+
+    def forward_prefix(self, x: torch.Tensor) -> torch.Tensor:
+        """Computes hidden states of frozen prefix in eval mode
+
+        Args:
+            x (torch.Tensor): Waves with shape (bs, samples)
+
+        Returns:
+            torch.Tensor: Hidden states with shape (bs, frames, hidden_size)
+        """
+        wav2vec2 = self.wav2vec2
+        encoder = wav2vec2.encoder
+        is_training = wav2vec2.training
+        wav2vec2.eval()
+
+        with torch.no_grad():
+            hidden_states = wav2vec2.feature_extractor(x).transpose(1, 2)
+            hidden_states, _ = wav2vec2.feature_projection(hidden_states)
+
+            hidden_states = hidden_states + encoder.pos_conv_embed(hidden_states)
+            if not wav2vec2.config.do_stable_layer_norm:
+                hidden_states = encoder.layer_norm(hidden_states)
+
+            hidden_states = encoder.dropout(hidden_states)
+            for layer in encoder.layers[:self.num_frozen_layers]:
+                hidden_states = self.forward_layer(layer, hidden_states)
+
+        wav2vec2.train(is_training)
+        return hidden_states
+
+    def forward_tail(self, hidden_states: torch.Tensor) -> tuple[torch.Tensor]:
+        """Computes trainable transformer blocks of wav2vec2 using hidden states of frozen prefix.
+        Repeats the logic of Wav2Vec2Encoder/Wav2Vec2EncoderStableLayerNorm (with LayerDrop)
+
+        Args:
+            hidden_states (torch.Tensor): Hidden states of frozen prefix
+
+        Returns:
+            tuple[torch.Tensor]: Last hidden state as tuple, the same as output of Wav2Vec2Model
+        """
+        wav2vec2 = self.wav2vec2
+        encoder = wav2vec2.encoder
+
+        for layer in encoder.layers[self.num_frozen_layers:]:
+            # LayerDrop
+            if encoder.training and (torch.rand([]) < wav2vec2.config.layerdrop):
+                continue
+
+            hidden_states = self.forward_layer(layer, hidden_states)
+
+        if wav2vec2.config.do_stable_layer_norm:
+            hidden_states = encoder.layer_norm(hidden_states)
+
+        if wav2vec2.adapter is not None:
+            hidden_states = wav2vec2.adapter(hidden_states)
+
+        return (hidden_states,)
+
+    def get_key(self, wave: np.ndarray) -> str:
+        """Forms content hash of wave and frozen prefix
+
+        Args:
+            wave (np.ndarray): Wave
+
+        Returns:
+            str: Key of window
+        """
+        h = hashlib.sha1(self.prefix_id.encode())
+        h.update(np.ascontiguousarray(wave, dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    def __call__(self, inps: torch.Tensor, augmented: torch.Tensor = None, device: torch.device = None) -> torch.Tensor:
+        """Gets hidden states of frozen prefix for batch of waves.
+        Only missing windows are computed
+
+        Args:
+            inps (torch.Tensor): Waves with shape (bs, samples)
+            augmented (torch.Tensor, optional): Flags of augmented waves with shape (bs,).
+                                                If None, all waves are treated as not augmented. Defaults to None.
+            device (torch.device, optional): Device of the model. Defaults to None.
+
+        Returns:
+            torch.Tensor: Hidden states with shape (bs, frames, hidden_size) on device
+        """
+        device = device if device else inps.device
+        waves = inps.cpu().numpy()
+        augmented = augmented.cpu().numpy().astype(bool) if augmented is not None else np.zeros(len(waves), dtype=bool)
+
+        hidden_states = [None] * len(waves)
+        paths = [None] * len(waves)
+        for idx, wave in enumerate(waves):
+            if augmented[idx]:
+                continue
+
+            key = self.get_key(wave)
+            paths[idx] = os.path.join(self.cache_root, key[:2], '{0}.npy'.format(key))
+            if os.path.exists(paths[idx]):
+                hidden_states[idx] = torch.from_numpy(np.load(paths[idx]).astype(np.float32))
+
+        missing = [idx for idx, hs in enumerate(hidden_states) if hs is None]
+        if missing:
+            new_hidden_states = self.forward_prefix(inps[missing].to(device)).cpu()
+            for idx, hs in zip(missing, new_hidden_states):
+                # the same precision as stored hidden states
+                hidden_states[idx] = hs.half().float()
+                if paths[idx] is None:
+                    continue
+
+                os.makedirs(os.path.dirname(paths[idx]), exist_ok=True)
+                tmp_path = '{0}.{1}.tmp'.format(paths[idx], os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, hs.half().numpy())
+
+                os.replace(tmp_path, paths[idx])
+
+        return torch.stack(hidden_states).to(device)
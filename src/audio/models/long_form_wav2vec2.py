@@ -0,0 +1,209 @@
+import numpy as np
+import torch
+
+from torch.utils.data import default_collate
+
+from audio.data.waveform_cache import WaveformCache
+from audio.data.wav2vec2_collator import Wav2Vec2Collator
+
+
+def get_conv_geometry(config) -> tuple[int, int]:
+    """Calculates receptive field and total stride (in samples) of CNN feature encoder of wav2vec2
+
+    Args:
+        config (Wav2Vec2Config): Config of wav2vec2
+
+    Returns:
+        tuple[int, int]: Receptive field and stride of one frame of CNN feature encoder
+    """
+    receptive_field, stride = 1, 1
+    for kernel, conv_stride in zip(config.conv_kernel, config.conv_stride):
+        receptive_field += (kernel - 1) * stride
+        stride *= conv_stride
+
+    return receptive_field, stride
+
+
+class LongFormWav2Vec2:
+    """Long-form feature extraction with wav2vec2 for overlapping windows.
+    With `shift` < `max_w_len` every second of audio is passed through CNN feature encoder of each window.
+    In long-form mode CNN feature encoder and feature projection are computed once per file
+    (in chunks of `chunk_size` seconds), and the windows are slices of the shared frame sequence:
+    - `attach` replaces forward of model.wav2vec2 with forward of the transformer encoder.
+      After that the model takes projected frames instead of waves. State dict of the model is not changed
+    - `get_frames` computes frames of the whole file. Frame k covers samples [k * stride, k * stride + receptive_field),
+      so the chunks are overlapped by receptive_field - stride samples and the result does not depend on `chunk_size`.
+      It holds only for feat_extract_norm='layer' (as in wav2vec2-large): with 'group' normalization
+      the first CNN layer is normalized over the whole time axis, so frames depend on the chunk
+      and cannot be shared between windows. `attach` raises ValueError for such models
+    - window starting at `start_t` takes frames from round(start_t * sr / stride), the number of frames is the same
+      as for the wave of `max_w_len` seconds
+    - `detach` restores original forward of model.wav2vec2
+
+    ! Note ! The result is close but not equal to the windowed extraction:
+    the wave is normalized over the whole file instead of the window,
+    and the frames at the window edges see the neighbouring audio instead of zero padding
+
+    Args:
+        collate_fn (Wav2Vec2Collator): Collator of windowed extraction, used for normalization of waves
+        chunk_size (float, optional): Length of chunks for CNN feature encoder in seconds. Defaults to 60.
+        sr (int, optional): Sample rate of audio files. Defaults to 16000.
+    """
+    def __init__(self, collate_fn: Wav2Vec2Collator, chunk_size: float = 60, sr: int = 16000) -> None:
+        self.collate_fn = collate_fn
+        self.chunk_size = chunk_size
+        self.sr = sr
+        self.wav2vec2 = None
+        self.receptive_field = None
+        self.stride = None
+
+    def attach(self, model: torch.nn.Module) -> None:
+        """Switches model to long-form mode
+
+        Args:
+            model (torch.nn.Module): Model with wav2vec2 backbone
+
+        Raises:
+            ValueError: If feature encoder of the model is not normalized per frame (feat_extract_norm != 'layer')
+        """
+        feat_extract_norm = getattr(model.wav2vec2.config, 'feat_extract_norm', None)
+        if feat_extract_norm != 'layer':
+            raise ValueError('Long-form extraction requires feat_extract_norm=\'layer\', got {0}: '
+                             'CNN frames can not be shared between windows'.format(feat_extract_norm))
+
+        self.wav2vec2 = model.wav2vec2
+        self.receptive_field, self.stride = get_conv_geometry(self.wav2vec2.config)
+        self.wav2vec2.forward = self.forward_encoder
+
+    def detach(self, model: torch.nn.Module) -> None:
+        """Switches model back to original mode
+
+        Args:
+            model (torch.nn.Module): Model with wav2vec2 backbone
+        """
+        if 'forward' in model.wav2vec2.__dict__:
+            del model.wav2vec2.forward
+
+        self.wav2vec2 = None
+
+    def get_num_frames(self, num_samples: int) -> int:
+        """Calculates number of frames of CNN feature encoder for wave
+
+        Args:
+            num_samples (int): Length of wave in samples
+
+        Returns:
+            int: Number of frames
+        """
+        return max(0, (num_samples - self.receptive_field) // self.stride + 1)
+
+    def forward_encoder(self, hidden_states: torch.Tensor) -> tuple[torch.Tensor]:
+        """Computes transformer encoder of wav2vec2 using projected frames of window
+
+        Args:
+            hidden_states (torch.Tensor): Projected frames with shape (bs, frames, hidden_size)
+
+        Returns:
+            tuple[torch.Tensor]: Last hidden state as tuple, the same as output of Wav2Vec2Model
+        """
+        hidden_states = self.wav2vec2.encoder(hidden_states)[0]
+        if self.wav2vec2.adapter is not None:
+            hidden_states = self.wav2vec2.adapter(hidden_states)
+
+        return (hidden_states,)
+
+    def get_frames(self, wave: torch.Tensor, num_frames: int) -> torch.Tensor:
+        """Computes projected frames of CNN feature encoder for the whole file chunk by chunk.
+        Wave is normalized and padded with zeros to `num_frames` frames
+
+        Args:
+            wave (torch.Tensor): Float32 wave with shape (samples,)
+            num_frames (int): Number of frames
+
+        Returns:
+            torch.Tensor: Projected frames with shape (num_frames, hidden_size) on device of the model
+        """
+        wav2vec2 = self.wav2vec2
+        device = next(wav2vec2.parameters()).device
+        if self.collate_fn.do_normalize:
+            wave = self.collate_fn.normalize(wave.unsqueeze(0)).squeeze(0)
+
+        num_samples = (num_frames - 1) * self.stride + self.receptive_field
+        wave = torch.nn.functional.pad(wave, (0, max(0, num_samples - len(wave))), mode='constant')
+
+        chunk_frames = max(1, self.get_num_frames(int(self.chunk_size * self.sr)))
+        frames = []
+        with torch.no_grad():
+            for start in range(0, num_frames, chunk_frames):
+                end = min(start + chunk_frames, num_frames)
+                chunk = wave[start * self.stride: (end - 1) * self.stride + self.receptive_field]
+                hidden_states = wav2vec2.feature_extractor(chunk.unsqueeze(0).to(device)).transpose(1, 2)
+                hidden_states, _ = wav2vec2.feature_projection(hidden_states)
+                frames.append(hidden_states.squeeze(0))
+
+        return torch.cat(frames)
+
+
+class LongFormBatches:
+    """Iterates over windows of dataset in long-form mode.
+    Replaces DataLoader in `NetTrainer.extract_features`: batches contain projected frames of windows
+    instead of waves, labels and sample_info are collated the same way as in DataLoader.
+    Windows are grouped by audio file (their order within the file is kept),
+    only frames of the current file are kept in memory
+
+    Args:
+        long_form (LongFormWav2Vec2): Long-form extractor attached to the model
+        dataset (torch.utils.data.Dataset): Dataset with `get_wav_path`, `get_targets_and_info` and `meta`
+        batch_size (int): Number of windows in batch
+        indexes (list[int], optional): Indexes of windows to iterate over. If None, all windows are used. Defaults to None.
+    """
+    def __init__(self, long_form: LongFormWav2Vec2, dataset: torch.utils.data.Dataset, batch_size: int, 
+                 indexes: list[int] = None) -> None:
+        self.long_form = long_form
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.indexes = indexes if indexes is not None else list(range(len(dataset)))
+
+    def __len__(self) -> int:
+        return (len(self.indexes) + self.batch_size - 1) // self.batch_size
+
+    def get_file_frames(self, indexes: list[int]) -> tuple[torch.Tensor, np.ndarray]:
+        """Computes frames of file and rows of frames of each window
+
+        Args:
+            indexes (list[int]): Indexes of windows of the file in dataset
+
+        Returns:
+            tuple[torch.Tensor, np.ndarray]: Projected frames of file and rows of windows with shape (windows, window_frames)
+        """
+        a_data, a_data_sr = self.dataset.waveform_cache.load(self.dataset.get_wav_path(indexes[0]))
+        wave = WaveformCache.to_float(a_data).squeeze(0)
+
+        stride = self.long_form.stride
+        starts = np.asarray([round(round(a_data_sr * self.dataset.meta[idx]['start_t']) / stride) for idx in indexes])
+        window_frames = self.long_form.get_num_frames(self.dataset.max_w_len * a_data_sr)
+        frames = self.long_form.get_frames(wave, num_frames=int(starts.max()) + window_frames)
+        return frames, starts[:, np.newaxis] + np.arange(window_frames)
+
+    def __iter__(self):
+        """Yields batches of windows
+
+        Yields:
+            list: Projected frames of windows with shape (bs, frames, hidden_size), collated labels and sample_info
+        """
+        file_indexes = {}
+        for idx in self.indexes:
+            file_indexes.setdefault(self.dataset.get_wav_path(idx), []).append(idx)
+
+        batch_frames, batch_samples = [], []
+        for indexes in file_indexes.values():
+            frames, window_rows = self.get_file_frames(indexes)
+            for idx, rows in zip(indexes, window_rows):
+                batch_frames.append(frames[torch.from_numpy(rows).to(frames.device)])
+                batch_samples.append(self.dataset.get_targets_and_info(idx))
+                if len(batch_frames) == self.batch_size:
+                    yield [torch.stack(batch_frames), *default_collate(batch_samples)]
+                    batch_frames, batch_samples = [], []
+
+        if batch_frames:
+            yield [torch.stack(batch_frames), *default_collate(batch_samples)]
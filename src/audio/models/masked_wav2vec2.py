@@ -0,0 +1,37 @@
+import torch
+
+from transformers.models.wav2vec2.modeling_wav2vec2 import Wav2Vec2Model
+
+from audio.models.long_form_wav2vec2 import get_conv_geometry
+
+
+def forward_wav2vec2(wav2vec2: Wav2Vec2Model, x: torch.Tensor, attention_mask: torch.Tensor = None) -> torch.Tensor:
+    """Computes last hidden state of wav2vec2 for batch of windows padded to the same length.
+    If `attention_mask` is set (see `Wav2Vec2Collator(max_length=...)`):
+    - Waves are cut to the longest window of the batch, so padding is not computed
+      (batches of short windows are formed by `LengthBucketBatchSampler`)
+    - wav2vec2 gets the attention mask, so padding does not affect the hidden states of real frames
+    - Hidden states of padding are set to zero, and the hidden states are padded with zeros to the number of frames
+      of the padded window, so the heads of models get the same time axis as without attention mask
+
+    Args:
+        wav2vec2 (Wav2Vec2Model): Wav2vec2 model
+        x (torch.Tensor): Waves with shape (bs, samples) or hidden states (in frozen prefix or long-form mode)
+        attention_mask (torch.Tensor, optional): Mask of real samples with shape (bs, samples). Defaults to None.
+
+    Returns:
+        torch.Tensor: Last hidden state with shape (bs, frames, hidden_size)
+    """
+    if attention_mask is None:
+        return wav2vec2(x)[0]
+
+    receptive_field, stride = get_conv_geometry(wav2vec2.config)
+    num_frames = max(0, (x.shape[1] - receptive_field) // stride + 1)
+
+    length = max(int(attention_mask.sum(dim=1).max()), receptive_field)
+    x, attention_mask = x[:, :length], attention_mask[:, :length]
+
+    hidden_states = wav2vec2(x, attention_mask=attention_mask)[0]
+    frames_mask = wav2vec2._get_feature_vector_attention_mask(hidden_states.shape[1], attention_mask)
+    hidden_states = hidden_states * frames_mask.unsqueeze(-1).to(hidden_states.dtype)
+    return torch.nn.functional.pad(hidden_states, (0, 0, 0, num_frames - hidden_states.shape[1]))
@@ -13,6 +13,7 @@ from tensorboardX import SummaryWriter
 from audio.utils.accuracy_utils import conf_matrix
 from audio.visualization.visualize import plot_conf_matrix
 from audio.utils.common_utils import create_logger
+from audio.models.frozen_prefix_cache import FrozenPrefixCache
 
 
 class ProblemType(Enum):
@@ -50,6 +51,10 @@ class NetTrainer:
                                                     Defaults to None.
             source_code (str, optional): Source code and configuration for logging. Defaults to None.
             c_names_to_display (list[str], optional): Class names to visualize confuson matrix. Defaults to None.
+            frozen_prefix_cache_root (str, optional): Root dir for hidden states of frozen part of wav2vec2. 
+                                                      Enables frozen prefix cache mode if the value is set: 
+                                                      frozen part of wav2vec2 is computed once per window, and only the unfrozen tail is trained. 
+                                                      Defaults to None.
         """
     def __init__(self, 
                  log_root: str, 
@@ -60,7 +65,8 @@ class NetTrainer:
                  problem_type: ProblemType = ProblemType.CLASSIFICATION,
                  group_predicts_fn: callable = None, 
                  source_code: str = None, 
-                 c_names_to_display: list[str] = None) -> None:
+                 c_names_to_display: list[str] = None,
+                 frozen_prefix_cache_root: str = None) -> None:
         self.device = device
 
         self.model = None
@@ -82,6 +88,7 @@ class NetTrainer:
                 f.write(source_code)
 
         self.group_predicts_fn = group_predicts_fn
+        self.frozen_prefix_cache = FrozenPrefixCache(frozen_prefix_cache_root) if frozen_prefix_cache_root else None
 
         self.logging_paths = None
         self.logger = None
@@ -153,6 +160,9 @@ class NetTrainer:
         self.scheduler = scheduler
         
         self.create_loggers(fold_num)
+        if self.frozen_prefix_cache:
+            self.frozen_prefix_cache.attach(model)
+
         d_global_stats = []
         
         summary = {}
@@ -267,9 +277,27 @@ class NetTrainer:
 
         for phase in phases:
             summary[phase].close()
+        
+        if self.frozen_prefix_cache:
+            self.frozen_prefix_cache.detach(model)
             
         return model, max_perf
     
+    def split_attention_mask(self, inps: torch.Tensor | dict) -> tuple[torch.Tensor, torch.Tensor]:
+        """Splits inputs collated with attention mask (see `Wav2Vec2Collator(max_length=...)`) on waves and mask.
+        The mask is moved to device
+
+        Args:
+            inps (torch.Tensor | dict): Inputs of batch: waves or dict with `input_values` and `attention_mask`
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Waves and attention mask (None if inputs have no mask)
+        """
+        if not isinstance(inps, dict):
+            return inps, None
+
+        return inps['input_values'], inps['attention_mask'].to(self.device)
+
     def iterate_model(self, 
                       phase: str, 
                       dataloader: torch.utils.data.dataloader.DataLoader, 
@@ -309,7 +337,12 @@ class NetTrainer:
         # Iterate over data.
         for idx, data in enumerate(tqdm(dataloader, disable=not verbose)):
             inps, labs, s_info = data
-            if isinstance(inps, list):
+            inps, attention_mask = self.split_attention_mask(inps)
+            if self.frozen_prefix_cache:
+                # hidden states of frozen prefix are cached for the whole padded windows
+                attention_mask = None
+                inps = self.frozen_prefix_cache(inps, augmented=s_info[0].get('augmented', None), device=self.device)
+            elif isinstance(inps, list):
                 inps = [d.to(self.device) for d in inps]
             else:
                 inps = inps.to(self.device)
@@ -332,7 +365,7 @@ class NetTrainer:
             # forward and backward
             preds = None
             with torch.set_grad_enabled('train' in phase):
-                preds = self.model(inps)
+                preds = self.model(inps, attention_mask=attention_mask) if attention_mask is not None else self.model(inps)
                 if self.loss:
                     if self.problem_type == ProblemType.CLASSIFICATION:
                         loss_value = self.loss(preds.reshape(-1, len(self.c_names)), labs.flatten())
@@ -348,7 +381,7 @@ class NetTrainer:
 
             # statistics
             if has_labels and self.loss:
-                running_loss += loss_value.item() * dataloader.batch_size
+                running_loss += loss_value.item() * len(preds)
             
             if isinstance(labs, list):
                 labs = [d.cpu().numpy() for d in labs]
@@ -404,6 +437,7 @@ class NetTrainer:
         # Iterate over data.
         for idx, data in enumerate(tqdm(dataloader, disable=not verbose)):
             inps, labs, s_info = data
+            inps, attention_mask = self.split_attention_mask(inps)
             if isinstance(inps, list):
                 inps = [d.to(self.device) for d in inps]
             else:
@@ -417,7 +451,7 @@ class NetTrainer:
             # forward and backward
             preds = None
             with torch.set_grad_enabled('train' in phase):
-                preds, feats = self.model.get_features(inps)
+                preds, feats = self.model.get_features(inps, attention_mask=attention_mask) if attention_mask is not None else self.model.get_features(inps)
             
             if isinstance(labs, list):
                 labs = [d.cpu().numpy() for d in labs]
@@ -13,6 +13,7 @@ from tensorboardX import SummaryWriter
 from audio.utils.accuracy_utils import conf_matrix
 from audio.visualization.visualize import plot_conf_matrix
 from audio.utils.common_utils import create_logger
+from audio.models.frozen_prefix_cache import FrozenPrefixCache
 
 
 class ProblemType(Enum):
@@ -50,6 +51,10 @@ class VAENetTrainer:
                                                     Defaults to None.
             source_code (str, optional): Source code and configuration for logging. Defaults to None.
             c_names_to_display (list[str], optional): Class names to visualize confuson matrix. Defaults to None.
+            frozen_prefix_cache_root (str, optional): Root dir for hidden states of frozen part of wav2vec2. 
+                                                      Enables frozen prefix cache mode if the value is set: 
+                                                      frozen part of wav2vec2 is computed once per window, and only the unfrozen tail is trained. 
+                                                      Defaults to None.
         """
     def __init__(self, 
                  log_root: str, 
@@ -60,7 +65,8 @@ class VAENetTrainer:
                  regression_metrics: list[callable] = [], 
                  group_predicts_fn: callable = None, 
                  source_code: str = None, 
-                 c_names_to_display: list[str] = None) -> None:
+                 c_names_to_display: list[str] = None,
+                 frozen_prefix_cache_root: str = None) -> None:
         self.device = device
 
         self.model = None
@@ -83,6 +89,7 @@ class VAENetTrainer:
                 f.write(source_code)
 
         self.group_predicts_fn = group_predicts_fn
+        self.frozen_prefix_cache = FrozenPrefixCache(frozen_prefix_cache_root) if frozen_prefix_cache_root else None
 
         self.logging_paths = None
         self.logger = None
@@ -155,6 +162,9 @@ class VAENetTrainer:
         self.scheduler = scheduler
         
         self.create_loggers(fold_num)
+        if self.frozen_prefix_cache:
+            self.frozen_prefix_cache.attach(model)
+
         d_global_stats = []
         
         summary = {}
@@ -241,6 +251,9 @@ class VAENetTrainer:
 
         for phase in phases:
             summary[phase].close()
+        
+        if self.frozen_prefix_cache:
+            self.frozen_prefix_cache.detach(model)
             
         return self.model, max_perf
 
@@ -323,6 +336,21 @@ class VAENetTrainer:
                                  title='Confusion Matrix. {0}. UAR = {1:.3f}%'.format(phase, epoch_score * 100),
                                  save_path=os.path.join(self.logging_paths['model_path'], '{0}.svg'.format(res_name)))
     
+    def split_attention_mask(self, inps: torch.Tensor | dict) -> tuple[torch.Tensor, torch.Tensor]:
+        """Splits inputs collated with attention mask (see `Wav2Vec2Collator(max_length=...)`) on waves and mask.
+        The mask is moved to device
+
+        Args:
+            inps (torch.Tensor | dict): Inputs of batch: waves or dict with `input_values` and `attention_mask`
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Waves and attention mask (None if inputs have no mask)
+        """
+        if not isinstance(inps, dict):
+            return inps, None
+
+        return inps['input_values'], inps['attention_mask'].to(self.device)
+
     def iterate_model(self, 
                       phase: str, 
                       dataloader: torch.utils.data.dataloader.DataLoader, 
@@ -364,7 +392,12 @@ class VAENetTrainer:
         # Iterate over data.
         for idx, data in enumerate(tqdm(dataloader, disable=not verbose)):
             inps, labs, s_info = data
-            if isinstance(inps, list):
+            inps, attention_mask = self.split_attention_mask(inps)
+            if self.frozen_prefix_cache:
+                # hidden states of frozen prefix are cached for the whole padded windows
+                attention_mask = None
+                inps = self.frozen_prefix_cache(inps, augmented=s_info[0].get('augmented', None), device=self.device)
+            elif isinstance(inps, list):
                 inps = [d.to(self.device) for d in inps]
             else:
                 inps = inps.to(self.device)
@@ -379,7 +412,7 @@ class VAENetTrainer:
             # forward and backward
             preds = None
             with torch.set_grad_enabled('train' in phase):
-                preds = self.model(inps)
+                preds = self.model(inps, attention_mask=attention_mask) if attention_mask is not None else self.model(inps)
 
                 va_loss_v = 0 if -5 in labs[0] else self.loss[0](preds[0].reshape(-1, 2), labs[0].reshape(-1, 2)) # if va unlabeled
                 expr_loss_v = 0 if -1 in labs[1] else self.loss[1](preds[1].reshape(-1, len(self.c_names)), labs[1].flatten()) # if exp unlabeled
@@ -7,8 +7,10 @@ Author: *** # TODO
 
 import os
 import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
+import numpy as np
 import pandas as pd
 import mediapipe as mp
 from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmark, NormalizedLandmarkList
@@ -16,6 +18,16 @@ from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmark, Normali
 from tqdm import tqdm
 
 
+# Landmark indices for the outer and inner lips.
+OUTER_LIPS = [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 78]
+INNER_LIPS = [78, 95, 88, 178, 87, 14, 317, 402, 318, 324, 308, 78]
+
+# 22 triangles between the outer and inner lips with shape (22, 3)
+LIPS_TRIANGLES = np.asarray(
+    [[OUTER_LIPS[i], INNER_LIPS[i], OUTER_LIPS[i + 1]] for i in range(len(OUTER_LIPS) - 1)] +
+    [[INNER_LIPS[i + 1], INNER_LIPS[i], OUTER_LIPS[i + 1]] for i in range(len(OUTER_LIPS) - 1)])
+
+
 def calculate_triangle_area(landmark1: NormalizedLandmark, landmark2: NormalizedLandmark, landmark3: NormalizedLandmark) -> float:
     """Calculates the area of a triangle using the three dimensional coordinates of the landmarks
 
@@ -32,6 +44,36 @@ def calculate_triangle_area(landmark1: NormalizedLandmark, landmark2: Normalized
     return 0.5 * abs(a + b + c)
 
 
+def landmarks_to_array(landmarks: NormalizedLandmarkList) -> np.ndarray:
+    """Converts landmarks of MediaPipe to NumPy array once, instead of per-landmark attribute access
+
+    Args:
+        landmarks (NormalizedLandmarkList): list of landmarks
+
+    Returns:
+        np.ndarray: x and y coordinates of the landmarks with shape (num_landmarks, 2)
+    """
+    return np.asarray([(landmark.x, landmark.y) for landmark in landmarks.landmark], dtype=np.float64)
+
+
+def calculate_surface_areas(points: np.ndarray) -> np.ndarray:
+    """Calculates the surface area of mouth for one or several frames.
+    The areas of all 22 triangles are computed with one vectorized shoelace expression,
+    the same as `calculate_triangle_area`
+
+    Args:
+        points (np.ndarray): x and y coordinates of the landmarks with shape (..., num_landmarks, 2)
+
+    Returns:
+        np.ndarray: surface area of the mouth with shape (...)
+    """
+    triangles = points[..., LIPS_TRIANGLES, :] # (..., 22, 3, 2)
+    x, y = triangles[..., 0], triangles[..., 1]
+    x_next, y_next = np.roll(x, -1, axis=-1), np.roll(y, -1, axis=-1)
+    areas = 0.5 * np.abs(((x - x_next) * (y + y_next)).sum(axis=-1))
+    return areas.sum(axis=-1)
+
+
 def calculate_surface_area(landmarks: NormalizedLandmarkList) -> float:
     """Calculates the surface area of mouth using the three dimensional coordinates of the landmarks
 
@@ -41,72 +83,142 @@ def calculate_surface_area(landmarks: NormalizedLandmarkList) -> float:
     Returns:
         float: surface area of the mouth
     """
-    
-    landmarks = landmarks.landmark
-
-    OUTER_LIPS = [78, 191, 80, 81, 82, 13, 312, 311, 310, 415, 308, 78]
-
-    # Landmark indices for the inner lips.
-    INNER_LIPS = [
-        78, 95, 88, 178, 87, 14, 317, 402, 318, 324, 308, 78
-    ]
-    
-    # Calculate the surface area using the three dimensional coordinates of the landmarks.
-    surface_area = 0
-    for i in range(len(OUTER_LIPS) - 1):
-        surface_area += calculate_triangle_area(
-            landmarks[OUTER_LIPS[i]], landmarks[INNER_LIPS[i]],
-            landmarks[OUTER_LIPS[i + 1]])
-        surface_area += calculate_triangle_area(
-            landmarks[INNER_LIPS[i + 1]], landmarks[INNER_LIPS[i]],
-            landmarks[OUTER_LIPS[i + 1]])
-        
-    return surface_area
-
-
-def extract_surface_area(path_to_images: str, path_to_landmarks: str) -> None:
-    """Extract frame-by-frame mouth open features from images
+    return float(calculate_surface_areas(landmarks_to_array(landmarks)))
+
+
+def save_mouth_open_features(pd_lips: pd.DataFrame, path_to_landmarks: str, name: str) -> pd.DataFrame:
+    """Marks the frames with open mouth and saves mouth open features of one video.
+    Mouth is open if the rolling mean of the surface area over 30 frames is greater than the mean over the video
 
     Args:
-        path_to_images (str): Path to list of folder with images
+        pd_lips (pd.DataFrame): Frame-by-frame surface area of the mouth with columns ['frame', 'surface_area_mouth']
         path_to_landmarks (str): Output path
+        name (str): Name of the video (folder with images)
+
+    Returns:
+        pd.DataFrame: Mouth open features
     """
-    mp_face_mesh = mp.solutions.face_mesh
+    surface_area = pd_lips["surface_area_mouth"]
+    pd_lips["mouth_open"] = (surface_area.rolling(window=30).mean() > surface_area.mean()).astype(int)
+    os.makedirs(path_to_landmarks, exist_ok=True)
+    pd_lips.to_csv(os.path.join(path_to_landmarks, name + '.csv'), index=True)
+    return pd_lips
 
-    with mp_face_mesh.FaceMesh(
-            static_image_mode=True,
+
+def extract_folder_surface_area(path_to_images: str, path_to_landmarks: str, folder: str, tracking: bool = False) -> str:
+    """Extract frame-by-frame mouth open features from images of one video
+
+    Args:
+        path_to_images (str): Path to list of folder with images
+        path_to_landmarks (str): Output path
+        folder (str): Name of the folder with images
+        tracking (bool, optional): Track the face between frames instead of detecting it on every frame. 
+                                   FaceMesh is created for every video, so tracking is not shared between videos.
+                                   Landmarks (and mouth open features) differ from the ones of per-image detection,
+                                   so the features should not be mixed with the existing ones. Defaults to False.
+
+    Returns:
+        str: Name of the folder
+    """
+    with mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=not tracking,
             max_num_faces=1,
             refine_landmarks=True,
             min_detection_confidence=0.5) as face_mesh:
-        for folder in tqdm(os.listdir(path_to_images)):
-            pd_lips = []
-            for idx, file in enumerate(sorted(glob.glob(os.path.join(path_to_images, folder, '*.jpg')))):
-                image = cv2.imread(file)
-                file_name = os.path.basename(file).split(".")[0]
-                # Convert the BGR image to RGB before processing.
-                results = face_mesh.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-
-                # Print and draw face mesh landmarks on the image.
-                if not results.multi_face_landmarks:
-                    continue
-                face_landmarks = results.multi_face_landmarks[0]
-
-                surface_area = calculate_surface_area(face_landmarks)
-                pd_lips.append([file_name,surface_area])
-            pd_lips = pd.DataFrame(pd_lips, columns=['frame', 'surface_area_mouth'])
-
-            mask = pd_lips[pd_lips["surface_area_mouth"].rolling(window=30).mean() > pd_lips["surface_area_mouth"].mean()]
-            pd_lips["mouth_open"] = 0
-            pd_lips.loc[mask.index, "mouth_open"] = 1
-            save_path = os.path.join(path_to_landmarks)
-            if not os.path.exists(save_path):
-                os.makedirs(save_path)
-            pd_lips.to_csv(os.path.join(save_path, folder + '.csv'), index=True)
-            print('Done with folder: {}'.format(folder))
+        frames, points = [], []
+        for file in sorted(glob.glob(os.path.join(path_to_images, folder, '*.jpg'))):
+            image = cv2.imread(file)
+            # Convert the BGR image to RGB before processing.
+            results = face_mesh.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            if not results.multi_face_landmarks:
+                continue
+
+            frames.append(os.path.basename(file).split(".")[0])
+            points.append(landmarks_to_array(results.multi_face_landmarks[0]))
+
+    surface_area = calculate_surface_areas(np.stack(points)) if points else []
+    pd_lips = pd.DataFrame({'frame': frames, 'surface_area_mouth': surface_area}, columns=['frame', 'surface_area_mouth'])
+    save_mouth_open_features(pd_lips, path_to_landmarks, folder)
+    return folder
+
+
+def extract_surface_area(path_to_images: str, path_to_landmarks: str, num_workers: int = None, tracking: bool = False) -> None:
+    """Extract frame-by-frame mouth open features from images.
+    Folders (videos) are processed in parallel processes
+
+    Args:
+        path_to_images (str): Path to list of folder with images
+        path_to_landmarks (str): Output path
+        num_workers (int, optional): Number of processes. If None, number of CPU cores is used. Defaults to None.
+        tracking (bool, optional): Track the face between frames instead of detecting it on every frame. 
+                                   Faster, but the features differ from the ones of per-image detection. Defaults to False.
+    """
+    folders = sorted(os.listdir(path_to_images))
+    with ProcessPoolExecutor(max_workers=num_workers if num_workers else os.cpu_count()) as executor:
+        futures = [executor.submit(extract_folder_surface_area, path_to_images, path_to_landmarks, folder, tracking)
+                   for folder in folders]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            print('Done with folder: {}'.format(future.result()))
+
+
+class MouthAreaConsumer:
+    """Consumer of the shared video pass (see video/preprocessing/shared_video_pass.py), which extracts
+    mouth open features from face images without saving and reading them back.
+    Usually, it is attached to the face extraction consumer, so it gets the same faces, which are saved as images.
+    The output format (one csv per video) is the same as of extract_surface_area(..., tracking=False),
+    but the values are not: the consumer gets unaligned in-memory face crops of the shared video pass,
+    while the original features are extracted from the aligned face images (/data/aligned_images/).
+    Face mesh landmarks, and hence the mouth area, differ between aligned and unaligned faces,
+    so the features should not be mixed with the ones extracted from the aligned images.
+
+    Args:
+        face_mesh (mp.solutions.face_mesh.FaceMesh): MediaPipe FaceMesh model
+        path_to_landmarks (str): Output path
+    """
+
+    def __init__(self, face_mesh: mp.solutions.face_mesh.FaceMesh, path_to_landmarks: str) -> None:
+        self.face_mesh = face_mesh
+        self.path_to_landmarks = path_to_landmarks
+
+    def start(self, video_info: dict) -> None:
+        """Prepares the consumer for the new video
+
+        Args:
+            video_info (dict): Information about the video. Only video_name is used
+        """
+        self.video_name = video_info["video_name"]
+        self.frames = []
+        self.points = []
+
+    def process_batch(self, frame_nums: list, images: list) -> None:
+        """Calculates the surface area of the mouth for the batch of RGB face images
+
+        Args:
+            frame_nums (list): Numbers of frames
+            images (list): RGB face images
+        """
+        for frame_num, image in zip(frame_nums, images):
+            results = self.face_mesh.process(np.ascontiguousarray(image))
+            if not results.multi_face_landmarks:
+                continue
+            # frames are named as the saved face images
+            self.frames.append(f"{frame_num:05}")
+            self.points.append(landmarks_to_array(results.multi_face_landmarks[0]))
+
+    def finish(self) -> pd.DataFrame:
+        """Saves mouth open features of the video
+
+        Returns:
+            pd.DataFrame: Mouth open features
+        """
+        surface_area = calculate_surface_areas(np.stack(self.points)) if self.points else []
+        pd_lips = pd.DataFrame({'frame': self.frames, 'surface_area_mouth': surface_area}, columns=['frame', 'surface_area_mouth'])
+        return save_mouth_open_features(pd_lips, self.path_to_landmarks, self.video_name)
 
 
 if    __name__ == '__main__':
     path_to_images = '/data/aligned_images/'
     path_to_landmarks = '/features/open_mouth/'
-    extract_surface_area(path_to_images, path_to_landmarks)
+    # tracking=True is faster, but the features differ from the existing ones in /features/open_mouth/
+    extract_surface_area(path_to_images, path_to_landmarks, tracking=False)
 
@@ -17,6 +17,8 @@ from audio.config import config_va
 from audio.augmentation.wave_augmentation import RandomChoice, PolarityInversion, WhiteNoise, Gain
 
 from audio.data.abaw_vae_dataset import AbawVAEDataset, VAEGrouping
+from audio.data.wav2vec2_collator import Wav2Vec2Collator
+from audio.data.length_bucketing import LengthBucketBatchSampler, get_window_lengths
 
 from audio.net_trainer.net_trainer import NetTrainer, ProblemType
 
@@ -45,6 +47,9 @@ def main(config: dict) -> None:
         config (dict): Configuration dictionary
     """
     audio_root = config['FILTERED_WAV_ROOT'] if config['FILTERED'] else config['WAV_ROOT']
+    waveform_cache_root = config.get('WAVEFORM_CACHE_ROOT', None)
+    frozen_prefix_cache_root = config.get('FROZEN_PREFIX_CACHE_ROOT', None)
+    length_bucketing = config.get('LENGTH_BUCKETING', False)
     video_root = config['VIDEO_ROOT']
     labels_root = config['LABELS_ROOT']
     features_root = config['FEATURES_ROOT']
@@ -103,7 +108,9 @@ def main(config: dict) -> None:
                     va_frames_grouping=VAEGrouping.F2F,
                     expr_frames_grouping=None,
                     multitask=False,
-                    shift=2, min_w_len=2, max_w_len=4, processor_name=model_name,
+                    shift=2, min_w_len=2, max_w_len=4,
+                    waveform_cache_root=waveform_cache_root,
+                    pad_waves=not length_bucketing,
                     transform=t) for t in all_transforms[ds]
                 ]
             )
@@ -119,7 +126,9 @@ def main(config: dict) -> None:
                     va_frames_grouping=VAEGrouping.F2F,
                     expr_frames_grouping=None,
                     multitask=False,
-                    shift=2, min_w_len=2, max_w_len=4, processor_name=model_name,
+                    shift=2, min_w_len=2, max_w_len=4,
+                    waveform_cache_root=waveform_cache_root,
+                    pad_waves=not length_bucketing,
                     transform=all_transforms[ds],
                 )
 
@@ -138,15 +147,29 @@ def main(config: dict) -> None:
                              device=device,
                              c_names=None,
                              group_predicts_fn=None,
-                             source_code=source_code)
+                             source_code=source_code,
+                             frozen_prefix_cache_root=frozen_prefix_cache_root)
         
+    # with length bucketing windows are padded in batch and wav2vec2 gets attention mask
+    collate_fn = Wav2Vec2Collator(processor_name=model_name, max_length=4 * 16000 if length_bucketing else None)
     dataloaders = {}
     for ds in ds_names:
+        if length_bucketing:
+            dataloaders[ds] = torch.utils.data.DataLoader(
+                datasets[ds],
+                batch_sampler=LengthBucketBatchSampler(get_window_lengths(datasets[ds]), 
+                                                       batch_size=batch_size, 
+                                                       shuffle=('train' in ds)),
+                num_workers=batch_size if batch_size < 9 else 8,
+                collate_fn=collate_fn)
+            continue
+
         dataloaders[ds] = torch.utils.data.DataLoader(
             datasets[ds],
             batch_size=batch_size,
             shuffle=('train' in ds),
-            num_workers=batch_size if batch_size < 9 else 8)
+            num_workers=batch_size if batch_size < 9 else 8,
+            collate_fn=collate_fn)
     
 
     model = model_cls.from_pretrained(model_name)
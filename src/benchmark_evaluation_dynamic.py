@@ -0,0 +1,107 @@
+"""
+Benchmark of the functions of evaluation_dynamic.py. Compares the current implementations of
+__average_predictions_on_timesteps, __interpolate_to_100_fps and __apply_hamming_smoothing with the previous ones
+(search of every unique timestep with np.where, resampling with pandas and np.convolve of every channel) and checks
+that they return the same result.
+
+The predictions are generated as for the evaluation on the full fps: the video is cut on windows with 50% overlap
+and every window gets its own predictions for all its timesteps.
+
+Usage: python benchmark_evaluation_dynamic.py [video_length_in_minutes] [fps]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from evaluation_dynamic import __average_predictions_on_timesteps as average_predictions_on_timesteps
+from evaluation_dynamic import __interpolate_to_100_fps as interpolate_to_100_fps
+from evaluation_dynamic import __apply_hamming_smoothing as apply_hamming_smoothing
+
+
+def average_predictions_on_timesteps_reference(timesteps_with_predictions):
+    """ Previous implementation of __average_predictions_on_timesteps. """
+    num_labels = timesteps_with_predictions[0][1].shape[-1]
+    all_timesteps = np.concatenate([timesteps for timesteps, _ in timesteps_with_predictions]).reshape((-1,))
+    all_predictions = np.concatenate([predictions for _, predictions in timesteps_with_predictions],
+                                     axis=0).reshape((-1, num_labels))
+    unique_timesteps = np.unique(all_timesteps)
+    averaged_predictions = np.zeros((len(unique_timesteps), num_labels))
+    for i, timestep in enumerate(unique_timesteps):
+        indices = np.where(all_timesteps == timestep)
+        averaged_predictions[i] = all_predictions[indices].mean(axis=0)
+    return unique_timesteps, averaged_predictions
+
+
+def interpolate_to_100_fps_reference(predictions, predictions_timesteps):
+    """ Previous implementation of __interpolate_to_100_fps. """
+    if predictions_timesteps[0] != 0.0:
+        predictions_timesteps = np.concatenate([[0.0], predictions_timesteps])
+        predictions = np.concatenate([np.expand_dims(predictions[0].copy(), axis=0), predictions], axis=0)
+    predictions_df = pd.DataFrame(predictions, columns=[f'pred_{i}' for i in range(predictions.shape[-1])])
+    predictions_df['timestep'] = predictions_timesteps
+    predictions_df["milliseconds"] = predictions_df["timestep"] * 1000
+    predictions_df = predictions_df.set_index('milliseconds')
+    predictions_df.index = pd.to_timedelta(predictions_df.index, unit='ms')
+    predictions_df = predictions_df.resample('10ms').asfreq()
+    predictions_df = predictions_df.interpolate(method='linear')
+    predictions_df.reset_index(inplace=True)
+    predictions_df['timestep'] = predictions_df['milliseconds'].dt.total_seconds().apply("float64")
+    predictions = predictions_df[[f'pred_{i}' for i in range(predictions.shape[-1])]].values
+    predictions_timesteps = np.round(predictions_df['timestep'].values, 2)
+    return predictions, predictions_timesteps
+
+
+def apply_hamming_smoothing_reference(array, smoothing_window_size):
+    """ Previous implementation of __apply_hamming_smoothing (works in-place). """
+    for i in range(array.shape[-1]):
+        array[:, i] = np.convolve(array[:, i], np.hamming(smoothing_window_size)/np.hamming(smoothing_window_size).sum(), mode='same')
+    return array
+
+
+def generate_predictions(length_minutes=30, fps=30, window_size=60, batch_size=32, num_labels=8, seed=0):
+    """ Generates batches of (timesteps, predictions) for the windows with 50% overlap. """
+    rng = np.random.default_rng(seed)
+    timesteps = np.round(np.arange(int(length_minutes * 60 * fps)) / fps, 2)
+    starts = np.arange(0, len(timesteps) - window_size, window_size // 2)
+    starts[-1] = len(timesteps) - window_size
+    windows = timesteps[starts[:, np.newaxis] + np.arange(window_size)]
+    return [(windows[i:i + batch_size], rng.normal(size=(len(windows[i:i + batch_size]), window_size, num_labels)))
+            for i in range(0, len(windows), batch_size)]
+
+
+def run(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    length_minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    fps = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    predictions = generate_predictions(length_minutes, fps)
+    num_predictions = sum(timesteps.size for timesteps, _ in predictions)
+    print('video: {0} min at {1} fps, predictions: {2}'.format(length_minutes, fps, num_predictions))
+    print('averaging of predictions')
+
+    ref_time, (ref_timesteps, ref_values) = run(average_predictions_on_timesteps_reference, predictions)
+    new_time, (new_timesteps, new_values) = run(average_predictions_on_timesteps, predictions)
+    same = np.array_equal(ref_timesteps, new_timesteps) and np.allclose(ref_values, new_values)
+    print('{0:>10}: {1:.4f} s'.format('reference', ref_time))
+    print('{0:>10}: {1:.4f} s, x{2:.1f}, same result: {3}'.format('bincount', new_time, ref_time / new_time, same))
+
+    ref_time, (ref_values, ref_timesteps) = run(interpolate_to_100_fps_reference, new_values, new_timesteps)
+    new_time, (new_values, new_timesteps) = run(interpolate_to_100_fps, new_values, new_timesteps)
+    same = np.array_equal(ref_timesteps, new_timesteps) and np.allclose(ref_values, new_values, equal_nan=True)
+    print('interpolation to 100 fps')
+    print('{0:>10}: {1:.4f} s'.format('pandas', ref_time))
+    print('{0:>10}: {1:.4f} s, x{2:.1f}, same result: {3}'.format('np.interp', new_time, ref_time / new_time, same))
+
+    for smoothing_window_size in (fps // 2, 64):
+        ref_time, ref_values = run(apply_hamming_smoothing_reference, new_values.copy(), smoothing_window_size)
+        new_time, smoothed_values = run(apply_hamming_smoothing, new_values, smoothing_window_size)
+        same = np.allclose(ref_values, smoothed_values)
+        print('hamming smoothing, window size {0}'.format(smoothing_window_size))
+        print('{0:>10}: {1:.4f} s'.format('np.convolve', ref_time))
+        print('{0:>10}: {1:.4f} s, x{2:.1f}, same result: {3}'.format('cached', new_time, ref_time / new_time, same))
@@ -1,10 +1,16 @@
-from typing import Tuple, List, Dict, Union
+from typing import Tuple, List, Dict, Union, Optional
 
 import numpy as np
 import pandas as pd
 from scipy.special import softmax
 from sklearn.metrics import f1_score
 
+try:
+    from src.hamming_smoothing import apply_hamming_smoothing
+except ImportError:
+    # the module is imported as evaluation_dynamic (the src directory is in the path)
+    from hamming_smoothing import apply_hamming_smoothing
+
 
 def __interpolate_to_100_fps(predictions:np.ndarray, predictions_timesteps:np.ndarray)->\
         Tuple[np.ndarray, np.ndarray]:
@@ -25,70 +31,173 @@ def __interpolate_to_100_fps(predictions:np.ndarray, predictions_timesteps:np.nd
     if predictions_timesteps[0] != 0.0:
         predictions_timesteps = np.concatenate([[0.0], predictions_timesteps])
         predictions = np.concatenate([np.expand_dims(predictions[0].copy(), axis=0), predictions], axis=0)
-    # create dataframe with predictions
-    predictions_df = pd.DataFrame(predictions, columns=[f'pred_{i}' for i in range(predictions.shape[-1])])
-    predictions_df['timestep'] = predictions_timesteps
-    predictions_df["milliseconds"] = predictions_df["timestep"] * 1000
-    # set timestep as index
-    predictions_df = predictions_df.set_index('milliseconds')
-    # convert index to TimeDeltaIndex
-    predictions_df.index = pd.to_timedelta(predictions_df.index, unit='ms')
-    # Resample the DataFrame to 100 FPS (0.01 seconds interval)
-    predictions_df = predictions_df.resample('10ms').asfreq()
-
-    # Interpolate the missing values
-    predictions_df = predictions_df.interpolate(method='linear')
-
-    # Reset the index to get the timesteps back as a column
-    predictions_df.reset_index(inplace=True)
-    predictions_df['timestep'] = predictions_df['milliseconds'].dt.total_seconds().apply("float64")
-
-    # Get the predictions and timesteps
-    predictions = predictions_df[[f'pred_{i}' for i in range(predictions.shape[-1])]].values
-    predictions_timesteps = predictions_df['timestep'].values
+    # convert timesteps to nanoseconds and find the ones, which lie on the grid of 100 FPS (0.01 seconds interval).
+    # Only they are used for the interpolation
+    nanoseconds = np.round(np.asarray(predictions_timesteps, dtype=np.float64) * 1e9).astype(np.int64)
+    on_grid = nanoseconds % 10_000_000 == 0
+    # integer grid of centiseconds from the first to the last timestep
+    keys = nanoseconds // 10_000_000
+    grid = np.arange(keys[0], keys[-1] + 1)
+    # interpolate every channel linearly. After the last known value, the values are filled with it;
+    # NaNs are skipped
+    predictions = np.asarray(predictions, dtype=np.float64)
+    interpolated_predictions = np.full((len(grid), predictions.shape[-1]), np.nan, dtype=np.float64)
+    for i in range(predictions.shape[-1]):
+        mask = on_grid & ~np.isnan(predictions[:, i])
+        if mask.any():
+            interpolated_predictions[:, i] = np.interp(grid, keys[mask], predictions[mask, i], left=np.nan)
 
     # round timestep to 2 decimal places
-    predictions_timesteps = np.round(predictions_timesteps, 2)
-    return predictions, predictions_timesteps
+    predictions_timesteps = np.round(grid / 100., 2)
+    return interpolated_predictions, predictions_timesteps
+
+
+
+def get_interpolation_to_100_fps_indices(predictions_timesteps:np.ndarray)->\
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Precomputes the linear interpolation of __interpolate_to_100_fps, which depends only on the timesteps.
+    The interpolated predictions can be then calculated for any predictions (without NaNs) with these timesteps as
+        (predictions[upper] - predictions[lower]) / distance * offset + predictions[lower]
+    which gives the same values as np.interp.
+
+    :param predictions_timesteps: np.ndarray
+        The timesteps of the predictions with the shape (N,).
+    :return: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        The timesteps after the interpolation (N',), indices of the lower and upper predictions (N',),
+        offsets from the lower timestep and distances between the lower and upper timesteps in centiseconds (N',)
+    """
+    indices = np.arange(len(predictions_timesteps))
+    # the same as in __interpolate_to_100_fps: the first prediction is duplicated for the timestep 0.0
+    if predictions_timesteps[0] != 0.0:
+        predictions_timesteps = np.concatenate([[0.0], predictions_timesteps])
+        indices = np.concatenate([[0], indices])
+    nanoseconds = np.round(np.asarray(predictions_timesteps, dtype=np.float64) * 1e9).astype(np.int64)
+    on_grid = nanoseconds % 10_000_000 == 0
+    keys = nanoseconds // 10_000_000
+    grid = np.arange(keys[0], keys[-1] + 1)
+    known_keys, known_indices = keys[on_grid], indices[on_grid]
+    positions = np.clip(np.searchsorted(known_keys, grid, side='right') - 1, 0, len(known_keys) - 1)
+    next_positions = np.minimum(positions + 1, len(known_keys) - 1)
+    offsets = (grid - known_keys[positions]).astype(np.float64)
+    distances = (known_keys[next_positions] - known_keys[positions]).astype(np.float64)
+    # after the last known value, the value is held
+    last = positions == next_positions
+    offsets[last], distances[last] = 0., 1.
+    # before the first known value, there are NaNs
+    offsets[grid < known_keys[0]] = np.nan
+    return np.round(grid / 100., 2), known_indices[positions], known_indices[next_positions], offsets, distances
 
 
 
 def __average_predictions_on_timesteps(timesteps_with_predictions:List[Tuple[np.ndarray, np.ndarray]])->Tuple[np.ndarray, np.ndarray]:
     """ Averages the predictions on the same timesteps. timestamps_with_predictions is a list of tuples
-    (timesteps, predictions) where timesteps is an array with timesteps and predictions is an array with model predictions
+    (timesteps, predictions) where timesteps is an array with timesteps and predictions is an array with model predictions.
+    Timesteps are compared with the precision of 0.01 seconds (they are converted to integer centiseconds),
+    the predictions are summed up for every timestep with np.bincount, which takes O(N log N) instead of
+    O(num_timesteps x N) of searching every timestep separately.
 
     :param timesteps_with_predictions: List[Tuple[np.ndarray, np.ndarray]]
         List of tuples with timesteps and predictions.
     :return: Tuple[np.ndarray, np.ndarray]
-        Tuple with timesteps and averaged predictions
+        Tuple with sorted timesteps (rounded to 2 decimal places) and averaged predictions
     """
     # get all timesteps
     num_labels = timesteps_with_predictions[0][1].shape[-1]
     all_timesteps = np.concatenate([timesteps for timesteps, _ in timesteps_with_predictions]).reshape((-1,))
     all_predictions = np.concatenate([predictions for _, predictions in timesteps_with_predictions],
                                      axis=0).reshape((-1,num_labels))
-    # get unique timesteps
-    unique_timesteps = np.unique(all_timesteps)
-    # sort
-    unique_timesteps.sort()
-    # create array to store the averaged predictions
-    averaged_predictions = np.zeros((len(unique_timesteps), num_labels))
-    # go over unique timesteps and average the predictions
-    for i, timestep in enumerate(unique_timesteps):
-        # find indices of the current timestep in the all_timesteps
-        indices = np.where(all_timesteps == timestep)
-        # take the mean of predictions for the current timestep
-        predictions = all_predictions[indices]
-        averaged_predictions[i] = predictions.mean(axis=0)
+    # quantise timesteps to centiseconds and get the index of the unique (sorted) timestep for every prediction
+    keys = np.round(all_timesteps * 100).astype(np.int64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape((-1,))
+    # sum up the predictions of every timestep and divide by the number of predictions
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    averaged_predictions = np.stack([np.bincount(inverse, weights=all_predictions[:, i], minlength=len(unique_keys))
+                                     for i in range(num_labels)], axis=1) / counts[:, np.newaxis]
+    unique_timesteps = unique_keys / 100.
     return unique_timesteps, averaged_predictions
 
 
 
+def timesteps_to_centiseconds(timesteps:np.ndarray)->np.ndarray:
+    """ Converts timesteps in seconds to integer centiseconds. All timesteps in the pipeline are given with
+    the precision of 0.01 seconds (frame_num / fps rounded to 2 decimal places, the 100 FPS grid of the interpolation),
+    so the integer keys identify the same frame in predictions and labels without comparison of floats.
+
+    :param timesteps: np.ndarray
+        Timesteps in seconds. Shape: (num_timesteps,)
+    :return: np.ndarray
+        Timesteps in centiseconds (int64). Shape: (num_timesteps,)
+    """
+    return np.round(np.asarray(timesteps, dtype=np.float64) * 100).astype(np.int64)
+
+
+class TimestepAlignment:
+    """ Gather indices, which align the predictions with the ground truth on the integer (centisecond) timeline.
+    The indices are cached for every video: during the evaluation after every epoch, the timesteps of the
+    predictions (the 100 FPS grid) and the labels do not change, so the alignment is calculated only once and
+    the same frames are compared every epoch. The cached indices are used only if the timesteps are the same.
+    """
+    def __init__(self):
+        self.cache = {}
+
+    @staticmethod
+    def calculate_indices(predictions_keys:np.ndarray, ground_truth_keys:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+        """ Finds the predictions and the ground truth with the same timesteps. If the ground truth has duplicated
+        timesteps, the first one is taken. The predictions timesteps are expected to be sorted and unique.
+
+        :param predictions_keys: np.ndarray
+            Timesteps of the predictions in centiseconds. Shape: (num_timesteps1,)
+        :param ground_truth_keys: np.ndarray
+            Timesteps of the ground truth in centiseconds. Shape: (num_timesteps2,)
+        :return: Tuple[np.ndarray, np.ndarray]
+            Indices of the predictions and indices of the ground truth (both of the same length)
+        """
+        unique_keys, first_indices = np.unique(ground_truth_keys, return_index=True)
+        if len(unique_keys) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(unique_keys, predictions_keys), len(unique_keys) - 1)
+        matched = unique_keys[positions] == predictions_keys
+        return np.flatnonzero(matched), first_indices[positions[matched]]
+
+    def get_indices(self, predictions_timesteps:np.ndarray, ground_truth_timesteps:np.ndarray,
+                    video_name:Optional[str]=None)->Tuple[np.ndarray, np.ndarray]:
+        """ Returns the gather indices of the predictions and the ground truth. If video_name is given,
+        the indices are cached for this video.
+
+        :param predictions_timesteps: np.ndarray
+            The timesteps of the predictions in seconds. Shape: (num_timesteps1,)
+        :param ground_truth_timesteps: np.ndarray
+            The timesteps of the ground truth in seconds. Shape: (num_timesteps2,)
+        :param video_name: Optional[str]
+            The name of the video, which is used as the key of the cache.
+        :return: Tuple[np.ndarray, np.ndarray]
+            Indices of the predictions and indices of the ground truth
+        """
+        predictions_keys = timesteps_to_centiseconds(predictions_timesteps)
+        ground_truth_keys = timesteps_to_centiseconds(ground_truth_timesteps)
+        if video_name is not None and video_name in self.cache:
+            cached_predictions_keys, cached_ground_truth_keys, indices = self.cache[video_name]
+            if np.array_equal(cached_predictions_keys, predictions_keys) and \
+                    np.array_equal(cached_ground_truth_keys, ground_truth_keys):
+                return indices
+        indices = self.calculate_indices(predictions_keys, ground_truth_keys)
+        if video_name is not None:
+            self.cache[video_name] = (predictions_keys, ground_truth_keys, indices)
+        return indices
+
+
+# alignment shared by the evaluation, fusion and submission scripts
+timestep_alignment = TimestepAlignment()
+
+
 def __synchronize_predictions_with_ground_truth(predictions:np.ndarray, predictions_timesteps:np.ndarray,
-                                                ground_truth:np.ndarray, ground_truth_timesteps:np.ndarray)->\
+                                                ground_truth:np.ndarray, ground_truth_timesteps:np.ndarray,
+                                                video_name:Optional[str]=None)->\
         Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """ Synchronizes the predictions with ground truth. It means that we take only the predictions
-    that have the same timesteps as the ground truth.
+    that have the same timesteps as the ground truth. The timesteps are compared as integer centiseconds
+    (see TimestepAlignment).
 
 
     :param predictions: np.ndarray
@@ -99,19 +208,14 @@ def __synchronize_predictions_with_ground_truth(predictions:np.ndarray, predicti
         The ground truth with the shape (num_timesteps2, num_classes or num_regressions)
     :param ground_truth_timesteps: np.ndarray
         The timesteps of the ground truth. Shape: (num_timesteps2,)
+    :param video_name: Optional[str]
+        The name of the video. If given, the alignment is cached and reused in the next calls for this video.
     :return: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
         Tuple with synchronized predictions and ground truth. The first two elements are the synchronized predictions
         and timesteps, the last two elements are the synchronized ground truth and timesteps.
     """
-    # delete duplicates in the ground truth timesteps and corresponding ground truth
-    ground_truth_timesteps, indices = np.unique(ground_truth_timesteps, return_index=True)
-    ground_truth = ground_truth[indices]
-    # find common timesteps
-    common_timesteps = np.intersect1d(ground_truth_timesteps, predictions_timesteps)
-    # find indices of the common timesteps in the predictions and ground truth
-    predictions_indices = np.where(np.isin(predictions_timesteps, common_timesteps))[0]
-    ground_truth_indices = np.where(np.isin(ground_truth_timesteps, common_timesteps))[0]
-    # at this point, the number of common timesteps in the predictions and ground truth should be the same
+    predictions_indices, ground_truth_indices = timestep_alignment.get_indices(predictions_timesteps,
+                                                                               ground_truth_timesteps, video_name)
     new_predictions = predictions[predictions_indices]
     new_predictions_timesteps = predictions_timesteps[predictions_indices]
     new_ground_truth = ground_truth[ground_truth_indices]
@@ -123,6 +227,7 @@ def __synchronize_predictions_with_ground_truth(predictions:np.ndarray, predicti
 
 def __apply_hamming_smoothing(array:np.ndarray, smoothing_window_size:int)->np.ndarray:
     """ Smooths the data by applying the Hamming window to every channel of the array.
+    All channels are smoothed at once with the cached window (see hamming_smoothing.apply_hamming_smoothing).
 
     :param array: np.ndarray
         Array with data. Shape: (num_timesteps, num_classes)
@@ -131,10 +236,7 @@ def __apply_hamming_smoothing(array:np.ndarray, smoothing_window_size:int)->np.n
     :return: np.ndarray
         Smoothed array. Shape: (num_timesteps, num_classes)
     """
-    # uses numpy.hamming function. Remember to apply the mean to every element as the window is not normalized
-    for i in range(array.shape[-1]):
-        array[:, i] = np.convolve(array[:, i], np.hamming(smoothing_window_size)/np.hamming(smoothing_window_size).sum(), mode='same')
-    return array
+    return apply_hamming_smoothing(array, smoothing_window_size)
 
 
 def np_concordance_correlation_coefficient(y_true, y_pred):
@@ -183,6 +285,34 @@ def np_concordance_correlation_coefficient(y_true, y_pred):
 
 
 
+def calculate_metric_on_dev_set(predictions:np.ndarray, labels:np.ndarray,
+                                labels_type:str)->Union[float, Tuple[float, float]]:
+    """ Calculates the metric on the synchronized and smoothed predictions of all videos.
+
+    :param predictions: np.ndarray
+        The predictions. Shape: (num_timesteps, num_classes or 2)
+    :param labels: np.ndarray
+        The labels. Shape: (num_timesteps, num_classes or 2)
+    :param labels_type: str
+        The type of the labels. Either "Exp" or "VA".
+    :return: float
+        Either F1 score or CCC score.
+    """
+    if labels_type == 'Exp':
+        # fpr Exp challenge, the softmax and argmax firstly needed
+        predictions = np.argmax(softmax(predictions, axis=-1), axis=-1)
+        labels = np.argmax(labels, axis=-1)
+        return f1_score(labels, predictions, average='macro')
+    elif labels_type == 'VA':
+        valence = np_concordance_correlation_coefficient(labels[:, 0], predictions[:, 0])
+        arousal = np_concordance_correlation_coefficient(labels[:, 1], predictions[:, 1])
+        # if valence or arousal is nan, than set it to 0.0
+        if np.isnan(valence): valence = 0.0
+        if np.isnan(arousal): arousal = 0.0
+        return (valence, arousal)
+
+
+
 def evaluate_predictions_on_dev_set_full_fps(predictions:Dict[str, pd.DataFrame], labels:Dict[str, pd.DataFrame],
                                              labels_type:str)->Union[float, Tuple[float, float]]:
     """ Evaluates the predictions on the development set. THe predictions and labels should be passed as the
@@ -220,32 +350,14 @@ def evaluate_predictions_on_dev_set_full_fps(predictions:Dict[str, pd.DataFrame]
         predictions_values, predictions_timesteps = __interpolate_to_100_fps(predictions_values, predictions_timesteps)
         # synchronize predictions with ground truth
         predictions_values, predictions_timesteps, ground_truth_values, ground_truth_timesteps = \
-            __synchronize_predictions_with_ground_truth(predictions_values, predictions_timesteps, ground_truth_values, ground_truth_timesteps)
+            __synchronize_predictions_with_ground_truth(predictions_values, predictions_timesteps, ground_truth_values,
+                                                        ground_truth_timesteps, video_name=video_name)
         # Apply hamming smoothing
         predictions_values = __apply_hamming_smoothing(predictions_values, smoothing_window_size=fps//2)
-        # fpr Exp challenge, the softmax and argmax firstly needed
-        if labels_type == 'Exp':
-            predictions_values = softmax(predictions_values, axis=-1)
-            predictions_values = np.argmax(predictions_values, axis=-1)
-            ground_truth_values = np.argmax(ground_truth_values, axis=-1)
         # append to the full big array
-        full_array_predictions.append(predictions_values.reshape((predictions_values.shape[0], -1)))
-        full_array_labels.append(ground_truth_values.reshape((ground_truth_values.shape[0], -1)))
+        full_array_predictions.append(predictions_values)
+        full_array_labels.append(ground_truth_values)
     # calculate the metric
     full_array_predictions = np.concatenate(full_array_predictions, axis=0)
     full_array_labels = np.concatenate(full_array_labels, axis=0)
-    if labels_type == 'Exp':
-        full_array_predictions = full_array_predictions.flatten()
-        full_array_labels = full_array_labels.flatten()
-        return f1_score(full_array_labels, full_array_predictions, average='macro')
-    elif labels_type == 'VA':
-        valence = np_concordance_correlation_coefficient(full_array_labels[:, 0], full_array_predictions[:, 0])
-        arousal = np_concordance_correlation_coefficient(full_array_labels[:, 1], full_array_predictions[:, 1])
-        # if valence or arousal is nan, than set it to 0.0
-        if np.isnan(valence): valence = 0.0
-        if np.isnan(arousal): arousal = 0.0
-        return (valence, arousal)
-
-
-
-
+    return calculate_metric_on_dev_set(full_array_predictions, full_array_labels, labels_type)
@@ -5,9 +5,9 @@ import numpy as np
 import sys
 import os
 
-from evaluation_dynamic import __interpolate_to_100_fps, __synchronize_predictions_with_ground_truth, \
-    np_concordance_correlation_coefficient
+from evaluation_dynamic import __interpolate_to_100_fps, __synchronize_predictions_with_ground_truth
 from fusion.exp_submissions.weighted_fusion.submission_2.submission_2 import average_predictions_on_timesteps
+from fusion.weight_search import generate_dirichlet_weights, search_best_fusion_weights
 from video.preprocessing.labels_preprocessing import load_AffWild2_labels
 
 path_to_project = os.path.abspath(
@@ -135,25 +135,17 @@ def process_dict(predictions_dict:dict, labels_dict):
     return result_dict
 
 
-def get_best_fusion_weights(audio, video, label_values, num_generations=1000):
+def get_best_fusion_weights(audio, video, label_values, num_generations=1000, num_workers=1):
     # generate num_generations weights using Dirichlet distribution. We generate both for models and classses
-    generated_weights = np.random.dirichlet((1,1), size=(num_generations,audio.shape[-1])).transpose(0,2,1)
-    best_CCC = 0
-    best_CCC_valence = 0
-    best_CCC_arousal = 0
-    best_weights = None
-    for weights in generated_weights:
-        # calculate metrics
-        prediction = audio * weights[0][np.newaxis,...] + video * weights[1][np.newaxis,...]
-        CCC_valence = np_concordance_correlation_coefficient(label_values[:,0], prediction[:,0])
-        CCC_arousal = np_concordance_correlation_coefficient(label_values[:,1], prediction[:,1])
-        CCC = (CCC_valence + CCC_arousal) / 2
-        if CCC > best_CCC:
-            best_CCC = CCC
-            best_CCC_valence = CCC_valence
-            best_CCC_arousal = CCC_arousal
-            best_weights = weights
-    return best_weights, best_CCC, best_CCC_valence, best_CCC_arousal
+    generated_weights = generate_dirichlet_weights(num_generations, 2, audio.shape[-1])
+    # evaluate all candidates at once: CCC is calculated in closed form from the moments of the modalities
+    best_idx, scores = search_best_fusion_weights([audio, video], label_values, generated_weights,
+                                                  metric="CCC", num_workers=num_workers)
+    if best_idx < 0:
+        return None, 0, 0, 0
+    best_CCC_valence, best_CCC_arousal = scores[best_idx]
+    best_CCC = (best_CCC_valence + best_CCC_arousal) / 2
+    return generated_weights[best_idx], best_CCC, best_CCC_valence, best_CCC_arousal
 
 
 def generate_test_predictions(audio, video, weights, path_to_test_sample, output_path):
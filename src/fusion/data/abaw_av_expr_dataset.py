@@ -105,6 +105,9 @@ class AbawMultimodalExprDataset(Dataset):
         
         for fn in a_train_data.keys():
             for idx, m_o in enumerate(a_train_data[fn]['mouth_open']):
+                if a_train_data[fn]['features'][idx] is None: # window with closed mouth, skipped by audio model
+                    continue
+
                 mouth_open_w = np.split(m_o, np.arange(self.new_fps, len(m_o), self.new_fps))
                 mouth_open = np.asarray([max(set(i), key=list(i).count) for i in mouth_open_w]).T
 
@@ -290,6 +293,9 @@ class AbawMultimodalExprWithNormDataset(Dataset):
         
         for fn in a_train_data.keys():
             for idx, m_o in enumerate(a_train_data[fn]['mouth_open']):
+                if a_train_data[fn]['features'][idx] is None: # window with closed mouth, skipped by audio model
+                    continue
+
                 mouth_open_w = np.split(m_o, np.arange(self.new_fps, len(m_o), self.new_fps))
                 mouth_open = np.asarray([max(set(i), key=list(i).count) for i in mouth_open_w]).T
 
@@ -147,6 +147,9 @@ class AbawMultimodalVAWithNormDataset(Dataset):
         
         for fn in a_train_data.keys():
             for idx, mouth_open in enumerate(a_train_data[fn]['mouth_open']):
+                if a_train_data[fn]['features'][idx] is None: # window with closed mouth, skipped by audio model
+                    continue
+
                 mouth_open_index = (mouth_open == 1)
                 train_audio_features.append(a_train_data[fn]['features'][idx][mouth_open_index, :])
 
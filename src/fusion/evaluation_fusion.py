@@ -106,7 +106,8 @@ def evaluate_model_full_fps(targets, predicts:List[np.ndarray], sample_info:List
             video_labels = dev_labels[video_name][['valence', 'arousal']].values
         # synchronize predictions with labels
         current_predictions, current_timesteps, video_labels, video_labels_timesteps = \
-            __synchronize_predictions_with_ground_truth(current_predictions, current_timesteps, video_labels, video_labels_timesteps)
+            __synchronize_predictions_with_ground_truth(current_predictions, current_timesteps, video_labels, video_labels_timesteps,
+                                                        video_name=video_name)
         # apply hamming window
         current_predictions = __apply_hamming_smoothing(current_predictions, smoothing_window_size=video_to_fps[video_name]//2)
         # check if the number of predictions corresponds to the number of labels+
@@ -1,4 +1,3 @@
-import glob
 import os
 import sys
 from typing import List, Optional
@@ -25,7 +24,7 @@ from src.evaluation_dynamic import __average_predictions_on_timesteps, __interpo
     __synchronize_predictions_with_ground_truth, __apply_hamming_smoothing
 from src.video.post_processing.embeddings_extraction_dynamic import __initialize_static_feature_extractor, \
     __initialize_face_detector, __initialize_pose_detector, process_one_video_static, align_labels_with_metadata, \
-    __cut_video_on_windows, load_fps_file, __initialize_dynamic_model
+    __cut_video_on_windows, load_fps_file, __initialize_dynamic_model, load_static_features
 
 
 
@@ -108,18 +107,7 @@ def generate_test_predictions_all_videos(dynamic_model_type, path_to_weights, no
     else:
         normalizer = None
     # load metadata
-    metadata_static = glob.glob(os.path.join(path_to_extracted_features, "*.csv"))
-    metadata_static = {os.path.basename(file).split(".")[0]: pd.read_csv(file) for file in metadata_static}
-    # assign column names
-    columns = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
-               [f"pose_embedding_{i}" for i in range(256)])
-    if challenge == "Exp":
-        columns = columns + ["category"]
-    else:
-        columns = columns + ["valence", "arousal"]
-    # assign column names to every dataframe
-    for video in metadata_static.keys():
-        metadata_static[video].columns = columns
+    metadata_static = load_static_features(path_to_extracted_features, challenge)
     # fit normalizer
     # concatenate embeddings columns if tuple
     feature_columns = embeddings_columns if not isinstance(embeddings_columns, tuple) else embeddings_columns[0] + \
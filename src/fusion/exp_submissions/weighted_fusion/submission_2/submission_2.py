@@ -19,6 +19,7 @@ import numpy as np
 
 from evaluation_dynamic import __average_predictions_on_timesteps, __interpolate_to_100_fps, \
     __synchronize_predictions_with_ground_truth
+from fusion.weight_search import generate_dirichlet_weights, search_best_fusion_weights
 from video.preprocessing.labels_preprocessing import load_AffWild2_labels
 
 
@@ -40,6 +41,11 @@ def load_labels(path_to_labels: str, challenge:str, video_to_fps:dict)->pd.DataF
 
 
 def average_predictions_on_timesteps(predictions_dict:dict):
+    # windows skipped by mouth open gating have no predictions, weighted fusion needs every window
+    if any(predictions_dict.get("gated", [])) or any(p is None for p in predictions_dict["predicts"]):
+        raise ValueError("Predictions contain windows gated by mouth open detection (predicts are None). "
+                         "Weighted fusion requires predictions for every window: "
+                         "re-extract audio predictions with MOUTH_OPEN_GATING disabled.")
     num_windows = len(predictions_dict["features"])
     array_predictions = []
     for window_idx in range(num_windows):
@@ -139,20 +145,15 @@ def filter_out_predictions_with_high_entropy(audio, threshold):
 
 
 
-def get_best_fusion_weights(audio, video, label_values, num_generations=1000):
+def get_best_fusion_weights(audio, video, label_values, num_generations=1000, num_workers=1):
     # generate num_generations weights using Dirichlet distribution. We generate both for models and classses
-    generated_weights = np.random.dirichlet((1,1), size=(num_generations,audio.shape[-1])).transpose(0,2,1)
-    best_f1 = 0
-    best_weights = None
-    for weights in generated_weights:
-        # calculate f1 score
-        prediction = audio * weights[0][np.newaxis,...] + video * weights[1][np.newaxis,...]
-        prediction = np.argmax(prediction, axis=-1)
-        f1 = f1_score(label_values, prediction, average="macro")
-        if f1 > best_f1:
-            best_f1 = f1
-            best_weights = weights
-    return best_weights, best_f1
+    generated_weights = generate_dirichlet_weights(num_generations, 2, audio.shape[-1])
+    # evaluate all candidates in blocks: macro F1 is calculated from the confusion matrices of all candidates
+    best_idx, scores = search_best_fusion_weights([audio, video], label_values, generated_weights,
+                                                  metric="F1", num_workers=num_workers)
+    if best_idx < 0:
+        return None, 0
+    return generated_weights[best_idx], scores[best_idx]
 
 
 
@@ -6,10 +6,10 @@ import numpy as np
 import pandas as pd
 from scipy.special import softmax
 from scipy.stats import entropy
-from sklearn.metrics import f1_score
 
 from fusion.exp_submissions.weighted_fusion.submission_2.submission_2 import load_test_sample_file_and_preprocess, load_labels, \
     process_dict, filter_out_predictions_with_high_entropy
+from fusion.weight_search import generate_dirichlet_weights, search_best_fusion_weights
 from video.post_processing.embeddings_extraction_dynamic import load_fps_file
 
 path_to_project = os.path.abspath(
@@ -19,20 +19,15 @@ sys.path.append(path_to_project.replace("ABAW_2023_SIU", "datatools"))
 sys.path.append(path_to_project.replace("ABAW_2023_SIU", "simple-HRNet-master"))
 
 
-def get_best_fusion_weights(audio, video, statistical, label_values, num_generations=1000):
+def get_best_fusion_weights(audio, video, statistical, label_values, num_generations=1000, num_workers=1):
     # generate num_generations weights using Dirichlet distribution. We generate both for models and classses
-    generated_weights = np.random.dirichlet((1,1,1), size=(num_generations,audio.shape[-1])).transpose(0,2,1)
-    best_f1 = 0
-    best_weights = None
-    for weights in generated_weights:
-        # calculate f1 score
-        prediction = audio * weights[0][np.newaxis,...] + video * weights[1][np.newaxis,...] + statistical * weights[2][np.newaxis,...]
-        prediction = np.argmax(prediction, axis=-1)
-        f1 = f1_score(label_values, prediction, average="macro")
-        if f1 > best_f1:
-            best_f1 = f1
-            best_weights = weights
-    return best_weights, best_f1
+    generated_weights = generate_dirichlet_weights(num_generations, 3, audio.shape[-1])
+    # evaluate all candidates in blocks: macro F1 is calculated from the confusion matrices of all candidates
+    best_idx, scores = search_best_fusion_weights([audio, video, statistical], label_values, generated_weights,
+                                                  metric="F1", num_workers=num_workers)
+    if best_idx < 0:
+        return None, 0
+    return generated_weights[best_idx], scores[best_idx]
 
 
 def generate_test_predictions(audio, video, statistical, path_to_test_sample, weights, entropy_threshold,
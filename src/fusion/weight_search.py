@@ -0,0 +1,215 @@
+"""
+Batched search of the fusion weights. Every candidate is a matrix of weights (num_modalities x num_labels)
+and the fused prediction is sum_m predictions[m] * weights[m] (see get_best_fusion_weights in the submission scripts).
+Instead of fusing the predictions and calling f1_score / np_concordance_correlation_coefficient for every candidate,
+the candidates are evaluated in blocks:
+    - macro F1: the fused predictions of the block of candidates are computed at once for chunks of frames,
+      the confusion matrices of all candidates are accumulated with one np.bincount;
+    - CCC: the fused prediction is linear in the weights, so its mean, variance and covariance with the labels
+      are calculated in closed form from the means and covariance matrices of the modalities, which are computed once.
+The blocks of candidates can be split across processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+# number of float64 values of the fused predictions in memory at once (per process)
+FUSED_BUFFER_SIZE = 2 ** 18
+
+
+def generate_dirichlet_weights(num_generations:int, num_modalities:int, num_labels:int)->np.ndarray:
+    """ Generates candidates of the fusion weights using Dirichlet distribution. The weights of every label (class)
+    sum up to 1 over modalities. Uses the global numpy random state as the submission scripts.
+
+    :param num_generations: int
+        number of candidates
+    :param num_modalities: int
+        number of fused modalities
+    :param num_labels: int
+        number of classes or regression targets
+    :return: np.ndarray
+        weights with the shape (num_generations, num_modalities, num_labels)
+    """
+    return np.random.dirichlet((1,) * num_modalities, size=(num_generations, num_labels)).transpose(0, 2, 1)
+
+
+def fuse_predictions(predictions:List[np.ndarray], weights:np.ndarray)->np.ndarray:
+    """ Fuses predictions of modalities for a block of candidates.
+
+    :param predictions: List[np.ndarray]
+        predictions of every modality with the shape (num_frames, num_labels)
+    :param weights: np.ndarray
+        weights with the shape (num_candidates, num_modalities, num_labels)
+    :return: np.ndarray
+        fused predictions with the shape (num_candidates, num_frames, num_labels)
+    """
+    # summed in the order of modalities, so the result is the same as of fusing one candidate at a time
+    fused = predictions[0][np.newaxis] * weights[:, 0, np.newaxis, :]
+    for modality_idx in range(1, len(predictions)):
+        fused += predictions[modality_idx][np.newaxis] * weights[:, modality_idx, np.newaxis, :]
+    return fused
+
+
+def calculate_macro_f1_scores(predictions:List[np.ndarray], labels:np.ndarray, weights:np.ndarray)->np.ndarray:
+    """ Calculates macro F1 score of argmax of the fused predictions for every candidate. The result is the same as
+    of sklearn.metrics.f1_score(labels, prediction, average="macro"): only classes presented in the labels or
+    predictions are averaged.
+
+    :param predictions: List[np.ndarray]
+        predictions (probabilities or logits) of every modality with the shape (num_frames, num_classes)
+    :param labels: np.ndarray
+        classes with the shape (num_frames,)
+    :param weights: np.ndarray
+        weights with the shape (num_candidates, num_modalities, num_classes)
+    :return: np.ndarray
+        macro F1 scores with the shape (num_candidates,)
+    """
+    num_candidates, _, num_classes = weights.shape
+    labels = np.asarray(labels).astype(np.int64)
+    confusion = np.zeros(num_candidates * num_classes * num_classes, dtype=np.int64)
+    candidate_offsets = (np.arange(num_candidates) * num_classes * num_classes)[:, np.newaxis]
+    chunk_size = max(1, FUSED_BUFFER_SIZE // (num_candidates * num_classes))
+    for start in range(0, len(labels), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        fused = fuse_predictions([modality[chunk] for modality in predictions], weights)
+        # index of the cell (candidate, true class, predicted class) of the confusion matrix
+        cells = candidate_offsets + labels[chunk][np.newaxis] * num_classes + np.argmax(fused, axis=-1)
+        confusion += np.bincount(cells.reshape((-1,)), minlength=len(confusion))
+    confusion = confusion.reshape((num_candidates, num_classes, num_classes))
+    true_positives = np.diagonal(confusion, axis1=1, axis2=2).astype(np.float64)
+    num_true = confusion.sum(axis=2)
+    num_predicted = confusion.sum(axis=1)
+    denominator = num_true + num_predicted
+    f1_scores = np.divide(2 * true_positives, denominator, out=np.zeros_like(true_positives), where=denominator > 0)
+    present = denominator > 0
+    return (f1_scores * present).sum(axis=1) / present.sum(axis=1)
+
+
+class CCCMoments:
+    """ Moments of the predictions of the modalities and the labels, from which CCC of the fused prediction
+    is calculated for any weights. For every label, the rows with NaNs are skipped
+    (as in np_concordance_correlation_coefficient).
+
+    :param predictions: List[np.ndarray]
+        predictions of every modality with the shape (num_frames, num_labels)
+    :param labels: np.ndarray
+        labels with the shape (num_frames, num_labels)
+    """
+    def __init__(self, predictions:List[np.ndarray], labels:np.ndarray):
+        num_labels = labels.shape[-1]
+        num_modalities = len(predictions)
+        self.predictions_means = np.zeros((num_modalities, num_labels))
+        self.predictions_covariances = np.zeros((num_labels, num_modalities, num_modalities))
+        self.cross_covariances = np.zeros((num_modalities, num_labels))
+        self.labels_means = np.zeros(num_labels)
+        self.labels_variances = np.zeros(num_labels)
+        for label_idx in range(num_labels):
+            values = np.stack([modality[:, label_idx] for modality in predictions], axis=0).astype(np.float64)
+            label_values = labels[:, label_idx].astype(np.float64)
+            mask = ~np.isnan(label_values) & ~np.isnan(values).any(axis=0)
+            values, label_values = values[:, mask], label_values[mask]
+            # moments are calculated on the centered values to avoid the loss of precision
+            means = values.mean(axis=1)
+            label_mean = label_values.mean()
+            values = values - means[:, np.newaxis]
+            label_values = label_values - label_mean
+            self.predictions_means[:, label_idx] = means
+            self.predictions_covariances[label_idx] = values @ values.T / len(label_values)
+            self.cross_covariances[:, label_idx] = values @ label_values / len(label_values)
+            self.labels_means[label_idx] = label_mean
+            self.labels_variances[label_idx] = label_values @ label_values / len(label_values)
+
+    def calculate_ccc(self, weights:np.ndarray)->np.ndarray:
+        """ Calculates CCC of the fused prediction for every candidate and label.
+
+        :param weights: np.ndarray
+            weights with the shape (num_candidates, num_modalities, num_labels)
+        :return: np.ndarray
+            CCC with the shape (num_candidates, num_labels)
+        """
+        mean = np.einsum('cml,ml->cl', weights, self.predictions_means)
+        variance = np.einsum('cml,lmk,ckl->cl', weights, self.predictions_covariances, weights)
+        covariance = np.einsum('cml,ml->cl', weights, self.cross_covariances)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 2 * covariance / (self.labels_variances + variance + (self.labels_means - mean) ** 2)
+
+
+# data of the worker processes (set once by the initializer, so it is not sent with every block)
+__worker_data = {}
+
+
+def __initialize_worker(predictions:List[np.ndarray], labels:np.ndarray, metric:str)->None:
+    __worker_data['predictions'] = predictions
+    __worker_data['labels'] = labels
+    __worker_data['moments'] = CCCMoments(predictions, labels) if metric == 'CCC' else None
+
+
+def __evaluate_block(weights:np.ndarray)->np.ndarray:
+    if __worker_data['moments'] is not None:
+        return __worker_data['moments'].calculate_ccc(weights)
+    return calculate_macro_f1_scores(__worker_data['predictions'], __worker_data['labels'], weights)
+
+
+def evaluate_fusion_weights(predictions:List[np.ndarray], labels:np.ndarray, weights:np.ndarray, metric:str,
+                            block_size:Optional[int]=64, num_workers:Optional[int]=1)->np.ndarray:
+    """ Evaluates all candidates of the fusion weights.
+
+    :param predictions: List[np.ndarray]
+        predictions of every modality with the shape (num_frames, num_labels)
+    :param labels: np.ndarray
+        classes (num_frames,) for metric 'F1' or regression targets (num_frames, num_labels) for metric 'CCC'
+    :param weights: np.ndarray
+        weights with the shape (num_candidates, num_modalities, num_labels)
+    :param metric: str
+        'F1' (macro F1 of argmax) or 'CCC' (CCC of every label)
+    :param block_size: int
+        number of candidates evaluated at once
+    :param num_workers: int
+        number of processes. The blocks of candidates are split across them.
+    :return: np.ndarray
+        scores with the shape (num_candidates,) for 'F1' and (num_candidates, num_labels) for 'CCC'
+    """
+    if metric not in ('F1', 'CCC'):
+        raise ValueError("metric should be either 'F1' or 'CCC'. Got %s" % metric)
+    blocks = [weights[start:start + block_size] for start in range(0, len(weights), block_size)]
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=__initialize_worker,
+                                 initargs=(predictions, labels, metric)) as executor:
+            scores = list(executor.map(__evaluate_block, blocks))
+    else:
+        __initialize_worker(predictions, labels, metric)
+        scores = [__evaluate_block(block) for block in blocks]
+        __worker_data.clear()
+    return np.concatenate(scores, axis=0)
+
+
+def search_best_fusion_weights(predictions:List[np.ndarray], labels:np.ndarray, weights:np.ndarray, metric:str,
+                               block_size:Optional[int]=64, num_workers:Optional[int]=1)->Tuple[int, np.ndarray]:
+    """ Finds the best candidate of the fusion weights. For 'CCC', the mean CCC over labels is maximized.
+    If several candidates have the same score, the first one is taken. Candidates with NaN scores are ignored.
+
+    :param predictions: List[np.ndarray]
+        predictions of every modality with the shape (num_frames, num_labels)
+    :param labels: np.ndarray
+        classes (num_frames,) for metric 'F1' or regression targets (num_frames, num_labels) for metric 'CCC'
+    :param weights: np.ndarray
+        weights with the shape (num_candidates, num_modalities, num_labels)
+    :param metric: str
+        'F1' or 'CCC'
+    :param block_size: int
+        number of candidates evaluated at once
+    :param num_workers: int
+        number of processes
+    :return: Tuple[int, np.ndarray]
+        index of the best candidate (-1 if no candidate has a score above 0) and scores of all candidates
+    """
+    scores = evaluate_fusion_weights(predictions, labels, weights, metric, block_size, num_workers)
+    total_scores = scores.mean(axis=1) if metric == 'CCC' else scores
+    total_scores = np.where(np.isnan(total_scores), -np.inf, total_scores)
+    best_idx = int(np.argmax(total_scores))
+    # the submission scripts start from the score 0 and take only better candidates
+    if total_scores[best_idx] <= 0:
+        best_idx = -1
+    return best_idx, scores
@@ -0,0 +1,107 @@
+"""
+Smoothing of the predictions with the normalized Hamming window. The windows are cached per size and applied
+to all channels at once along the time axis: short windows (the usual fps // 2) with one direct convolution
+(scipy.ndimage.convolve1d), long windows with the overlap-add FFT convolution (scipy.signal.oaconvolve),
+which is faster than the direct one starting from ~32 taps.
+
+StreamingHammingSmoother gives the same result for the predictions arriving in chunks (online inference).
+"""
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+from scipy.ndimage import convolve1d
+from scipy.signal import lfilter, oaconvolve
+
+
+# windows of this size and longer are applied with the FFT convolution
+FFT_MIN_WINDOW_SIZE = 32
+
+
+@lru_cache(maxsize=None)
+def get_hamming_window(window_size:int)->np.ndarray:
+    """ Returns the Hamming window normalized to the sum of 1. The window is cached and read-only.
+
+    :param window_size: int
+        Size of the window
+    :return: np.ndarray
+        Normalized window. Shape: (window_size,)
+    """
+    window = np.hamming(window_size)
+    window = window / window.sum()
+    window.setflags(write=False)
+    return window
+
+
+def apply_hamming_smoothing(array:np.ndarray, smoothing_window_size:int)->np.ndarray:
+    """ Smooths the data by applying the Hamming window to every channel of the array. The output is aligned
+    with the input as np.convolve(..., mode='same'). The input array is not modified.
+
+    :param array: np.ndarray
+        Array with data. Shape: (num_timesteps, num_classes) or (num_timesteps,)
+    :param smoothing_window_size: int
+        Size of the smoothing window
+    :return: np.ndarray
+        Smoothed array. Shape: the same as of the input array
+    """
+    array = np.asarray(array, dtype=np.float64)
+    window = get_hamming_window(int(smoothing_window_size))
+    if len(array) == 0:
+        return array.copy()
+    if len(window) < FFT_MIN_WINDOW_SIZE:
+        # np.convolve(..., mode='same') centers the window on the element (len(window) - 1) // 2
+        return convolve1d(array, window, axis=0, mode='constant', cval=0., origin=0 if len(window) % 2 else -1)
+    # the window is broadcast to all channels
+    window = window.reshape((-1,) + (1,) * (array.ndim - 1))
+    return oaconvolve(array, window, mode='same', axes=0)
+
+
+class StreamingHammingSmoother:
+    """ Hamming smoothing of the stream of predictions. The predictions are passed in chunks with update(), and
+    the smoothed predictions are returned as soon as all values in their window are known, i.e. with the delay of
+    (smoothing_window_size - 1) // 2 timesteps. flush() returns the rest at the end
+    of the stream. The concatenated output is equal to apply_hamming_smoothing applied to the whole stream.
+
+    :param smoothing_window_size: int
+        Size of the smoothing window
+    :param num_channels: Optional[int]
+        Number of channels of the predictions. If None, the predictions are 1D.
+    """
+    def __init__(self, smoothing_window_size:int, num_channels:Optional[int]=None):
+        self.window = get_hamming_window(int(smoothing_window_size))
+        self.num_channels = num_channels
+        # number of the first outputs of the causal filter, which are skipped to align the output as mode='same'
+        self.delay = (len(self.window) - 1) // 2
+        self.reset()
+
+    def reset(self)->None:
+        """ Prepares the smoother for the new stream. """
+        # state of the FIR filter: the last len(window) - 1 inputs weighted by the window
+        state_shape = (len(self.window) - 1,) + (() if self.num_channels is None else (self.num_channels,))
+        self.state = np.zeros(state_shape)
+        self.num_skipped = 0
+
+    def __filter(self, chunk:np.ndarray)->np.ndarray:
+        if len(chunk) == 0:
+            return chunk
+        output, self.state = lfilter(self.window, 1., chunk, axis=0, zi=self.state)
+        num_skipped = min(self.delay - self.num_skipped, len(output))
+        self.num_skipped += num_skipped
+        return output[num_skipped:]
+
+    def update(self, chunk:np.ndarray)->np.ndarray:
+        """ Passes the next chunk of predictions.
+
+        :param chunk: np.ndarray
+            Predictions. Shape: (num_timesteps, num_channels) or (num_timesteps,)
+        :return: np.ndarray
+            Smoothed predictions, which can be calculated (can be empty)
+        """
+        return self.__filter(np.asarray(chunk, dtype=np.float64))
+
+    def flush(self)->np.ndarray:
+        """ Finishes the stream and returns the remaining smoothed predictions. """
+        # the stream is padded with zeros at the end as np.convolve(..., mode='same') does
+        output = self.__filter(np.zeros((self.delay,) + self.state.shape[1:]))
+        self.reset()
+        return output
@@ -0,0 +1,178 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+MANIFEST_FILENAME = 'embeddings_manifest.json'
+
+
+class EmbeddingStore:
+    """ Binary store of the static embeddings extracted from videos. It replaces per-video csv files with
+    hundreds of columns: parsing of the text floats is the main cost of loading the embeddings.
+
+    Every video is stored as two .npy files:
+        - <video>.npy: embeddings (num_frames x num_features) in float32 (lossless for the model outputs) or float16
+        - <video>.info.npy: frame numbers, timesteps and labels (num_frames x num_info_columns) in float64
+    The manifest (embeddings_manifest.json) contains the column names, dtypes and the number of frames of every video.
+    Embeddings are loaded as memory-mapped arrays, so they can be sliced without reading the whole file.
+
+    :param path: str
+            path to the directory of the store
+    :param dtype: str
+            dtype of the stored embeddings ('float32' or 'float16'). Used for writing only.
+    """
+    def __init__(self, path:str, dtype:Optional[str]='float32'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.manifest = self.__load_manifest()
+
+    @staticmethod
+    def exists(path:str)->bool:
+        """ Checks if the directory contains the embedding store. """
+        return os.path.exists(os.path.join(path, MANIFEST_FILENAME))
+
+    def __load_manifest(self)->Dict[str, object]:
+        manifest_path = os.path.join(self.path, MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            return {'videos': {}}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def __save_manifest(self)->None:
+        manifest_path = os.path.join(self.path, MANIFEST_FILENAME)
+        tmp_path = '{0}.{1}.tmp'.format(manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+
+    @property
+    def videos(self)->List[str]:
+        """ Names of all stored videos. """
+        return sorted(self.manifest['videos'].keys())
+
+    def __contains__(self, video:str)->bool:
+        return video in self.manifest['videos']
+
+    def __get_paths(self, video:str):
+        return os.path.join(self.path, video + '.npy'), os.path.join(self.path, video + '.info.npy')
+
+    def save(self, video:str, metadata:pd.DataFrame, columns:List[str], feature_columns:List[str])->None:
+        """ Saves the embeddings of one video. The metadata should contain the column 'video_name', the feature columns
+        and other numeric columns (frame numbers, timesteps and labels).
+
+        :param video: str
+                name of the video
+        :param metadata: pd.DataFrame
+                dataframe with the embeddings of the video (the same as saved to csv files before)
+        :param columns: List[str]
+                names of the columns of the metadata (they are assigned by position)
+        :param feature_columns: List[str]
+                names of the embedding columns
+        :return: None
+        """
+        os.makedirs(self.path, exist_ok=True)
+        metadata = metadata.set_axis(columns, axis=1)
+        info_columns = [column for column in columns if column != 'video_name' and column not in set(feature_columns)]
+        embeddings_path, info_path = self.__get_paths(video)
+        # write to temporary files first, so the store is not corrupted if the process is interrupted
+        tmp_suffix = '.{0}.tmp'.format(os.getpid())
+        with open(embeddings_path + tmp_suffix, 'wb') as f:
+            np.save(f, metadata[feature_columns].to_numpy(dtype=self.dtype))
+        with open(info_path + tmp_suffix, 'wb') as f:
+            np.save(f, metadata[info_columns].to_numpy(dtype=np.float64))
+        os.replace(embeddings_path + tmp_suffix, embeddings_path)
+        os.replace(info_path + tmp_suffix, info_path)
+        # update manifest
+        self.manifest['columns'] = columns
+        self.manifest['feature_columns'] = feature_columns
+        self.manifest['info_columns'] = info_columns
+        self.manifest['videos'][video] = {
+            'num_frames': len(metadata),
+            'dtype': self.dtype.name,
+            'info_dtypes': [metadata[column].dtype.name for column in info_columns],
+        }
+        self.__save_manifest()
+
+    def load_embeddings(self, video:str, mmap_mode:Optional[str]='r')->np.ndarray:
+        """ Loads the embeddings of the video (num_frames x num_features) as the memory-mapped array in the stored dtype.
+        Slices of the array (f.e. temporal windows) are read from disk without copying the whole video. """
+        return np.load(self.__get_paths(video)[0], mmap_mode=mmap_mode)
+
+    def load_info(self, video:str)->np.ndarray:
+        """ Loads frame numbers, timesteps and labels of the video (num_frames x num_info_columns). """
+        return np.load(self.__get_paths(video)[1])
+
+    def load_dataframe(self, video:str, columns:Optional[List[str]]=None)->pd.DataFrame:
+        """ Loads the video as the dataframe. The dataframe has the same columns as read from the csv file before:
+        embeddings keep the stored dtype (float32 or float16) instead of float64, so the video is not converted
+        to a twice larger copy, integer columns (f.e. frame numbers, categories) get the original dtype.
+        Use load_embeddings to slice the embeddings without loading the whole video.
+
+        :param video: str
+                name of the video
+        :param columns: Optional[List[str]]
+                names of the columns (by position). If None, the names from the manifest are used.
+        :return: pd.DataFrame
+                dataframe with all columns of the video
+        """
+        video_info = self.manifest['videos'][video]
+        embeddings = self.load_embeddings(video, mmap_mode='r')
+        info = self.load_info(video)
+        data = {'video_name': np.full(video_info['num_frames'], video, dtype=object)}
+        data.update(zip(self.manifest['feature_columns'], embeddings.T))
+        for idx, (column, dtype) in enumerate(zip(self.manifest['info_columns'], video_info['info_dtypes'])):
+            values = info[:, idx]
+            data[column] = values.astype(dtype) if np.issubdtype(np.dtype(dtype), np.integer) else values
+        stored_columns = self.manifest['columns']
+        df = pd.DataFrame(data, columns=stored_columns)
+        if columns is not None:
+            df.columns = columns
+        return df
+
+    def load_all_dataframes(self, columns:Optional[List[str]]=None)->Dict[str, pd.DataFrame]:
+        """ Loads all videos as dataframes. """
+        return {video: self.load_dataframe(video, columns) for video in self.videos}
+
+
+def read_embeddings_table(path:str, embeddings_type:Optional[str]='facial', num_classes:Optional[int]=8)->pd.DataFrame:
+    """ Reads the table with the embeddings of several videos, which is used for training: either the csv file
+    or the EmbeddingStore directory. The videos of the store are concatenated and converted to the schema
+    of the training csv files:
+        - 'path' (<video>/<frame_num>) is restored from the video names and frame numbers, since the training code
+          groups the frames by the folder in the path
+        - 'timestep' is renamed to 'timestamp'
+        - the embeddings of `embeddings_type` are renamed to 'embedding_{i}', the embeddings of other types are dropped
+        - 'category' is one-hot encoded to 'category_{i}' (frames without label, f.e. -1, get zeros)
+
+    :param path: str
+            path to the csv file or to the directory of the store
+    :param embeddings_type: str
+            type of the embeddings taken from the store ('facial' or 'pose'). Not used for the csv file.
+    :param num_classes: int
+            number of classes for the one-hot encoding of 'category'. Not used for the csv file.
+    :return: pd.DataFrame
+            dataframe with the embeddings of all videos
+    """
+    if not EmbeddingStore.exists(path):
+        return pd.read_csv(path)
+    store = EmbeddingStore(path)
+    table = pd.concat([store.load_dataframe(video) for video in store.videos], ignore_index=True)
+    if 'path' not in table.columns:
+        table.insert(0, 'path', table['video_name'] + '/' + table['frame_num'].astype(int).map('{:05d}'.format))
+    prefix = '{0}_embedding_'.format(embeddings_type)
+    embedding_columns = [column for column in table.columns if column.startswith(prefix)]
+    if not embedding_columns:
+        raise ValueError('The store {0} does not contain {1} embeddings'.format(path, embeddings_type))
+    other_embedding_columns = [column for column in table.columns
+                               if '_embedding_' in column and not column.startswith(prefix)]
+    table = table.drop(columns=other_embedding_columns)
+    table = table.rename(columns={'timestep': 'timestamp',
+                                  **{column: 'embedding_' + column[len(prefix):] for column in embedding_columns}})
+    if 'category' in table.columns:
+        categories = table.pop('category').to_numpy()
+        for i in range(num_classes):
+            table['category_{0}'.format(i)] = (categories == i).astype(np.int64)
+    return table
@@ -36,9 +36,15 @@ from pytorch_utils.models.input_preprocessing import resize_image_saving_aspect_
     ViT_image_preprocessor
 from src.video.preprocessing.face_extraction_utils import recognize_faces_bboxes, get_bbox_closest_to_previous_bbox, \
     get_most_confident_person, extract_face_according_bbox, load_and_prepare_detector_retinaFace_mobileNet
+from src.video.preprocessing.face_tracking import FaceTracker
+from src.video.preprocessing.row_buffer import ColumnarRowBuffer
+from src.video.preprocessing.video_metadata_index import load_fps_file
+from src.video.post_processing.embedding_store import EmbeddingStore
+from src.video.preprocessing.shared_video_pass import FrameConsumer, CallbackConsumer, process_video_with_consumers
 from src.video.preprocessing.labels_preprocessing import load_train_dev_AffWild2_labels_with_frame_paths, \
     load_AffWild2_labels
 from src.video.preprocessing.pose_extraction_utils import get_bboxes_for_frame, apply_bbox_to_frame
+from src.video.training.temporal_window_index import TemporalWindowIndex, get_video_window_starts
 from src.video.training.dynamic_fusion.models import VisualFusionModel_v1, VisualFusionModel_v2
 from src.video.training.dynamic_models.dynamic_models import UniModalTemporalModel_v1, UniModalTemporalModel_v2, \
     UniModalTemporalModel_v3, UniModalTemporalModel_v4, UniModalTemporalModel_v5, UniModalTemporalModel_v6_1_fps, \
@@ -47,19 +53,6 @@ from src.video.training.dynamic_models.dynamic_models import UniModalTemporalMod
 
 
 
-def load_fps_file(path_to_fps_file:str)->Dict[str, float]:
-    """ Loads the video_to_fps file from the provided path.
-
-    :param path_to_fps_file: str
-        Path to the video_to_fps file.
-    :return: Dict[str, float]
-        Dictionary with video names as keys and fps as values.
-    """
-    with open(path_to_fps_file, 'rb') as f:
-        fps_dict = pickle.load(f)
-        fps_dict = {''.join(key.split('.')[:-1]): value for key, value in fps_dict.items()}
-    return fps_dict
-
 class hook_model(nn.Module):
     def __init__(self, model, hook_layer, challenge:str):
         super(hook_model, self).__init__()
@@ -89,45 +82,37 @@ class hook_model(nn.Module):
         return self.features, output
 
 
-def __cut_video_on_windows(video:pd.DataFrame, window_size:int, stride:int)->List[pd.DataFrame]:
-    """ Cuts the video on windows with specified window size and stride.
+def __cut_video_on_windows(video:pd.DataFrame, column_groups:Dict[str, List[str]], window_size:int, stride:int,
+                           step:Optional[int]=1)->TemporalWindowIndex:
+    """ Cuts the video on windows with specified window size and stride. Only windows with monotonically increasing
+    frame numbers are included, the window ending with the last frame is always added. If the video is too short,
+    it is padded with zeros at the start. The columns are stored as contiguous arrays and every window is a view of them.
 
     :param video: pd.DataFrame
         The dataframe with corresponding frames of the video (represented as paths to the frames)
         It has columns ['path', 'frame_num', 'timestep', ...]
+    :param column_groups: Dict[str, Union[str, List[str]]]
+        Groups of columns (group name -> columns). Features are stored in float32. The groups 'timestep',
+        'frame_num' and 'labels' keep the original dtype.
     :param window_size: int
         Size of the window. Given in number of frames.
     :param stride: int
         Stride of the window. Given in number of frames.
-    :return: List[pd.DataFrame]
-        List of dataframes with windows. Each dataframe has the same columns as the input dataframe.
+    :param step: int
+        Take every step-th frame of the window.
+    :return: TemporalWindowIndex
+        Index of the windows of the video.
     """
-    if len(video) <= window_size:
-        # pad it with zeros at the start
-        zeros = pd.DataFrame(np.zeros((window_size - len(video), len(video.columns))), columns=video.columns)
-        video = pd.concat([zeros, video], axis=0)
-        return [video]
-    # create list to store the windows
-    windows = []
-    # calculate the common frame_num_difference and the reference range of the window
-    frame_num_difference = video['frame_num'].diff().round(2).mode().values[0]
-    reference_range = np.round(frame_num_difference * (window_size-1), 2)
-    # go over the video and cut it on windows. We include only windows with the same range as the reference range
-    # (thus, only windows with the monotonically increasing timesteps are included in the result list)
-    for i in range(0, len(video), stride):
-        window = video.iloc[i:i + window_size]
-        actual_range = np.round(window["frame_num"].iloc[-1] - window["frame_num"].iloc[0], 2)
-        if actual_range == reference_range:
-            windows.append(window)
-    # sometimes, there are no windows at all (because they are ultra short and most of the labels are missing)
-    # then, we will just take the last window
-    if len(windows) == 0:
-        windows.append(video.iloc[-window_size:])
-    # most of the times, the last window has not been added as there have been not enough values. Therefore,
-    # we add it manually
-    windows.append(video.iloc[-window_size:])
+    starts, padding = get_video_window_starts(video['frame_num'].values, window_size=window_size, stride=stride,
+                                              replace_last=False)
+    arrays = {name: video[columns].to_numpy() if name in ('timestep', 'frame_num', 'labels')
+                    else video[columns].to_numpy(dtype=np.float32)
+              for name, columns in column_groups.items()}
+    windows = TemporalWindowIndex(window_size, step=step)
+    windows.add_video('video', arrays, starts, padding)
     return windows
 
+
 def __initialize_face_detector():
     detector = load_and_prepare_detector_retinaFace_mobileNet()
     return detector
@@ -228,8 +213,13 @@ def __initialize_dynamic_model(dynamic_model_type, path_to_weights, input_shape,
     model.eval()
     return model
 
-def __recognize_face(frame, face_detector, previous_face, previous_bbox)->Tuple[np.ndarray, np.ndarray]:
-    bboxes_face = recognize_faces_bboxes(frame, face_detector, conf_threshold=0.8)
+def __recognize_face(frame, face_detector, previous_face, previous_bbox,
+                     tracker:Optional[FaceTracker]=None)->Tuple[np.ndarray, np.ndarray]:
+    # the tracker runs the detector only every k-th frame and returns the tracked bbox on other frames
+    if tracker is not None:
+        bboxes_face = tracker.track_batch([frame], face_detector)[0]
+    else:
+        bboxes_face = recognize_faces_bboxes(frame, face_detector, conf_threshold=0.8)
     # if face is not recognized, note it as NaN
     if bboxes_face is None:
         # if there were no face before
@@ -281,74 +271,90 @@ def __recognize_pose(frame, pose_detector, previous_pose, previous_bbox)->Tuple[
     return pose, bbox
 
 
-def process_one_video_static(path_to_video:str, face_detector:object, pose_detector:object,
-                             facial_feature_extractor:Tuple[nn.Module, List[Callable]],
-                             pose_feature_extractor:Tuple[nn.Module, List[Callable]],
-                             device)->pd.DataFrame:
+def create_static_embeddings_consumer(face_detector:object, pose_detector:object,
+                                      facial_feature_extractor:Tuple[nn.Module, List[Callable]],
+                                      pose_feature_extractor:Tuple[nn.Module, List[Callable]],
+                                      device, detect_every_k:Optional[int]=1)->CallbackConsumer:
+    """ Creates the consumer of the shared video pass, which extracts facial and pose embeddings from every frame.
+    The result of the consumer is the dataframe with embeddings (see process_one_video_static).
+    """
     # extract feature extractors and preprocessing functions
     facial_feature_extractor, facial_preprocessing_functions = facial_feature_extractor
     pose_feature_extractor, pose_preprocessing_functions = pose_feature_extractor
-    video_name = os.path.basename(path_to_video).split(".")[0]
-    # metadata
-    columns = (["video_name", "frame_num", "timestep"] +
-               [f"facial_embedding_{i}" for i in range(256)] + [f"pose_embedding_{i}" for i in range(256)])
-    metadata = pd.DataFrame(columns=columns)
-    # load video file
-    video = cv2.VideoCapture(path_to_video)
-    # get FPS
-    FPS = video.get(cv2.CAP_PROP_FPS)
-    FPS_in_seconds = 1. / FPS
-    # go through all frames
-    counter = 1
-    previous_face = None
-    previous_pose = None
-    last_bbox_face = None
-    last_bbox_pose = None
-    pbar = tqdm(total=int(video.get(cv2.CAP_PROP_FRAME_COUNT)))
-    while video.isOpened():
-        ret, frame = video.read()
-        pbar.update(1)
-        if ret:
-            # convert BGR to RGB
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            # calculate timestamp
-            timestep = counter * FPS_in_seconds
-            # round it to 2 digits to make it readable
-            timestep = round(timestep, 2)
-            # recognize the face
-            face, face_bbox = __recognize_face(frame, face_detector, previous_face, last_bbox_face)
-            previous_face = face
-            last_bbox_face = last_bbox_face
-            # recognize the pose
-            pose, pose_bbox = __recognize_pose(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), # HRNet requires BGR format of frame
-                                    pose_detector, previous_pose, last_bbox_pose)
-            pose = cv2.cvtColor(pose, cv2.COLOR_BGR2RGB) # transform back to RGB
-            previous_pose = pose
-            last_bbox_pose = last_bbox_pose
-            # extract facial embeddings
-            face = torch.from_numpy(face).permute(2, 0, 1)
-            for func in facial_preprocessing_functions:
-                face = func(face)
-            face = face.unsqueeze(0).to(device)
-            facial_embeddings, _ = facial_feature_extractor(face)
-            facial_embeddings = facial_embeddings.detach().cpu().numpy().squeeze()
-            # extract pose embeddings
-            pose = torch.from_numpy(pose).permute(2, 0, 1)
-            for func in pose_preprocessing_functions:
-                pose = func(pose)
-            pose = pose.unsqueeze(0).to(device)
-            pose_embeddings, _ = pose_feature_extractor(pose)
-            pose_embeddings = pose_embeddings.detach().cpu().numpy().squeeze()
-            # save everything to metadata. Generate row
-            metadata_row = {"video_name": video_name, "frame_num": counter, "timestep": timestep}
-            metadata_row.update({f"facial_embedding_{i}": facial_embeddings[i] for i in range(256)})
-            metadata_row.update({f"pose_embedding_{i}": pose_embeddings[i] for i in range(256)})
-            metadata = pd.concat([metadata, pd.DataFrame(metadata_row, index=[0])], axis=0, ignore_index=True)
-            # update counter
-            counter += 1
-        else:
-            break
-    metadata.reset_index(drop=True, inplace=True)
+    # metadata columns. Embeddings are kept in float64, so the saved values are the same as before
+    columns = {"video_name": object, "frame_num": np.int64, "timestep": np.float64,
+               "facial_embedding": (256, np.float64), "pose_embedding": (256, np.float64)}
+    state = {}
+
+    def start(video_info):
+        state.update(video_name=video_info["video_name"], FPS_in_seconds=1. / video_info["fps"],
+                     metadata=ColumnarRowBuffer(columns), previous_face=None, previous_pose=None,
+                     last_bbox_face=None, last_bbox_pose=None,
+                     face_tracker=FaceTracker(detect_every_k, keep_the_same_person=False) if detect_every_k > 1 else None,
+                     pbar=tqdm(total=video_info["num_frames"]))
+
+    def process_batch(frame_nums, frames):
+        # gradient mode is thread-local, so it is disabled in the thread of the consumer explicitly
+        with torch.no_grad():
+            for counter, frame in zip(frame_nums, frames):
+                state["pbar"].update(1)
+                # calculate timestamp
+                timestep = counter * state["FPS_in_seconds"]
+                # round it to 2 digits to make it readable
+                timestep = round(timestep, 2)
+                # recognize the face. The last bboxes are not updated, so the most confident face is taken on every frame
+                # (the tracker does not keep the same person either, so detect_every_k > 1 selects the same face as 1)
+                face, face_bbox = __recognize_face(frame, face_detector, state["previous_face"], state["last_bbox_face"],
+                                                   state["face_tracker"])
+                state["previous_face"] = face
+                # recognize the pose
+                pose, pose_bbox = __recognize_pose(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), # HRNet requires BGR format of frame
+                                        pose_detector, state["previous_pose"], state["last_bbox_pose"])
+                pose = cv2.cvtColor(pose, cv2.COLOR_BGR2RGB) # transform back to RGB
+                state["previous_pose"] = pose
+                # extract facial embeddings
+                face = torch.from_numpy(face).permute(2, 0, 1)
+                for func in facial_preprocessing_functions:
+                    face = func(face)
+                face = face.unsqueeze(0).to(device)
+                facial_embeddings, _ = facial_feature_extractor(face)
+                facial_embeddings = facial_embeddings.detach().cpu().numpy().squeeze()
+                # extract pose embeddings
+                pose = torch.from_numpy(pose).permute(2, 0, 1)
+                for func in pose_preprocessing_functions:
+                    pose = func(pose)
+                pose = pose.unsqueeze(0).to(device)
+                pose_embeddings, _ = pose_feature_extractor(pose)
+                pose_embeddings = pose_embeddings.detach().cpu().numpy().squeeze()
+                # save everything to metadata
+                state["metadata"].append(video_name=state["video_name"], frame_num=counter, timestep=timestep,
+                                         facial_embedding=facial_embeddings, pose_embedding=pose_embeddings)
+
+    def finish():
+        state["pbar"].close()
+        metadata = state["metadata"].to_dataframe()
+        if state["face_tracker"] is not None:
+            # the statistics are returned with the metadata
+            metadata.attrs['tracking_statistics'] = state["face_tracker"].log_drift_statistics(state["video_name"])
+        return metadata
+
+    return CallbackConsumer(process_batch, start=start, finish=finish)
+
+
+def process_one_video_static(path_to_video:str, face_detector:object, pose_detector:object,
+                             facial_feature_extractor:Tuple[nn.Module, List[Callable]],
+                             pose_feature_extractor:Tuple[nn.Module, List[Callable]],
+                             device, detect_every_k:Optional[int]=1,
+                             additional_consumers:Optional[List[FrameConsumer]]=None,
+                             additional_results:Optional[List[object]]=None)->pd.DataFrame:
+    # the video is decoded once for the embeddings extraction and additional consumers (f.e. face and pose crops).
+    # Results of additional consumers are appended to additional_results
+    additional_consumers = additional_consumers if additional_consumers is not None else []
+    consumer = create_static_embeddings_consumer(face_detector, pose_detector, facial_feature_extractor,
+                                                 pose_feature_extractor, device, detect_every_k)
+    metadata, *results = process_video_with_consumers(path_to_video, [consumer] + additional_consumers)
+    if additional_results is not None:
+        additional_results.extend(results)
     return metadata
 
 
@@ -380,30 +386,27 @@ def process_one_video_dynamic(df_video, window_size, stride, dynamic_model, feat
     original_fps = round_math(original_fps)
     every_n_frame = int(round(original_fps / needed_fps))
     full_window_size = int(np.round(window_size//5*original_fps))
-    windows = __cut_video_on_windows(df_video, window_size=full_window_size, stride=round_math(full_window_size/2))
-    for idx in range(len(windows)):
-        # if the window is too short (has one less frame than the full_window_size), then we need to pad it by adding last row
-        if len(windows[idx]) < full_window_size:
-            last_row = windows[idx].iloc[-1].copy()
-            windows[idx] = pd.concat([windows[idx], last_row], axis=0, ignore_index=True)
-            windows[idx].reset_index(drop=True, inplace=True)
-    windows = [item.iloc[::every_n_frame] for item in windows]
+    if isinstance(feature_columns, tuple):
+        feature_groups = ['features_%i' % i for i in range(len(feature_columns))]
+        column_groups = dict(zip(feature_groups, feature_columns))
+    else:
+        feature_groups = ['features']
+        column_groups = {'features': feature_columns}
+    column_groups.update({'timestep': 'timestep', 'frame_num': 'frame_num', 'labels': labels_columns})
+    windows = __cut_video_on_windows(df_video, column_groups=column_groups, window_size=full_window_size,
+                                     stride=round_math(full_window_size/2), step=every_n_frame)
     predictions = []
     for window_idx in range(0, len(windows), batch_size):
         # extract the batch of windows
-        batch_windows = windows[window_idx:window_idx + batch_size]
-        timesteps = np.stack([window['timestep'].values for window in batch_windows])
-        num_frames = np.stack([window['frame_num'].values for window in batch_windows])
-        labels = np.stack([window[labels_columns].values for window in batch_windows])
+        batch_windows = slice(window_idx, window_idx + batch_size)
+        timesteps = windows.get_windows(batch_windows, 'timestep')
+        num_frames = windows.get_windows(batch_windows, 'frame_num')
+        labels = windows.get_windows(batch_windows, 'labels')
         # extract features from the batch # TODO: take into account bi-modal model
-        if isinstance(feature_columns, tuple):
-            batch_windows = [
-                [torch.from_numpy(window[feature_columns[i]].values) for window in batch_windows] for i in range(len(feature_columns))
-            ]
-            batch_windows = [torch.stack(batch_windows[i]).float().to(device) for i in range(len(feature_columns))]
-        else:
-            batch_windows = [torch.from_numpy(window[feature_columns].values) for window in batch_windows]
-            batch_windows = torch.stack(batch_windows).float().to(device)
+        batch_windows = [torch.from_numpy(windows.get_windows(batch_windows, group)).to(device)
+                         for group in feature_groups]
+        if not isinstance(feature_columns, tuple):
+            batch_windows = batch_windows[0]
         # get predictions
         batch_features, batch_predictions = dynamic_model(batch_windows) if not isinstance(dynamic_model, tuple) else dynamic_model(*batch_windows)
         batch_features = batch_features.detach().cpu().numpy()
@@ -446,7 +449,47 @@ def align_labels_with_metadata(metadata:pd.DataFrame, labels:pd.DataFrame, chall
 
 
 
-def process_all_videos_static(config, videos:List[str]):
+def get_static_columns(challenge:str)->List[str]:
+    """ Returns names of the columns of the extracted static embeddings (with labels) in the order they are saved. """
+    columns = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
+               [f"pose_embedding_{i}" for i in range(256)])
+    return columns + (["category"] if challenge == "Exp" else ["valence", "arousal"])
+
+
+def save_static_features(metadata_static:pd.DataFrame, output_path:str, video:str, challenge:str,
+                         features_format:Optional[str]="npy")->None:
+    """ Saves the extracted static embeddings of one video either to the binary EmbeddingStore ("npy")
+    or to the csv file ("csv"). """
+    if features_format == "csv":
+        metadata_static.to_csv(os.path.join(output_path, f"{video}.csv"), index=False)
+        return
+    columns = get_static_columns(challenge)
+    EmbeddingStore(output_path).save(video, metadata_static, columns=columns, feature_columns=columns[3:3 + 512])
+
+
+def load_static_features(path_to_extracted_features:str, challenge:str)->Dict[str, pd.DataFrame]:
+    """ Loads the extracted static embeddings of all videos with the named columns. The directory can contain
+    both the binary EmbeddingStore and csv files (f.e. the extraction was resumed with another static_features_format):
+    videos are taken from the store, and the csv files are read for the videos, which are not in the store. """
+    columns = get_static_columns(challenge)
+    metadata_static = {}
+    if EmbeddingStore.exists(path_to_extracted_features):
+        metadata_static.update(EmbeddingStore(path_to_extracted_features).load_all_dataframes(columns))
+    for file in glob.glob(os.path.join(path_to_extracted_features, "*.csv")):
+        video = os.path.basename(file).split(".")[0]
+        if video in metadata_static:
+            continue
+        metadata_static[video] = pd.read_csv(file)
+        # assign column names
+        metadata_static[video].columns = columns
+    return metadata_static
+
+
+def process_all_videos_static(config, videos:List[str],
+                              additional_consumers:Optional[List[FrameConsumer]]=None)->Dict[str, List[object]]:
+    # additional consumers (f.e. FaceExtractionConsumer, PoseExtractionConsumer) get the same decoded frames,
+    # their results are returned for every video
+    additional_results = {}
     # initialize face detector and pose detector
     face_detector = __initialize_face_detector()
     pose_detector = __initialize_pose_detector()
@@ -487,11 +530,16 @@ def process_all_videos_static(config, videos:List[str]):
                                                    face_detector=face_detector, pose_detector=pose_detector,
                                                     facial_feature_extractor=(facial_feature_extractor, facial_preprocessing_functions),
                                                     pose_feature_extractor=(pose_feature_extractor, pose_preprocessing_functions),
-                                                    device=config["device"])
+                                                    device=config["device"],
+                                                    detect_every_k=config.get("detect_every_k", 1),
+                                                    additional_consumers=additional_consumers,
+                                                    additional_results=additional_results.setdefault(video, []))
         current_labels = labels[video]
         metadata_static = align_labels_with_metadata(metadata_static, current_labels, challenge=config["challenge"])
         # save extracted features
-        metadata_static.to_csv(os.path.join(config["output_static_features"], f"{os.path.basename(video)}.csv"), index=False)
+        save_static_features(metadata_static, config["output_static_features"], os.path.basename(video),
+                             challenge=config["challenge"], features_format=config.get("static_features_format", "npy"))
+    return additional_results
 
 
 
@@ -512,18 +560,7 @@ def process_all_videos_dynamic(dynamic_model_type, path_to_weights, normalizatio
     else:
         normalizer = None
     # load metadata
-    metadata_static = glob.glob(os.path.join(path_to_extracted_features, "*.csv"))
-    metadata_static = {os.path.basename(file).split(".")[0]: pd.read_csv(file) for file in metadata_static}
-    # assign column names
-    columns = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
-               [f"pose_embedding_{i}" for i in range(256)])
-    if challenge == "Exp":
-        columns = columns + ["category"]
-    else:
-        columns = columns + ["valence", "arousal"]
-    # assign column names to every dataframe
-    for video in metadata_static.keys():
-        metadata_static[video].columns = columns
+    metadata_static = load_static_features(path_to_extracted_features, challenge)
     # fit normalizer
     # concatenate embeddings columns if tuple
     feature_columns = embeddings_columns if not isinstance(embeddings_columns, tuple) else embeddings_columns[0] + embeddings_columns[1]
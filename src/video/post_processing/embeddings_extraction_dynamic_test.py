@@ -1,7 +1,6 @@
 import gc
-import glob
 from functools import partial
-from typing import Tuple, Optional, List, Callable, Dict
+from typing import Tuple, Optional, List, Callable
 import sys
 
 import math
@@ -39,6 +38,9 @@ from src.video.preprocessing.face_extraction_utils import recognize_faces_bboxes
 from src.video.preprocessing.labels_preprocessing import load_train_dev_AffWild2_labels_with_frame_paths, \
     load_AffWild2_labels
 from src.video.preprocessing.pose_extraction_utils import get_bboxes_for_frame, apply_bbox_to_frame
+from src.video.preprocessing.row_buffer import ColumnarRowBuffer
+from src.video.preprocessing.video_metadata_index import load_fps_file
+from src.video.post_processing.embeddings_extraction_dynamic import save_static_features, load_static_features
 from src.video.training.dynamic_fusion.models import VisualFusionModel_v1, VisualFusionModel_v2
 from src.video.training.dynamic_models.dynamic_models import UniModalTemporalModel_v1, UniModalTemporalModel_v2, \
     UniModalTemporalModel_v3, UniModalTemporalModel_v4, UniModalTemporalModel_v5, UniModalTemporalModel_v6_1_fps, \
@@ -47,19 +49,6 @@ from src.video.training.dynamic_models.dynamic_models import UniModalTemporalMod
 
 
 
-def load_fps_file(path_to_fps_file:str)->Dict[str, float]:
-    """ Loads the video_to_fps file from the provided path.
-
-    :param path_to_fps_file: str
-        Path to the video_to_fps file.
-    :return: Dict[str, float]
-        Dictionary with video names as keys and fps as values.
-    """
-    with open(path_to_fps_file, 'rb') as f:
-        fps_dict = pickle.load(f)
-        fps_dict = {''.join(key.split('.')[:-1]): value for key, value in fps_dict.items()}
-    return fps_dict
-
 class hook_model(nn.Module):
     def __init__(self, model, hook_layer, challenge:str):
         super(hook_model, self).__init__()
@@ -289,10 +278,9 @@ def process_one_video_static(path_to_video:str, face_detector:object, pose_detec
     facial_feature_extractor, facial_preprocessing_functions = facial_feature_extractor
     pose_feature_extractor, pose_preprocessing_functions = pose_feature_extractor
     video_name = os.path.basename(path_to_video).split(".")[0]
-    # metadata
-    columns = (["video_name", "frame_num", "timestep"] +
-               [f"facial_embedding_{i}" for i in range(256)] + [f"pose_embedding_{i}" for i in range(256)])
-    metadata = pd.DataFrame(columns=columns)
+    # metadata is accumulated in columns. Embeddings are kept in float64, so the saved values are the same as before
+    metadata = ColumnarRowBuffer({"video_name": object, "frame_num": np.int64, "timestep": np.float64,
+                                  "facial_embedding": (256, np.float64), "pose_embedding": (256, np.float64)})
     # load video file
     video = cv2.VideoCapture(path_to_video)
     # get FPS
@@ -339,17 +327,14 @@ def process_one_video_static(path_to_video:str, face_detector:object, pose_detec
             pose = pose.unsqueeze(0).to(device)
             pose_embeddings, _ = pose_feature_extractor(pose)
             pose_embeddings = pose_embeddings.detach().cpu().numpy().squeeze()
-            # save everything to metadata. Generate row
-            metadata_row = {"video_name": video_name, "frame_num": counter, "timestep": timestep}
-            metadata_row.update({f"facial_embedding_{i}": facial_embeddings[i] for i in range(256)})
-            metadata_row.update({f"pose_embedding_{i}": pose_embeddings[i] for i in range(256)})
-            metadata = pd.concat([metadata, pd.DataFrame(metadata_row, index=[0])], axis=0, ignore_index=True)
+            # save everything to metadata
+            metadata.append(video_name=video_name, frame_num=counter, timestep=timestep,
+                            facial_embedding=facial_embeddings, pose_embedding=pose_embeddings)
             # update counter
             counter += 1
         else:
             break
-    metadata.reset_index(drop=True, inplace=True)
-    return metadata
+    return metadata.to_dataframe()
 
 
 
@@ -491,7 +476,8 @@ def process_all_videos_static(config, videos:List[str]):
         current_labels = labels[video]
         metadata_static = align_labels_with_metadata(metadata_static, current_labels, challenge=config["challenge"])
         # save extracted features
-        metadata_static.to_csv(os.path.join(config["output_static_features"], f"{os.path.basename(video)}.csv"), index=False)
+        save_static_features(metadata_static, config["output_static_features"], os.path.basename(video),
+                             challenge=config["challenge"], features_format=config.get("static_features_format", "npy"))
 
 
 
@@ -512,18 +498,7 @@ def process_all_videos_dynamic(dynamic_model_type, path_to_weights, normalizatio
     else:
         normalizer = None
     # load metadata
-    metadata_static = glob.glob(os.path.join(path_to_extracted_features, "*.csv"))
-    metadata_static = {os.path.basename(file).split(".")[0]: pd.read_csv(file) for file in metadata_static}
-    # assign column names
-    columns = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
-               [f"pose_embedding_{i}" for i in range(256)])
-    if challenge == "Exp":
-        columns = columns + ["category"]
-    else:
-        columns = columns + ["valence", "arousal"]
-    # assign column names to every dataframe
-    for video in metadata_static.keys():
-        metadata_static[video].columns = columns
+    metadata_static = load_static_features(path_to_extracted_features, challenge)
     # fit normalizer
     # concatenate embeddings columns if tuple
     feature_columns = embeddings_columns if not isinstance(embeddings_columns, tuple) else embeddings_columns[0] + embeddings_columns[1]
@@ -1,4 +1,3 @@
-import glob
 import os
 import sys
 from typing import List, Optional
@@ -25,7 +24,8 @@ from src.evaluation_dynamic import __average_predictions_on_timesteps, __interpo
     __synchronize_predictions_with_ground_truth, __apply_hamming_smoothing
 from src.video.post_processing.embeddings_extraction_dynamic import __initialize_static_feature_extractor, \
     __initialize_face_detector, __initialize_pose_detector, process_one_video_static, align_labels_with_metadata, \
-    __cut_video_on_windows, load_fps_file, __initialize_dynamic_model
+    __cut_video_on_windows, load_fps_file, __initialize_dynamic_model, save_static_features, load_static_features
+from src.video.post_processing.embedding_store import EmbeddingStore
 
 
 def process_all_videos_static_test(config, videos:List[str]):
@@ -57,7 +57,8 @@ def process_all_videos_static_test(config, videos:List[str]):
     # go over videos
     for video in tqdm(videos):
         videofile_name = video+".mp4" if video+".mp4" in os.listdir(path_to_data) else video+".avi"
-        if os.path.exists(os.path.join(config["output_static_features"], f"{os.path.basename(video)}.csv")):
+        if (os.path.exists(os.path.join(config["output_static_features"], f"{os.path.basename(video)}.csv")) or
+                os.path.basename(video) in EmbeddingStore(config["output_static_features"])):
             continue
         # process one video with static models
         metadata_static = process_one_video_static(path_to_video=os.path.join(path_to_data, videofile_name),
@@ -72,7 +73,8 @@ def process_all_videos_static_test(config, videos:List[str]):
             current_labels = pd.DataFrame([[np.NaN, np.NaN]] * 100, columns=["valence", "arousal"])
         metadata_static = align_labels_with_metadata(metadata_static, current_labels, challenge=config["challenge"])
         # save extracted features
-        metadata_static.to_csv(os.path.join(config["output_static_features"], f"{os.path.basename(video)}.csv"), index=False)
+        save_static_features(metadata_static, config["output_static_features"], os.path.basename(video),
+                             challenge=config["challenge"], features_format=config.get("static_features_format", "npy"))
 
 
 
@@ -161,18 +163,7 @@ def generate_test_predictions_all_videos(dynamic_model_type, path_to_weights, no
     else:
         normalizer = None
     # load metadata
-    metadata_static = glob.glob(os.path.join(path_to_extracted_features, "*.csv"))
-    metadata_static = {os.path.basename(file).split(".")[0]: pd.read_csv(file) for file in metadata_static}
-    # assign column names
-    columns = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
-               [f"pose_embedding_{i}" for i in range(256)])
-    if challenge == "Exp":
-        columns = columns + ["category"]
-    else:
-        columns = columns + ["valence", "arousal"]
-    # assign column names to every dataframe
-    for video in metadata_static.keys():
-        metadata_static[video].columns = columns
+    metadata_static = load_static_features(path_to_extracted_features, challenge)
     # fit normalizer
     # concatenate embeddings columns if tuple
     feature_columns = embeddings_columns if not isinstance(embeddings_columns, tuple) else embeddings_columns[0] + \
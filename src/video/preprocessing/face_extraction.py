@@ -6,27 +6,165 @@ sys.path.append("/nfs/scripts/simple-HRNet-master/")
 
 import glob
 import os
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
 
 import pandas as pd
 import torch
 import pandas
 
-import cv2
 import numpy as np
 from PIL import Image
 from moviepy.video.fx import crop
 from moviepy.video.io.VideoFileClip import VideoFileClip
 from tqdm import tqdm
 
-from src.video.preprocessing.face_extraction_utils import extract_face_according_bbox, recognize_faces_bboxes, \
+from src.video.preprocessing.face_extraction_utils import extract_faces_according_bboxes, recognize_faces_bboxes_batch, \
     get_bbox_closest_to_previous_bbox, get_most_confident_person, load_and_prepare_detector_retinaFace_mobileNet
+from src.video.preprocessing.face_tracking import FaceTracker
+from src.video.preprocessing.row_buffer import ColumnarRowBuffer
+from src.video.preprocessing.shared_video_pass import FrameConsumer, process_video_with_consumers
+
+
+def save_face(face:np.ndarray, output_filename:str)->None:
+    """ Saves the face to the output file. Used by the writer pool of the face extraction.
+
+    :param face: np.ndarray
+            face image represented by np.ndarray
+    :param output_filename: str
+            path to the output file
+    :return: None
+    """
+    Image.fromarray(face).save(output_filename)
+
+
+class FaceExtractionConsumer(FrameConsumer):
+    """ Consumer of the shared video pass, which extracts faces and saves them to the output path. Also, generates
+    dataframe with information about the extracted faces.
+    The detector recognizes faces in the whole batch, the faces are cropped for the whole batch, and the writer pool
+    saves the faces. The metadata is collected in columns and converted to the dataframe once.
+    If detect_every_k > 1, the detector runs every k-th frame (and on scene cuts or low confidence), and the face
+    is tracked between detections by the FaceTracker.
+    The extracted faces (the same as saved ones) can be passed to face_consumers, f.e. for the mouth area extraction,
+    so the faces are not read back from the disk.
+
+    :param detector: object
+            the model that generates bboxes from facial images. It should return bounding boxes and confidence score for every person.
+    :param output_path: str
+            path to the output directory
+    :param keep_the_same_person: bool
+            if True, then the function will try to keep the same person along the frames bu comparins positions of the
+            bounding boxes.
+    :param num_writers: int
+            number of threads for saving of the faces
+    :param detect_every_k: int
+            run the detector every k-th extracted frame and track the face in between. 1 means detection on every frame.
+    :param face_consumers: List[FrameConsumer]
+            consumers of the extracted faces. They are called in the thread of this consumer.
+    """
+    def __init__(self, detector:object, output_path:str, keep_the_same_person:Optional[bool]=False,
+                 num_writers:Optional[int]=4, detect_every_k:Optional[int]=1,
+                 face_consumers:Optional[List[FrameConsumer]]=None):
+        self.detector = detector
+        self.output_path = output_path
+        self.keep_the_same_person = keep_the_same_person
+        self.num_writers = num_writers
+        self.detect_every_k = detect_every_k
+        self.face_consumers = face_consumers if face_consumers is not None else []
+
+    def start(self, video_info:Dict[str, object])->None:
+        self.video_filename = video_info["video_name"]
+        # create output directory if needed
+        if not os.path.exists(os.path.join(self.output_path, self.video_filename)):
+            os.makedirs(os.path.join(self.output_path, self.video_filename), exist_ok=True)
+        # metadata is accumulated in columns
+        self.metadata = ColumnarRowBuffer({"filename": object, "frame_num": np.int64, "timestamp": np.float64})
+        self.FPS_in_seconds = 1. / video_info["fps"]
+        self.previous_face = None
+        self.last_bbox = None
+        self.tracker = FaceTracker(self.detect_every_k, self.keep_the_same_person) if self.detect_every_k > 1 else None
+        self.writers = ThreadPoolExecutor(max_workers=self.num_writers)
+        self.pending = []
+        for consumer in self.face_consumers:
+            consumer.start(video_info)
+
+    def process_batch(self, frame_nums:List[int], frames:List[np.ndarray])->None:
+        # recognize the faces in the whole batch. The tracker returns only the chosen bbox for every frame
+        if self.tracker is not None:
+            bboxes_batch = self.tracker.track_batch(frames, self.detector)
+        else:
+            bboxes_batch = recognize_faces_bboxes_batch(frames, self.detector, conf_threshold=0.8)
+        # choose bboxes. It is done sequentially, since the choice depends on the previous bbox
+        chosen_bboxes = []
+        for bboxes in bboxes_batch:
+            if bboxes is None:
+                # if not recognized, the previous bbox (and face) is used
+                chosen_bboxes.append(self.last_bbox)
+                continue
+            if self.keep_the_same_person and self.last_bbox is not None:
+                # if we want to keep the same person, then we need to calculate the distances between the
+                # center of the previous bbox and the current ones. Then, choose the closest one.
+                self.last_bbox = get_bbox_closest_to_previous_bbox(bboxes, self.last_bbox)
+            else:
+                # otherwise, take the most confident one
+                self.last_bbox = get_most_confident_person(bboxes)
+            chosen_bboxes.append(self.last_bbox)
+        # extract faces according to bboxes for the whole batch
+        recognized = [idx for idx, bboxes in enumerate(bboxes_batch) if bboxes is not None]
+        recognized_faces = extract_faces_according_bboxes([frames[idx] for idx in recognized],
+                                                          [chosen_bboxes[idx] for idx in recognized])
+        recognized_faces = dict(zip(recognized, recognized_faces))
+        faces = []
+        for idx, counter in enumerate(frame_nums):
+            if idx in recognized_faces:
+                face = recognized_faces[idx]
+            elif self.previous_face is None:
+                # if there were no face before
+                face = np.zeros((224,224,3), dtype=np.uint8)
+            else:
+                # save previous face
+                face = self.previous_face
+            # create full path to the output file
+            output_filename = os.path.join(self.output_path, self.video_filename, f"{counter:05}.jpg")
+            # save extracted face in the writer pool
+            self.pending.append(self.writers.submit(save_face, face, output_filename))
+            # calculate timestamp and round it to 2 digits to make it readable
+            self.metadata.append(filename=output_filename, frame_num=counter,
+                                 timestamp=round(counter * self.FPS_in_seconds, 2))
+            self.previous_face = face
+            faces.append(face)
+        for consumer in self.face_consumers:
+            consumer.process_batch(frame_nums, faces)
+        # limit the number of faces waiting for saving
+        if len(self.pending) > 4 * len(frame_nums):
+            self.__wait_for_writers()
+
+    def __wait_for_writers(self)->None:
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def finish(self)->pd.DataFrame:
+        """ Waits until all faces are saved and returns the metadata of the extracted faces. """
+        self.__wait_for_writers()
+        self.writers.shutdown()
+        for consumer in self.face_consumers:
+            consumer.finish()
+        metadata = self.metadata.to_dataframe()
+        if self.tracker is not None:
+            # the statistics are returned with the metadata
+            metadata.attrs['tracking_statistics'] = self.tracker.log_drift_statistics(self.video_filename)
+        return metadata
 
 
 def extract_face_one_video(path_to_video:str, detector:object, output_path:str, keep_the_same_person:Optional[bool]=False,
-                                 every_n_frame:Optional[int]=1)->pd.DataFrame:
+                                 every_n_frame:Optional[int]=1, batch_size:Optional[int]=32,
+                                 num_writers:Optional[int]=4, detect_every_k:Optional[int]=1)->pd.DataFrame:
     """ Extracts faces from video and saves them to the output path. Also, generates dataframe with information about the
     extracted faces.
+    The video is processed in the streaming way by the shared video pass with FaceExtractionConsumer: the decoder
+    reads frames in batches, the detector recognizes faces in the batch, the faces are cropped for the whole batch,
+    and the writer pool saves the faces.
 
     :param path_to_video: str
             path to the video file
@@ -39,84 +177,23 @@ def extract_face_one_video(path_to_video:str, detector:object, output_path:str,
             bounding boxes.
     :param every_n_frame: int
             extract faces from every n-th frame
+    :param batch_size: int
+            number of frames processed by the detector at once
+    :param num_writers: int
+            number of threads for saving of the faces
+    :param detect_every_k: int
+            run the detector every k-th extracted frame and track the face in between. 1 means detection on every frame.
     :return: pd.DataFrame
             dataframe with information about the extracted faces
     """
-    video_filename = os.path.basename(path_to_video).split(".")[0]
-    # create output directory if needed
-    if not os.path.exists(os.path.join(output_path, video_filename)):
-        os.makedirs(os.path.join(output_path, video_filename), exist_ok=True)
-    # metadata
-    metadata = pd.DataFrame(columns=["filename", "frame_num", "timestamp"])
-    # load video file
-    video = cv2.VideoCapture(path_to_video)
-    # get FPS
-    FPS = video.get(cv2.CAP_PROP_FPS)
-    FPS_in_seconds = 1. / FPS
-    # go through all frames
-    counter = 1
-    previous_face = None
-    last_bbox = None
-    while video.isOpened():
-        ret, frame = video.read()
-        if ret:
-            if (counter-1) % every_n_frame == 0:
-                # convert BGR to RGB
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                # calculate timestamp
-                timestamp = counter * FPS_in_seconds
-                # round it to 2 digits to make it readable
-                timestamp = round(timestamp, 2)
-                # recognize the face
-                bboxes = recognize_faces_bboxes(frame, detector, conf_threshold=0.8)
-                # create new filename for saving the face
-                new_filename = video_filename
-                new_filename = os.path.join(new_filename,
-                                            f"{counter:05}.jpg")
-                # if not recognized, note it as NaN
-                if bboxes is None:
-                    # if there were no face vefore
-                    if previous_face is None:
-                        face = np.zeros((224,224,3), dtype=np.uint8)
-                        bbox = None
-                    else:
-                        # save previous face
-                        face = previous_face
-                        bbox = last_bbox
-                else:
-                    # otherwise, extract the face and save it
-                    if keep_the_same_person and last_bbox is not None:
-                        # if we want to keep the same person, then we need to calculate the distances between the
-                        # center of the previous bbox and the current ones. Then, choose the closest one.
-                        bbox = get_bbox_closest_to_previous_bbox(bboxes, last_bbox)
-                    else:
-                        # otherwise, take the most confident one
-                        bbox = get_most_confident_person(bboxes)
-                    # extract face according to bbox
-                    face = extract_face_according_bbox(frame, bbox)
-                # create full path to the output file
-                output_filename = os.path.join(output_path, new_filename)
-                # save extracted face
-                Image.fromarray(face).save(output_filename)
-                metadata = pd.concat([metadata,
-                                      pd.DataFrame.from_records([{
-                                          "filename": output_filename,
-                                          "frame_num": counter,
-                                          "timestamp": timestamp}
-                                      ])
-                                      ], ignore_index=True)
-                # save previous face and bbox
-                previous_face = face
-                last_bbox = bbox
-            # increment counter
-            counter += 1
-        else:
-            break
+    consumer = FaceExtractionConsumer(detector, output_path, keep_the_same_person, num_writers, detect_every_k)
+    metadata, = process_video_with_consumers(path_to_video, [consumer], every_n_frame, batch_size)
     return metadata
 
 
 def extract_faces_from_all_videos(paths_to_videos:List[str], detector:object, output_path:str, keep_the_same_person:Optional[bool]=False,
-                                  every_n_frame:Optional[int]=1)->pd.DataFrame:
+                                  every_n_frame:Optional[int]=1, batch_size:Optional[int]=32,
+                                  num_writers:Optional[int]=4, detect_every_k:Optional[int]=1)->pd.DataFrame:
     """ Extracts faces from all videos and saves them to the output path. Also, generates dataframe with information about every video.
 
     :param paths_to_videos: List[str]
@@ -130,6 +207,12 @@ def extract_faces_from_all_videos(paths_to_videos:List[str], detector:object, ou
             bounding boxes.
     :param every_n_frame: int
             extract faces from every n-th frame
+    :param batch_size: int
+            number of frames processed by the detector at once
+    :param num_writers: int
+            number of threads for saving of the faces
+    :param detect_every_k: int
+            run the detector every k-th extracted frame and track the face in between. 1 means detection on every frame.
     :return: pd.DataFrame
             dataframe with information about the extracted faces (all videos are included)
     """
@@ -141,7 +224,8 @@ def extract_faces_from_all_videos(paths_to_videos:List[str], detector:object, ou
     # go through all videos
     for path_to_video in tqdm(paths_to_videos, desc="Extracting faces from videos..."):
         # extract faces from one video
-        metadata_one_video = extract_face_one_video(path_to_video, detector, output_path, keep_the_same_person, every_n_frame)
+        metadata_one_video = extract_face_one_video(path_to_video, detector, output_path, keep_the_same_person, every_n_frame,
+                                                    batch_size, num_writers, detect_every_k)
         # add metadata from one video to the main metadata
         metadata = pd.concat([metadata, metadata_one_video], ignore_index=True, axis=0)
         # print
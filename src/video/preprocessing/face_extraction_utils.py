@@ -69,6 +69,47 @@ def extract_face_according_bbox(img:np.ndarray, bbox:List[float])->np.ndarray:
     return img[y1:y2, x1:x2]
 
 
+def extract_faces_according_bboxes(imgs:List[np.ndarray], bboxes:List[List[float]])->List[np.ndarray]:
+    """
+    Extracts (crops) batch of images according provided bounding boxes. The coordinates of all crops are computed
+    at once, the results are the same as of extract_face_according_bbox applied to every image.
+    :param imgs: List[np.ndarray]
+            list of images represented by np.ndarray
+    :param bboxes: List[List[float]]
+            list of bounding boxes (one per image). Every bbox is a list of 5 floats: the bounding box of face and its confidence
+    :return: List[np.ndarray]
+            list of images represented by np.ndarray (views of the provided images)
+    """
+    if len(imgs) == 0:
+        return []
+    # take a little more than the bounding box. The dtype of bboxes is kept as in extract_face_according_bbox
+    coords = np.asarray([bbox[:4] for bbox in bboxes])
+    coords = (coords + np.array([-10, -10, 10, 10], dtype=coords.dtype)).astype(int)
+    # check if the bounding boxes are out of the images
+    sizes = np.array([[img.shape[1], img.shape[0]] for img in imgs])
+    coords[:, :2] = np.maximum(coords[:, :2], 0)
+    coords[:, 2:] = np.minimum(coords[:, 2:], sizes)
+    return [img[y1:y2, x1:x2] for img, (x1, y1, x2, y2) in zip(imgs, coords)]
+
+
+def filter_recognized_faces(recognized_faces:np.ndarray, conf_threshold:float=0.8)->Tuple[List[float],...]:
+    """
+    Filters faces recognized by the detector with confidence threshold.
+    :param recognized_faces: np.ndarray
+            faces recognized by the detector (bounding box of face and its confidence for every face)
+    :param conf_threshold: float
+            faces with confidence less than threshold are filtered out
+    :return: Tuple[List[float],...]
+            recognized faces or None if there are no faces
+    """
+    # filter faces with confidence less than threshold
+    recognized_faces = [face for face in recognized_faces if face[4] > conf_threshold]
+    recognized_faces = tuple(recognized_faces)
+    if recognized_faces is None or len(recognized_faces) == 0:
+        return None # no faces recognized
+    return recognized_faces
+
+
 def recognize_faces_bboxes(img:Union[np.ndarray, str], detector:RetinafaceDetector.detect_faces, conf_threshold:float=0.8)->Tuple[List[float],...]:
     """
     Recognizes the faces in provided image and return the face with the highest confidence.
@@ -82,12 +123,28 @@ def recognize_faces_bboxes(img:Union[np.ndarray, str], detector:RetinafaceDetect
     if type(img) is str:
         img = np.array(Image.open(img))
     recognized_faces = detector(img)
-    # filter faces with confidence less than threshold
-    recognized_faces = [face for face in recognized_faces if face[4] > conf_threshold]
-    recognized_faces = tuple(recognized_faces)
-    if recognized_faces is None or len(recognized_faces) == 0:
-        return None # no faces recognized
-    return recognized_faces
+    return filter_recognized_faces(recognized_faces, conf_threshold)
+
+
+def recognize_faces_bboxes_batch(imgs:List[np.ndarray], detector:RetinafaceDetector.detect_faces,
+                                 conf_threshold:float=0.8)->List[Tuple[List[float],...]]:
+    """
+    Recognizes the faces in provided batch of images. If the detector is RetinafaceDetector.detect_faces and
+    all images have the same size, the whole batch is processed by RetinafaceDetector.detect_faces_batch
+    with one forward pass. Otherwise, recognize_faces_bboxes is applied to every image.
+    :param imgs: List[np.ndarray]
+            list of images represented by np.ndarray
+    :param detector: object
+            the model, which has method detect. It should return bounding boxes and landmarks.
+    :param conf_threshold: float
+            faces with confidence less than threshold are filtered out
+    :return: List[Tuple[List[float],...]]
+            recognized faces for every image (None if no faces were recognized)
+    """
+    batch_detector = getattr(getattr(detector, '__self__', None), 'detect_faces_batch', None)
+    if batch_detector is None or len(set(img.shape for img in imgs)) != 1:
+        return [recognize_faces_bboxes(img, detector, conf_threshold) for img in imgs]
+    return [filter_recognized_faces(recognized_faces, conf_threshold) for recognized_faces in batch_detector(np.stack(imgs))]
 
 
 def get_bbox_closest_to_previous_bbox(faces_bboxes:Tuple[List[float],...], previous_bbox:List[float])->List[float]:
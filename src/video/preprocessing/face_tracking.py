@@ -0,0 +1,187 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.video.preprocessing.face_extraction_utils import recognize_faces_bboxes, recognize_faces_bboxes_batch, \
+    get_bbox_closest_to_previous_bbox, get_most_confident_person
+
+
+logger = logging.getLogger(__name__)
+
+def calculate_iou(bbox_1:np.ndarray, bbox_2:np.ndarray)->float:
+    """ Calculates intersection over union of two bounding boxes (x1, y1, x2, y2, ...).
+
+    :param bbox_1: np.ndarray
+            first bounding box
+    :param bbox_2: np.ndarray
+            second bounding box
+    :return: float
+            intersection over union
+    """
+    w = max(0., min(bbox_1[2], bbox_2[2]) - max(bbox_1[0], bbox_2[0]))
+    h = max(0., min(bbox_1[3], bbox_2[3]) - max(bbox_1[1], bbox_2[1]))
+    inter = w * h
+    union = (bbox_1[2] - bbox_1[0]) * (bbox_1[3] - bbox_1[1]) + (bbox_2[2] - bbox_2[0]) * (bbox_2[3] - bbox_2[1]) - inter
+    return float(inter / union) if union > 0 else 0.
+
+
+class FaceTracker:
+    """ Tracks the face between detections, so the detector runs only every K frames.
+    Between detections, the bounding box is extrapolated with the constant velocity estimated from
+    the last two detections (velocity is clamped to `max_velocity` of the box size per frame).
+    The detector runs again on the next frame if:
+        - K frames passed since the last detection
+        - the scene is cut (mean absolute difference of downscaled grayscale frames is more than `scene_cut_threshold`)
+        - the confidence of the last detection is less than `min_confidence`
+        - there is no face to track
+    On every detection, IoU between the extrapolated box and the detected one is recorded, so the crop drift
+    is measured on the frames where it is the largest (see get_drift_statistics).
+
+    For every frame, the tracker returns a tuple with one bbox (the chosen person) or None, the same format
+    as recognize_faces_bboxes.
+
+    :param detect_every_k: int
+            run the detector every k-th frame
+    :param keep_the_same_person: bool
+            if True, the detected bbox closest to the tracked one is chosen, otherwise the most confident one.
+    :param conf_threshold: float
+            faces with confidence less than threshold are filtered out
+    :param min_confidence: float
+            if the confidence of the chosen face is less than min_confidence, the detector runs on the next frame
+    :param scene_cut_threshold: float
+            threshold for mean absolute difference of downscaled grayscale frames (0..255)
+    :param max_velocity: float
+            maximal shift of the box per frame as a fraction of the box size
+    :param downscale: int
+            downscale factor of frames for the scene cut detection
+    """
+    def __init__(self, detect_every_k:int=5, keep_the_same_person:bool=True, conf_threshold:float=0.8,
+                 min_confidence:float=0.95, scene_cut_threshold:float=30., max_velocity:float=0.1, downscale:int=8):
+        self.detect_every_k = detect_every_k
+        self.keep_the_same_person = keep_the_same_person
+        self.conf_threshold = conf_threshold
+        self.min_confidence = min_confidence
+        self.scene_cut_threshold = scene_cut_threshold
+        self.max_velocity = max_velocity
+        self.downscale = downscale
+        self.reset()
+
+    def reset(self)->None:
+        """ Resets the state of the tracker. Should be called for every new video. """
+        self.last_bbox = None
+        self.velocity = None
+        self.frames_since_detection = 0
+        self.last_small_frame = None
+        self.need_detection = True
+        self.num_frames = 0
+        self.num_detections = 0
+        self.drift_ious = []
+
+    def __downscale(self, frames:List[np.ndarray])->np.ndarray:
+        """ Downscales frames and converts them to grayscale for the scene cut detection. """
+        return np.stack([frame[::self.downscale, ::self.downscale] for frame in frames]).mean(axis=-1)
+
+    def __predict(self)->np.ndarray:
+        """ Extrapolates the last detected bbox to the current frame. """
+        bbox = np.array(self.last_bbox, dtype=np.float32)
+        if self.velocity is not None:
+            bbox[:4] += self.velocity * self.frames_since_detection
+        return bbox
+
+    def __update_with_detection(self, bboxes:Optional[Tuple[np.ndarray, ...]])->Optional[Tuple[np.ndarray]]:
+        """ Updates the state of the tracker with the detected bboxes and returns the chosen one. """
+        self.num_detections += 1
+        if bboxes is None:
+            # the face is lost, the detector will run on the next frame
+            self.need_detection = True
+            self.frames_since_detection += 1
+            return None
+        predicted = self.__predict() if self.last_bbox is not None else None
+        if self.keep_the_same_person and predicted is not None:
+            bbox = np.array(get_bbox_closest_to_previous_bbox(bboxes, predicted), dtype=np.float32)
+        else:
+            bbox = np.array(get_most_confident_person(bboxes), dtype=np.float32)
+        if predicted is not None:
+            # the drift is measured in both modes of choosing the person
+            self.drift_ious.append(calculate_iou(predicted, bbox))
+        if self.last_bbox is not None and self.frames_since_detection > 0:
+            velocity = (bbox[:4] - self.last_bbox[:4]) / self.frames_since_detection
+            size = np.tile(bbox[2:4] - bbox[:2], 2)
+            self.velocity = np.clip(velocity, -self.max_velocity * size, self.max_velocity * size)
+        else:
+            self.velocity = None
+        self.last_bbox = bbox
+        self.frames_since_detection = 0
+        self.need_detection = bbox[4] < self.min_confidence
+        return (bbox,)
+
+    def track_batch(self, frames:List[np.ndarray], detector:object)->List[Optional[Tuple[np.ndarray]]]:
+        """ Tracks the face in the batch of consecutive frames. Frames, on which the detector should run
+        according to the schedule and scene cuts, are processed by the detector as one batch. If the detector
+        is needed on other frames (low confidence or lost face), it runs on them separately.
+
+        :param frames: List[np.ndarray]
+                batch of consecutive RGB frames
+        :param detector: object
+                the model that generates bboxes from facial images.
+        :return: List[Optional[Tuple[np.ndarray]]]
+                tuple with the chosen bbox for every frame or None if there is no face
+        """
+        small_frames = self.__downscale(frames)
+        previous_small_frames = np.concatenate([small_frames[:1] if self.last_small_frame is None
+                                                else self.last_small_frame[np.newaxis], small_frames[:-1]])
+        scene_cuts = np.abs(small_frames - previous_small_frames).mean(axis=(1, 2)) > self.scene_cut_threshold
+        self.last_small_frame = small_frames[-1]
+        # frames scheduled for the detection (assuming that detections happen only on them)
+        scheduled = []
+        frames_since_detection = self.frames_since_detection
+        need_detection = self.need_detection
+        for idx in range(len(frames)):
+            if need_detection or scene_cuts[idx] or frames_since_detection + 1 >= self.detect_every_k:
+                scheduled.append(idx)
+                frames_since_detection, need_detection = 0, False
+            else:
+                frames_since_detection += 1
+        detected = dict(zip(scheduled, recognize_faces_bboxes_batch([frames[idx] for idx in scheduled], detector,
+                                                                    conf_threshold=self.conf_threshold)))
+        # go through frames sequentially
+        results = []
+        for idx, frame in enumerate(frames):
+            self.num_frames += 1
+            if self.last_bbox is None or self.need_detection or scene_cuts[idx] or \
+                    self.frames_since_detection + 1 >= self.detect_every_k or idx in detected:
+                if idx not in detected:
+                    detected[idx] = recognize_faces_bboxes(frame, detector, conf_threshold=self.conf_threshold)
+                results.append(self.__update_with_detection(detected[idx]))
+            else:
+                self.frames_since_detection += 1
+                results.append((self.__predict(),))
+        return results
+
+    def get_drift_statistics(self)->Dict[str, float]:
+        """ Returns statistics of the tracking: fraction of frames processed by the detector and IoU between
+        extrapolated and detected bboxes (the crop drift right before the detection).
+
+        :return: Dict[str, float]
+                detection_rate, num_drift_measurements, min_iou, mean_iou. IoU values are NaN
+                if there were no detections with the tracked face (f.e. the face is detected on every frame).
+        """
+        return {
+            'detection_rate': self.num_detections / max(1, self.num_frames),
+            'num_drift_measurements': len(self.drift_ious),
+            'min_iou': float(np.min(self.drift_ious)) if self.drift_ious else float('nan'),
+            'mean_iou': float(np.mean(self.drift_ious)) if self.drift_ious else float('nan'),
+        }
+
+    def log_drift_statistics(self, video_name:str)->Dict[str, float]:
+        """ Logs the statistics of the tracking of the video (see get_drift_statistics) and returns them.
+
+        :param video_name: str
+                name of the video for the log message
+        :return: Dict[str, float]
+                detection_rate, num_drift_measurements, min_iou, mean_iou
+        """
+        statistics = self.get_drift_statistics()
+        logger.info("Tracking statistics of %s: %s", video_name, statistics)
+        return statistics
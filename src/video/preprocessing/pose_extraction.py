@@ -6,7 +6,7 @@ sys.path.append("/nfs/scripts/simple-HRNet-master/")
 
 import glob
 import os
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 import pandas as pd
 import torch
@@ -20,83 +20,87 @@ from tqdm import tqdm
 from SimpleHRNet import SimpleHRNet
 from src.video.preprocessing.pose_extraction_utils import get_bboxes_for_frame, get_bbox_closest_to_previous_bbox, \
     apply_bbox_to_frame
+from src.video.preprocessing.row_buffer import ColumnarRowBuffer
+from src.video.preprocessing.shared_video_pass import FrameConsumer, process_video_with_consumers
+
+
+class PoseExtractionConsumer(FrameConsumer):
+    """ Consumer of the shared video pass, which extracts poses (crops of the person) and saves them to
+    the output path. Also, generates dataframe with information about the extracted poses.
+
+    :param detector: object
+            HRNet model, which generates bboxes of persons from frames.
+    :param output_path: str
+            path to the output directory
+    :param keep_the_same_person: bool
+            if True, then the function will try to keep the same person along the frames by comparing positions of the
+            bounding boxes.
+    """
+    def __init__(self, detector:object, output_path:str, keep_the_same_person:Optional[bool]=False):
+        self.detector = detector
+        self.output_path = output_path
+        self.keep_the_same_person = keep_the_same_person
+
+    def start(self, video_info:Dict[str, object])->None:
+        self.video_filename = video_info["video_name"]
+        # create output directory if needed
+        if not os.path.exists(os.path.join(self.output_path, self.video_filename)):
+            os.makedirs(os.path.join(self.output_path, self.video_filename), exist_ok=True)
+        # metadata is accumulated in columns
+        self.metadata = ColumnarRowBuffer({"filename": object, "frame_num": np.int64, "timestamp": np.float64})
+        self.FPS_in_seconds = 1. / video_info["fps"]
+        self.previous_pose = None
+        self.last_bbox = None
+
+    def process_batch(self, frame_nums:List[int], frames:List[np.ndarray])->None:
+        for counter, frame in zip(frame_nums, frames):
+            # HRNet works with BGR frames (it converts them to RGB in prediction function)
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            # calculate timestamp and round it to 2 digits to make it readable
+            timestamp = round(counter * self.FPS_in_seconds, 2)
+            # recognize the pose
+            bboxes = get_bboxes_for_frame(extractor=self.detector, frame=frame)
+            # if not recognized, note it as NaN
+            if bboxes is None:
+                # if there were no face before
+                if self.previous_pose is None:
+                    pose = np.zeros((224, 224, 3), dtype=np.uint8)
+                    bbox = None
+                else:
+                    # save previous face
+                    pose = self.previous_pose
+                    bbox = self.last_bbox
+            else:
+                # otherwise, extract the face and save it
+                if self.keep_the_same_person and self.last_bbox is not None:
+                    # if we want to keep the same person, then we need to calculate the distances between the
+                    # center of the previous bbox and the current ones. Then, choose the closest one.
+                    bbox = get_bbox_closest_to_previous_bbox(bboxes, self.last_bbox)
+                else:
+                    # otherwise, take the first one, since we do not have confidences
+                    bbox = bboxes[0]
+                # extract face according to bbox
+                pose = apply_bbox_to_frame(frame, bbox)
+            # create full path to the output file
+            output_filename = os.path.join(self.output_path, self.video_filename, f"{counter:05}.jpg")
+            # transform image to RGB
+            pose = cv2.cvtColor(pose, cv2.COLOR_BGR2RGB)
+            # save extracted face
+            Image.fromarray(pose).save(output_filename)
+            self.metadata.append(filename=output_filename, frame_num=counter, timestamp=timestamp)
+            # save previous face and bbox
+            self.previous_pose = pose
+            self.last_bbox = bbox
+
+    def finish(self)->pd.DataFrame:
+        return self.metadata.to_dataframe()
 
 
 def extract_pose_one_video(path_to_video: str, detector: object, output_path: str,
                            keep_the_same_person: Optional[bool] = False,
                            every_n_frame: Optional[int] = 1) -> pd.DataFrame:
-    video_filename = os.path.basename(path_to_video).split(".")[0]
-    # create output directory if needed
-    if not os.path.exists(os.path.join(output_path, video_filename)):
-        os.makedirs(os.path.join(output_path, video_filename), exist_ok=True)
-    # metadata
-    metadata = pd.DataFrame(columns=["filename", "frame_num", "timestamp"])
-    # load video file
-    video = cv2.VideoCapture(path_to_video)
-    # get FPS
-    FPS = video.get(cv2.CAP_PROP_FPS)
-    FPS_in_seconds = 1. / FPS
-    # go through all frames
-    counter = 1
-    previous_pose = None
-    last_bbox = None
-    while video.isOpened():
-        ret, frame = video.read()
-        if ret:
-            if (counter - 1) % every_n_frame == 0:
-                # convert BGR to RGB
-                #frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) # HRNet does it in prediction function
-                # calculate timestamp
-                timestamp = counter * FPS_in_seconds
-                # round it to 2 digits to make it readable
-                timestamp = round(timestamp, 2)
-                # recognize the pose
-                bboxes =  get_bboxes_for_frame(extractor=detector, frame=frame)
-                # create new filename for saving the face
-                new_filename = video_filename
-                new_filename = os.path.join(new_filename,
-                                            f"{counter:05}.jpg")
-                # if not recognized, note it as NaN
-                if bboxes is None:
-                    # if there were no face before
-                    if previous_pose is None:
-                        pose = np.zeros((224, 224, 3), dtype=np.uint8)
-                        bbox = None
-                    else:
-                        # save previous face
-                        pose = previous_pose
-                        bbox = last_bbox
-                else:
-                    # otherwise, extract the face and save it
-                    if keep_the_same_person and last_bbox is not None:
-                        # if we want to keep the same person, then we need to calculate the distances between the
-                        # center of the previous bbox and the current ones. Then, choose the closest one.
-                        bbox = get_bbox_closest_to_previous_bbox(bboxes, last_bbox)
-                    else:
-                        # otherwise, take the first one, since we do not have confidences
-                        bbox =  bboxes[0]
-                    # extract face according to bbox
-                    pose =  apply_bbox_to_frame(frame, bbox)
-                # create full path to the output file
-                output_filename = os.path.join(output_path, new_filename)
-                # transform image to RGB
-                pose = cv2.cvtColor(pose, cv2.COLOR_BGR2RGB)
-                # save extracted face
-                Image.fromarray(pose).save(output_filename)
-                metadata = pd.concat([metadata,
-                                      pd.DataFrame.from_records([{
-                                          "filename": output_filename,
-                                          "frame_num": counter,
-                                          "timestamp": timestamp}
-                                      ])
-                                      ], ignore_index=True)
-                # save previous face and bbox
-                previous_pose = pose
-                last_bbox = bbox
-            # increment counter
-            counter += 1
-        else:
-            break
+    consumer = PoseExtractionConsumer(detector, output_path, keep_the_same_person)
+    metadata, = process_video_with_consumers(path_to_video, [consumer], every_n_frame)
     return metadata
 
 
@@ -1,66 +1,94 @@
 from __future__ import print_function
 
+from functools import partial
+
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 
 from .data import cfg_mnet
-from .layers.functions.prior_box import PriorBox
+from .layers.functions.prior_box import PriorBoxCache
 from .loader import load_model
 from .utils.box_utils import decode, decode_landm
-from .utils.nms.py_cpu_nms import py_cpu_nms
+from .utils.nms import NMS_BACKENDS, torch_nms
 
 
 class RetinafaceDetector:
-    def __init__(self, net='mnet', type='cuda'):
+    def __init__(self, net='mnet', type='cuda', nms_backend='auto'):
         cudnn.benchmark = True
         self.net = net
         self.device = torch.device(type)
         self.model = load_model(self.net).to(self.device)
         self.model.eval()
+        # priors are generated once per image size
+        self.priors_cache = PriorBoxCache()
+        # 'auto', 'py_cpu', 'matrix' or 'torch' (torchvision.ops.nms on the device of the detector)
+        if nms_backend == 'torch':
+            self.nms = partial(torch_nms, device=self.device)
+        else:
+            self.nms = NMS_BACKENDS[nms_backend]
 
     def detect_faces(self, img_raw:np.ndarray, confidence_threshold=0.9, top_k=5000, nms_threshold=0.4, keep_top_k=750, resize=1):
-        img = torch.Tensor(img_raw).float().to(self.device)
-        im_height, im_width = img.shape[:2]
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
+        return self.detect_faces_batch(np.asarray(img_raw)[np.newaxis], confidence_threshold=confidence_threshold,
+                                       top_k=top_k, nms_threshold=nms_threshold, keep_top_k=keep_top_k,
+                                       resize=resize)[0]
+
+    def detect_faces_batch(self, frames, confidence_threshold=0.9, top_k=5000, nms_threshold=0.4, keep_top_k=750,
+                           resize=1, return_landmarks=False):
+        """Detects faces in the batch of frames with one forward pass.
+        Boxes (and landmarks) of the whole batch are decoded at once, NMS is applied to every frame.
+
+        frames: uint8 (or float) NHWC batch as np.ndarray or torch.Tensor (f.e. in pinned memory).
+        Returns list with detections (K x 5: x1, y1, x2, y2, score) for every frame,
+        or list of (detections, landmarks (K x 10)) if return_landmarks is True.
+        """
+        if isinstance(frames, np.ndarray):
+            frames = torch.from_numpy(np.ascontiguousarray(frames))
+        frames = frames.to(self.device, non_blocking=True)
+        im_height, im_width = frames.shape[1:3]
+        scale = torch.Tensor([im_width, im_height, im_width, im_height])
         scale = scale.to(self.device)
 
-        img = torch.subtract(img, torch.Tensor((104., 117., 123.)).to(self.device))
-        img = img.permute(2, 0, 1)
-        img = img.unsqueeze(0)
-
-
+        img = torch.subtract(frames.float(), torch.Tensor((104., 117., 123.)).to(self.device))
+        img = img.permute(0, 3, 1, 2)
 
         with torch.no_grad():
             loc, conf, landms = self.model(img)  # forward pass
 
-        priorbox = PriorBox(cfg_mnet, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(self.device)
+        priors = self.priors_cache(cfg_mnet, (im_height, im_width), self.device)
         prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, cfg_mnet['variance'])
+        boxes = decode(loc.data, prior_data, cfg_mnet['variance'])
         boxes = boxes * scale / resize
         boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-
-        # ignore low scores
-        inds = np.where(scores > confidence_threshold)[0]
-        boxes = boxes[inds]
-        scores = scores[inds]
-
-        # keep top-K before NMS
-        order = scores.argsort()[::-1][:top_k]
-        boxes = boxes[order]
-        scores = scores[order]
-
-        # do NMS
-        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = py_cpu_nms(dets, nms_threshold)
-        # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
-        dets = dets[keep, :]
-
-        # keep top-K faster NMS
-        dets = dets[:keep_top_k, :]
-
-        return dets
-
+        scores = conf.data.cpu().numpy()[:, :, 1]
+        if return_landmarks:
+            scale_landm = torch.Tensor([im_width, im_height] * 5).to(self.device)
+            landms = decode_landm(landms.data, prior_data, cfg_mnet['variance'])
+            landms = landms * scale_landm / resize
+            landms = landms.cpu().numpy()
+
+        results = []
+        for idx in range(len(boxes)):
+            # ignore low scores
+            inds = np.where(scores[idx] > confidence_threshold)[0]
+            frame_boxes = boxes[idx][inds]
+            frame_scores = scores[idx][inds]
+
+            # keep top-K before NMS
+            order = frame_scores.argsort()[::-1][:top_k]
+            frame_boxes = frame_boxes[order]
+            frame_scores = frame_scores[order]
+
+            # do NMS
+            dets = np.hstack((frame_boxes, frame_scores[:, np.newaxis])).astype(np.float32, copy=False)
+            keep = self.nms(dets, nms_threshold)
+            dets = dets[keep, :]
+
+            # keep top-K faster NMS
+            dets = dets[:keep_top_k, :]
+            if return_landmarks:
+                results.append((dets, landms[idx][inds][order][keep][:keep_top_k]))
+            else:
+                results.append(dets)
+
+        return results
@@ -1,6 +1,7 @@
-from itertools import product as product
+from collections import OrderedDict
 from math import ceil
 
+import numpy as np
 import torch
 
 
@@ -17,18 +18,52 @@ class PriorBox(object):
     def forward(self):
         anchors = []
         for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [x * self.steps[k] / self.image_size[1] for x in [j + 0.5]]
-                    dense_cy = [y * self.steps[k] / self.image_size[0] for y in [i + 0.5]]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
+            min_sizes = np.asarray(self.min_sizes[k], dtype=np.float64)
+            # anchors are ordered by (i, j, min_size) as in the nested loops of the original implementation
+            dense_cy, dense_cx = np.meshgrid((np.arange(f[0]) + 0.5) * self.steps[k] / self.image_size[0],
+                                             (np.arange(f[1]) + 0.5) * self.steps[k] / self.image_size[1],
+                                             indexing='ij')
+            num_cells, num_sizes = dense_cx.size, len(min_sizes)
+            anchors.append(np.stack([
+                np.repeat(dense_cx.reshape(-1), num_sizes),
+                np.repeat(dense_cy.reshape(-1), num_sizes),
+                np.tile(min_sizes / self.image_size[1], num_cells),
+                np.tile(min_sizes / self.image_size[0], num_cells),
+            ], axis=1))
 
         # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
+        output = torch.from_numpy(np.concatenate(anchors).astype(np.float32))
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
+
+
+class PriorBoxCache(object):
+    """LRU cache of priors keyed by (height, width, cfg). All frames of a video have the same size,
+    so priors are generated once per image size. Returned priors are shared and should not be modified in-place.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.priors = OrderedDict()
+
+    @staticmethod
+    def get_key(cfg, image_size, device=None):
+        return (int(image_size[0]), int(image_size[1]), cfg['name'],
+                tuple(tuple(min_sizes) for min_sizes in cfg['min_sizes']), tuple(cfg['steps']), cfg['clip'],
+                str(device))
+
+    def __call__(self, cfg, image_size, device=None):
+        key = self.get_key(cfg, image_size, device)
+        if key in self.priors:
+            self.priors.move_to_end(key)
+            return self.priors[key]
+
+        priors = PriorBox(cfg, image_size=image_size).forward()
+        if device is not None:
+            priors = priors.to(device)
+
+        self.priors[key] = priors
+        if len(self.priors) > self.maxsize:
+            self.priors.popitem(last=False)
+
+        return priors
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 from ...data import cfg_mnet
 from ...utils.box_utils import match, log_sum_exp
+from ..functions.prior_box import PriorBoxCache
 
 GPU = cfg_mnet['gpu_train']
 
@@ -32,7 +33,7 @@ class MultiBoxLoss(nn.Module):
     """
 
     def __init__(self, num_classes, overlap_thresh, prior_for_matching, bkg_label, neg_mining, neg_pos, neg_overlap,
-                 encode_target):
+                 encode_target, cfg=cfg_mnet):
         super(MultiBoxLoss, self).__init__()
         self.num_classes = num_classes
         self.threshold = overlap_thresh
@@ -43,6 +44,8 @@ class MultiBoxLoss(nn.Module):
         self.negpos_ratio = neg_pos
         self.neg_overlap = neg_overlap
         self.variance = [0.1, 0.2]
+        self.cfg = cfg
+        self.priors_cache = PriorBoxCache()
 
     def forward(self, predictions, priors, targets):
         """Multibox Loss
@@ -51,14 +54,16 @@ class MultiBoxLoss(nn.Module):
             and prior boxes from SSD net.
                 conf shape: torch.size(batch_size,num_priors,num_classes)
                 loc shape: torch.size(batch_size,num_priors,4)
-                priors shape: torch.size(num_priors,4)
+                priors shape: torch.size(num_priors,4) or image size (height, width).
+                If image size is given, priors are taken from the cache of priors
 
             ground_truth (tensor): Ground truth boxes and labels for a batch,
                 shape: [batch_size,num_objs,5] (last idx is the label).
         """
 
         loc_data, conf_data, landm_data = predictions
-        priors = priors
+        if not torch.is_tensor(priors):
+            priors = self.priors_cache(self.cfg, priors, loc_data.device)
         num = loc_data.size(0)
         num_priors = (priors.size(0))
 
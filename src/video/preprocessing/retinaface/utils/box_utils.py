@@ -211,19 +211,19 @@ def decode(loc, priors, variances):
     the encoding we did for offset regression at train time.
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
+            Shape: [num_priors,4] or [batch_size,num_priors,4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
-        decoded bounding box predictions
+        decoded bounding box predictions with the same shape as loc
     """
 
     boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+        priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+        priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 def decode_landm(pre, priors, variances):
@@ -231,19 +231,19 @@ def decode_landm(pre, priors, variances):
     the encoding we did for offset regression at train time.
     Args:
         pre (tensor): landm predictions for loc layers,
-            Shape: [num_priors,10]
+            Shape: [num_priors,10] or [batch_size,num_priors,10]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
-        decoded landm predictions
+        decoded landm predictions with the same shape as pre
     """
-    landms = torch.cat((priors[:, :2] + pre[:, :2] * variances[0] * priors[:, 2:],
-                        priors[:, :2] + pre[:, 2:4] * variances[0] * priors[:, 2:],
-                        priors[:, :2] + pre[:, 4:6] * variances[0] * priors[:, 2:],
-                        priors[:, :2] + pre[:, 6:8] * variances[0] * priors[:, 2:],
-                        priors[:, :2] + pre[:, 8:10] * variances[0] * priors[:, 2:],
-                        ), dim=1)
+    landms = torch.cat((priors[..., :2] + pre[..., :2] * variances[0] * priors[..., 2:],
+                        priors[..., :2] + pre[..., 2:4] * variances[0] * priors[..., 2:],
+                        priors[..., :2] + pre[..., 4:6] * variances[0] * priors[..., 2:],
+                        priors[..., :2] + pre[..., 6:8] * variances[0] * priors[..., 2:],
+                        priors[..., :2] + pre[..., 8:10] * variances[0] * priors[..., 2:],
+                        ), dim=-1)
     return landms
 
 
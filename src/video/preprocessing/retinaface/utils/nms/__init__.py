@@ -0,0 +1,22 @@
+from .py_cpu_nms import py_cpu_nms
+from .matrix_nms import matrix_cpu_nms, torch_nms
+
+# maximal number of boxes for matrix_cpu_nms in 'auto' mode (memory is O(N^2))
+MATRIX_NMS_MAX_BOXES = 512
+
+
+def auto_nms(dets, thresh):
+    """Uses matrix_cpu_nms for small number of boxes and py_cpu_nms otherwise. Kept boxes are the same."""
+    if len(dets) <= MATRIX_NMS_MAX_BOXES:
+        return matrix_cpu_nms(dets, thresh)
+    return py_cpu_nms(dets, thresh)
+
+
+NMS_BACKENDS = {
+    'auto': auto_nms,
+    'py_cpu': py_cpu_nms,
+    'matrix': matrix_cpu_nms,
+    'torch': torch_nms,
+}
+
+__all__ = ['py_cpu_nms', 'matrix_cpu_nms', 'torch_nms', 'auto_nms', 'NMS_BACKENDS']
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of NMS backends. Compares time of every backend with py_cpu_nms (the reference) and checks
+that all backends keep the same set of boxes.
+
+Detections are read from .npz file, where every array contains detections of one frame before NMS
+(N x 5: x1, y1, x2, y2, score), f.e. `dets` of RetinafaceDetector.detect_faces recorded on AffWild2 videos.
+If the file is not provided, random clustered detections are generated.
+
+Usage: python benchmark_nms.py [path_to_detections.npz] [nms_threshold]
+"""
+import sys
+import time
+
+import numpy as np
+
+from py_cpu_nms import py_cpu_nms
+from matrix_nms import matrix_cpu_nms, torch_nms
+
+
+def generate_detections(num_frames=200, max_faces=5, boxes_per_face=20, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(num_frames):
+        dets = []
+        for _ in range(rng.integers(1, max_faces + 1)):
+            x1, y1 = rng.uniform(0, 1500), rng.uniform(0, 800)
+            size = rng.uniform(30, 300)
+            boxes = np.array([x1, y1, x1 + size, y1 + size]) + rng.normal(0, size * 0.1, (boxes_per_face, 4))
+            scores = rng.uniform(0.9, 1., (boxes_per_face, 1))
+            dets.append(np.hstack((boxes, scores)))
+        frames.append(np.concatenate(dets).astype(np.float32))
+    return frames
+
+
+def run_backend(nms_fn, frames, thresh):
+    start = time.perf_counter()
+    keeps = [nms_fn(dets, thresh) for dets in frames]
+    return time.perf_counter() - start, keeps
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        recorded = np.load(sys.argv[1])
+        frames = [recorded[key].astype(np.float32) for key in recorded.files]
+    else:
+        frames = generate_detections()
+    thresh = float(sys.argv[2]) if len(sys.argv) > 2 else 0.4
+
+    backends = {'py_cpu': py_cpu_nms, 'matrix': matrix_cpu_nms}
+    try:
+        import torchvision
+        backends['torch'] = torch_nms
+    except ImportError:
+        print('torchvision is not available, torch backend is skipped')
+
+    num_boxes = np.array([len(dets) for dets in frames])
+    print('frames: {0}, boxes per frame: mean {1:.1f}, max {2}'.format(len(frames), num_boxes.mean(), num_boxes.max()))
+
+    ref_time, ref_keeps = run_backend(py_cpu_nms, frames, thresh)
+    for name, nms_fn in backends.items():
+        backend_time, keeps = run_backend(nms_fn, frames, thresh)
+        same = all(set(map(int, k)) == set(map(int, r)) for k, r in zip(keeps, ref_keeps))
+        print('{0:>8}: {1:.4f} s, x{2:.1f}, same kept boxes: {3}'.format(name, backend_time, ref_time / backend_time, same))
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def matrix_cpu_nms(dets, thresh):
+    """Vectorized NMS. Overlaps of all pairs of boxes are computed at once with the same formulas as
+    in py_cpu_nms, so the kept boxes are the same. Memory is O(N^2), use it for small N."""
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+    x1, y1, x2, y2, areas = x1[order], y1[order], x2[order], y2[order], areas[order]
+
+    # pairwise overlaps of boxes sorted by score
+    xx1 = np.maximum(x1[:, np.newaxis], x1[np.newaxis, :])
+    yy1 = np.maximum(y1[:, np.newaxis], y1[np.newaxis, :])
+    xx2 = np.minimum(x2[:, np.newaxis], x2[np.newaxis, :])
+    yy2 = np.minimum(y2[:, np.newaxis], y2[np.newaxis, :])
+
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    ovr = inter / (areas[:, np.newaxis] + areas[np.newaxis, :] - inter)
+    suppress = ovr > thresh
+
+    keep = []
+    remaining = np.arange(len(order))
+    while remaining.size > 0:
+        i = remaining[0]
+        keep.append(order[i])
+        remaining = remaining[1:][~suppress[i, remaining[1:]]]
+
+    return keep
+
+
+def torch_nms(dets, thresh, device=None):
+    """NMS with torchvision.ops.nms on the device. Boxes are shifted by +1 on (x2, y2),
+    so the overlaps are the same as in py_cpu_nms."""
+    import torch
+    from torchvision.ops import nms
+
+    dets = torch.as_tensor(dets, device=device)
+    boxes = dets[:, :4].clone()
+    boxes[:, 2:] += 1
+    keep = nms(boxes.float(), dets[:, 4].float(), thresh)
+    return keep.cpu().numpy().tolist()
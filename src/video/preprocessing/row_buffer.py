@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+class ColumnarRowBuffer:
+    """ Accumulates rows in preallocated NumPy arrays (one array per column) and converts them to the DataFrame
+    (or Arrow table) once at the end. The arrays grow geometrically, so appending of n rows costs O(n) in total
+    instead of O(n^2) of appending rows to the DataFrame with pd.concat.
+
+    Columns are described by the ordered dict name -> dtype. A block of columns (f.e. embeddings) is described
+    by name -> (size, dtype). The block is stored as 2D array and expanded to the columns name_0, ..., name_{size-1}.
+    Example:
+        buffer = ColumnarRowBuffer({"video_name": object, "frame_num": np.int64, "timestep": np.float64,
+                                    "facial_embedding": (256, np.float32)})
+        buffer.append(video_name="video1", frame_num=1, timestep=0.03, facial_embedding=embeddings)
+        metadata = buffer.to_dataframe()
+
+    :param columns: Dict[str, Union[type, Tuple[int, type]]]
+            ordered description of the columns
+    :param initial_capacity: int
+            number of preallocated rows
+    :param growth_factor: float
+            the capacity is multiplied by the growth_factor when the buffer is full
+    """
+    def __init__(self, columns:Dict[str, Union[type, Tuple[int, type]]], initial_capacity:int=1024,
+                 growth_factor:float=2.):
+        self.columns = OrderedDict(
+            (name, (spec[0], np.dtype(spec[1])) if isinstance(spec, tuple) else (None, np.dtype(spec)))
+            for name, spec in columns.items())
+        self.growth_factor = growth_factor
+        self.capacity = max(1, initial_capacity)
+        self.size = 0
+        self.data = {name: self.__allocate(block_size, dtype, self.capacity)
+                     for name, (block_size, dtype) in self.columns.items()}
+
+    @staticmethod
+    def __allocate(block_size:Union[int, None], dtype:np.dtype, capacity:int)->np.ndarray:
+        shape = (capacity,) if block_size is None else (capacity, block_size)
+        return np.empty(shape, dtype=dtype)
+
+    def __len__(self)->int:
+        return self.size
+
+    def __grow(self, min_capacity:int)->None:
+        """ Reallocates all arrays with the larger capacity. """
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity = max(capacity + 1, int(capacity * self.growth_factor))
+        for name, (block_size, dtype) in self.columns.items():
+            array = self.__allocate(block_size, dtype, capacity)
+            array[:self.size] = self.data[name][:self.size]
+            self.data[name] = array
+        self.capacity = capacity
+
+    def append(self, **row)->None:
+        """ Appends one row. Values of all columns should be provided. """
+        if self.size == self.capacity:
+            self.__grow(self.size + 1)
+        for name in self.columns:
+            self.data[name][self.size] = row[name]
+        self.size += 1
+
+    def extend(self, **rows)->None:
+        """ Appends several rows at once. Every value is an array with the rows of one column (or block). """
+        num_rows = len(next(iter(rows.values())))
+        if self.size + num_rows > self.capacity:
+            self.__grow(self.size + num_rows)
+        for name in self.columns:
+            self.data[name][self.size:self.size + num_rows] = rows[name]
+        self.size += num_rows
+
+    def get_column_names(self)->list:
+        """ Returns names of all columns (blocks are expanded). """
+        names = []
+        for name, (block_size, _) in self.columns.items():
+            names.extend([name] if block_size is None else [f"{name}_{i}" for i in range(block_size)])
+        return names
+
+    def to_dict(self)->Dict[str, np.ndarray]:
+        """ Returns the filled part of the arrays as dict column name -> 1D array (blocks are expanded). """
+        result = {}
+        for name, (block_size, _) in self.columns.items():
+            array = self.data[name][:self.size]
+            if block_size is None:
+                result[name] = array
+            else:
+                result.update({f"{name}_{i}": array[:, i] for i in range(block_size)})
+        return result
+
+    def to_dataframe(self)->pd.DataFrame:
+        """ Materializes the buffer as the DataFrame. """
+        result = pd.DataFrame(self.to_dict(), columns=self.get_column_names())
+        return result
+
+    def to_arrow(self)->"pyarrow.Table":
+        """ Materializes the buffer as the Arrow table. Requires pyarrow. """
+        import pyarrow as pa
+        return pa.table(self.to_dict())
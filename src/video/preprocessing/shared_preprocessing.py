@@ -0,0 +1,114 @@
+import sys
+sys.path.append("/nfs/scripts/ABAW_2023_SIU/")
+sys.path.append("/nfs/scripts/datatools/")
+sys.path.append("/nfs/scripts/simple-HRNet-master/")
+
+import glob
+import os
+from typing import Optional, List, Dict
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from src.video.preprocessing.face_extraction import FaceExtractionConsumer
+from src.video.preprocessing.face_extraction_utils import load_and_prepare_detector_retinaFace_mobileNet
+from src.video.preprocessing.pose_extraction import PoseExtractionConsumer
+from src.video.preprocessing.shared_video_pass import FrameConsumer, process_video_with_consumers
+
+
+def preprocess_all_videos_in_one_pass(paths_to_videos:List[str], face_detector:object, faces_output_path:str,
+                                      pose_detector:Optional[object]=None, poses_output_path:Optional[str]=None,
+                                      path_to_landmarks:Optional[str]=None,
+                                      additional_consumers:Optional[List[FrameConsumer]]=None,
+                                      keep_the_same_person:Optional[bool]=False, every_n_frame:Optional[int]=1,
+                                      batch_size:Optional[int]=32, num_writers:Optional[int]=4,
+                                      detect_every_k:Optional[int]=1)->Dict[str, pd.DataFrame]:
+    """ Extracts faces, poses and mouth open features from all videos decoding every video only once.
+    The outputs of faces and poses are the same as of face_extraction.extract_faces_from_all_videos and
+    pose_extraction.extract_poses_from_all_videos. Mouth open features have the same format as of
+    audio/open_mouth_features_extraction.extract_surface_area, but they are calculated on the unaligned face crops
+    of the detector in memory instead of the aligned face images, so the values differ and are not interchangeable
+    with the features of extract_surface_area. Do not write them to the same directory.
+
+    :param paths_to_videos: List[str]
+            list of paths to the video files
+    :param face_detector: object
+            the model that generates bboxes from facial images.
+    :param faces_output_path: str
+            path to the output directory for faces
+    :param pose_detector: Optional[object]
+            HRNet model. If None, poses are not extracted.
+    :param poses_output_path: Optional[str]
+            path to the output directory for poses
+    :param path_to_landmarks: Optional[str]
+            path to the output directory for mouth open features. If None, they are not extracted.
+            Should differ from the directory of the features extracted from the aligned images.
+    :param additional_consumers: Optional[List[FrameConsumer]]
+            other consumers of the frames, f.e. embeddings_extraction_dynamic.create_static_embeddings_consumer
+    :param keep_the_same_person: Optional[bool]
+            if True, then the function will try to keep the same person along the frames by comparing the position of the
+            bounding boxes.
+    :param every_n_frame: int
+            extract faces and poses from every n-th frame
+    :param batch_size: int
+            number of frames processed by the face detector at once
+    :param num_writers: int
+            number of threads for saving of the faces
+    :param detect_every_k: int
+            run the face detector every k-th extracted frame and track the face in between.
+    :return: Dict[str, pd.DataFrame]
+            metadata of extracted faces and poses (all videos are included)
+    """
+    face_consumers = []
+    if path_to_landmarks is not None:
+        # MediaPipe is needed only for the mouth open features
+        import mediapipe as mp
+        from src.audio.open_mouth_features_extraction import MouthAreaConsumer
+        face_mesh = mp.solutions.face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True,
+                                                    min_detection_confidence=0.5)
+        face_consumers.append(MouthAreaConsumer(face_mesh, path_to_landmarks))
+    consumers = {"faces": FaceExtractionConsumer(face_detector, faces_output_path, keep_the_same_person, num_writers,
+                                                 detect_every_k, face_consumers)}
+    output_paths = {"faces": faces_output_path}
+    if pose_detector is not None:
+        consumers["poses"] = PoseExtractionConsumer(pose_detector, poses_output_path, keep_the_same_person)
+        output_paths["poses"] = poses_output_path
+    additional_consumers = additional_consumers if additional_consumers is not None else []
+    # create output directories if needed
+    for output_path in output_paths.values():
+        os.makedirs(output_path, exist_ok=True)
+    metadata = {name: [] for name in consumers}
+    for path_to_video in tqdm(paths_to_videos, desc="Preprocessing videos..."):
+        results = process_video_with_consumers(path_to_video, list(consumers.values()) + additional_consumers,
+                                               every_n_frame, batch_size)
+        for name, result in zip(consumers, results):
+            metadata[name].append(result)
+            # save metadata
+            pd.concat(metadata[name], ignore_index=True, axis=0).to_csv(
+                os.path.join(output_paths[name], "metadata.csv"), index=False)
+        print(f"Finished processing {path_to_video}")
+    return {name: pd.concat(metadata_one_type, ignore_index=True, axis=0) if metadata_one_type
+                  else pd.DataFrame(columns=["filename", "frame_num", "timestamp"])
+            for name, metadata_one_type in metadata.items()}
+
+
+if __name__ == "__main__":
+    from SimpleHRNet import SimpleHRNet
+    path_to_data = "/nfs/scratch/Data/ABAW/"
+    # load detectors
+    face_detector = load_and_prepare_detector_retinaFace_mobileNet()
+    pose_detector = SimpleHRNet(c=48, nof_joints=17, multiperson=True,
+                                yolo_version='v3',
+                                yolo_model_def=os.path.join("/nfs/scripts/simple-HRNet-master/", "models_/detectors/yolo/config/yolov3.cfg"),
+                                yolo_class_path=os.path.join("/nfs/scripts/simple-HRNet-master/", "models_/detectors/yolo/data/coco.names"),
+                                yolo_weights_path=os.path.join("/nfs/scripts/simple-HRNet-master/", "models_/detectors/yolo/weights/yolov3.weights"),
+                                checkpoint_path=r"/nfs/scripts/simple-HRNet-master/pose_hrnet_w48_384x288.pth",
+                                return_heatmaps=False, return_bounding_boxes=True, max_batch_size=1, device=torch.device("cuda"))
+    paths_to_videos = glob.glob(os.path.join(path_to_data, "*"))
+    preprocess_all_videos_in_one_pass(paths_to_videos, face_detector=face_detector,
+                                      faces_output_path="/nfs/scratch/Data/preprocessed/faces/",
+                                      pose_detector=pose_detector,
+                                      poses_output_path="/nfs/scratch/Data/preprocessed/pose/",
+                                      path_to_landmarks="/features/open_mouth_shared_pass/",
+                                      keep_the_same_person=True, every_n_frame=1)
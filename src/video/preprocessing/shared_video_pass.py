@@ -0,0 +1,177 @@
+"""
+Single-decode video pass with several consumers. The video is decoded once, and the batches of RGB frames are
+broadcast to all registered consumers (face crops, pose crops, mouth area, embeddings) through bounded queues.
+Every consumer works in its own thread, so the slowest consumer limits the decoding speed, while the number
+of decoded frames in memory is limited by the size of the queues.
+
+Frames are shared between consumers and should not be modified in-place.
+"""
+import os
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+
+class FrameConsumer:
+    """ Base class of the consumers of the shared video pass. For every video, start is called before
+    the decoding, process_batch is called for every batch of frames (in the thread of the consumer)
+    and finish is called after the last batch. The result of finish is returned by process_video_with_consumers.
+    """
+
+    def start(self, video_info:Dict[str, object])->None:
+        """ Prepares the consumer for the new video.
+
+        :param video_info: Dict[str, object]
+                information about the video: path_to_video, video_name, fps and num_frames
+        :return: None
+        """
+        pass
+
+    def process_batch(self, frame_nums:List[int], frames:List[np.ndarray])->None:
+        """ Processes the batch of frames.
+
+        :param frame_nums: List[int]
+                numbers of frames (starting from 1)
+        :param frames: List[np.ndarray]
+                RGB frames
+        :return: None
+        """
+        raise NotImplementedError
+
+    def finish(self)->object:
+        """ Finishes the processing of the video and returns the result of the consumer. """
+        return None
+
+
+class CallbackConsumer(FrameConsumer):
+    """ Consumer, which calls provided functions. Useful if the processing is defined by closures.
+
+    :param process_batch: Callable[[List[int], List[np.ndarray]], None]
+            function, which processes the batch of frame numbers and frames
+    :param start: Optional[Callable[[Dict[str, object]], None]]
+            function, which prepares the processing of the new video
+    :param finish: Optional[Callable[[], object]]
+            function, which finishes the processing of the video and returns the result
+    """
+
+    def __init__(self, process_batch:Callable[[List[int], List[np.ndarray]], None],
+                 start:Optional[Callable[[Dict[str, object]], None]]=None, finish:Optional[Callable[[], object]]=None):
+        self.process_batch_fn = process_batch
+        self.start_fn = start
+        self.finish_fn = finish
+
+    def start(self, video_info:Dict[str, object])->None:
+        if self.start_fn is not None:
+            self.start_fn(video_info)
+
+    def process_batch(self, frame_nums:List[int], frames:List[np.ndarray])->None:
+        self.process_batch_fn(frame_nums, frames)
+
+    def finish(self)->object:
+        return self.finish_fn() if self.finish_fn is not None else None
+
+
+class BroadcastQueue:
+    """ Puts every item to all queues. Used as the output queue of the decoder. """
+
+    def __init__(self, queues:List[queue.Queue]):
+        self.queues = queues
+
+    def put(self, item:object)->None:
+        for consumer_queue in self.queues:
+            consumer_queue.put(item)
+
+
+def decode_video_frames(video:cv2.VideoCapture, frames_queue:queue.Queue, every_n_frame:int=1, batch_size:int=32)->None:
+    """ Decodes video frames and puts them to the queue in batches.
+    Every batch is a tuple of frame numbers (starting from 1) and RGB frames. None is put to the queue at the end.
+
+    :param video: cv2.VideoCapture
+            opened video file
+    :param frames_queue: queue.Queue
+            bounded queue for the batches of frames
+    :param every_n_frame: int
+            take every n-th frame
+    :param batch_size: int
+            number of frames in one batch
+    :return: None
+    """
+    counter = 1
+    frame_nums, frames = [], []
+    try:
+        while video.isOpened():
+            ret, frame = video.read()
+            if not ret:
+                break
+            if (counter-1) % every_n_frame == 0:
+                frame_nums.append(counter)
+                # convert BGR to RGB
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                if len(frames) == batch_size:
+                    frames_queue.put((frame_nums, frames))
+                    frame_nums, frames = [], []
+            counter += 1
+        if len(frames) > 0:
+            frames_queue.put((frame_nums, frames))
+    finally:
+        video.release()
+        frames_queue.put(None)
+
+
+def __consume_frames(consumer:FrameConsumer, frames_queue:queue.Queue, errors:List[Optional[BaseException]],
+                     idx:int)->None:
+    """ Thread of one consumer. If the consumer fails, the queue is still drained, so the decoder is not blocked. """
+    while True:
+        batch = frames_queue.get()
+        if batch is None:
+            break
+        if errors[idx] is not None:
+            continue
+        try:
+            consumer.process_batch(*batch)
+        except BaseException as error:
+            errors[idx] = error
+
+
+def process_video_with_consumers(path_to_video:str, consumers:List[FrameConsumer], every_n_frame:Optional[int]=1,
+                                 batch_size:Optional[int]=32, queue_size:Optional[int]=4)->List[object]:
+    """ Decodes the video once and passes the batches of frames to all consumers.
+
+    :param path_to_video: str
+            path to the video file
+    :param consumers: List[FrameConsumer]
+            consumers of the frames
+    :param every_n_frame: int
+            take every n-th frame
+    :param batch_size: int
+            number of frames in one batch
+    :param queue_size: int
+            maximal number of batches waiting in the queue of every consumer
+    :return: List[object]
+            results of the consumers (in the same order as consumers)
+    """
+    video = cv2.VideoCapture(path_to_video)
+    video_info = {"path_to_video": path_to_video,
+                  "video_name": os.path.basename(path_to_video).split(".")[0],
+                  "fps": video.get(cv2.CAP_PROP_FPS),
+                  "num_frames": int(video.get(cv2.CAP_PROP_FRAME_COUNT))}
+    for consumer in consumers:
+        consumer.start(video_info)
+    queues = [queue.Queue(maxsize=queue_size) for _ in consumers]
+    errors = [None] * len(consumers)
+    workers = [threading.Thread(target=__consume_frames, args=(consumer, consumer_queue, errors, idx), daemon=True)
+               for idx, (consumer, consumer_queue) in enumerate(zip(consumers, queues))]
+    for worker in workers:
+        worker.start()
+    # decode in the current thread, the bounded queues stop the decoder if consumers are slow
+    decode_video_frames(video, BroadcastQueue(queues), every_n_frame, batch_size)
+    for worker in workers:
+        worker.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return [consumer.finish() for consumer in consumers]
+
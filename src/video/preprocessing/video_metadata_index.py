@@ -0,0 +1,192 @@
+import os
+import pickle
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import cv2
+import pandas as pd
+from tqdm import tqdm
+
+
+INDEX_FILENAME = '.video_metadata.csv'
+INDEX_COLUMNS = ['filename', 'name', 'path', 'size', 'mtime_ns', 'fps', 'num_frames', 'duration', 'audio_sr']
+
+
+def probe_audio_sample_rate(path_to_video:str)->int:
+    """ Gets the sample rate of the first audio stream of the video using ffprobe.
+
+    :param path_to_video: str
+            path to the video file
+    :return: int
+            sample rate of the audio stream. 0 if the video has no audio stream or ffprobe is not available.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=sample_rate',
+               '-of', 'default=noprint_wrappers=1:nokey=1', path_to_video]
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return int(output) if output.isdigit() else 0
+
+
+def probe_video(path_to_video:str, probe_audio:bool=True)->Dict[str, float]:
+    """ Gets metadata of the video: fps, number of frames, duration and sample rate of the audio.
+
+    :param path_to_video: str
+            path to the video file
+    :param probe_audio: bool
+            if True, the audio sample rate is obtained using ffprobe. Otherwise, it is set to 0.
+    :return: Dict[str, float]
+            dictionary with fps, num_frames, duration and audio_sr of the video
+    """
+    cap = cv2.VideoCapture(path_to_video)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    num_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    # release the video capture
+    cap.release()
+    return {
+        'fps': fps,
+        'num_frames': num_frames,
+        'duration': num_frames / fps if fps > 0 else 0.,
+        'audio_sr': probe_audio_sample_rate(path_to_video) if probe_audio else 0,
+    }
+
+
+class VideoMetadataIndex:
+    """ Persistent index of the video metadata: filename -> (path, fps, frame count, duration, audio sample rate).
+    The index is stored as a small csv table (by default, in the videos directory) and is built only once.
+    On every load, the directory is scanned once and only new or changed videos (by size and mtime) are probed,
+    in parallel. Removed videos are dropped from the index.
+
+    :param path_to_videos: str
+            path to the folder with videos
+    :param index_path: Optional[str]
+            path to the index csv file. If None, the index is stored in the folder with videos.
+    :param num_workers: int
+            number of threads for probing of videos
+    :param probe_audio: bool
+            if True, the audio sample rate is obtained using ffprobe.
+    """
+    def __init__(self, path_to_videos:str, index_path:Optional[str]=None, num_workers:int=8, probe_audio:bool=True):
+        self.path_to_videos = path_to_videos
+        self.index_path = index_path if index_path else os.path.join(path_to_videos, INDEX_FILENAME)
+        self.num_workers = num_workers
+        self.probe_audio = probe_audio
+        self.table = self.__update()
+        # lookup tables
+        self.__by_filename = {row['filename']: row for row in self.table.to_dict('records')}
+        self.__by_name = {}
+        for row in sorted(self.__by_filename.values(), key=lambda x: x['filename']):
+            self.__by_name.setdefault(row['name'], row)
+
+    def __scan(self)->List[os.DirEntry]:
+        """ Scans the folder with videos once. Hidden files (and the index itself) are skipped. """
+        with os.scandir(self.path_to_videos) as it:
+            return [entry for entry in it if entry.is_file() and not entry.name.startswith('.')]
+
+    def __update(self)->pd.DataFrame:
+        """ Loads the index from disk, probes new and changed videos and saves the index if it was changed. """
+        if os.path.exists(self.index_path):
+            table = pd.read_csv(self.index_path, dtype={'filename': str, 'name': str, 'path': str})
+        else:
+            table = pd.DataFrame(columns=INDEX_COLUMNS)
+
+        stats = {entry.name: entry.stat() for entry in self.__scan()}
+        num_indexed = len(table)
+        table = table[table['filename'].isin(stats.keys())]
+        # videos are valid if their size and modification time are not changed
+        is_valid = [(row.size, row.mtime_ns) == (stats[row.filename].st_size, stats[row.filename].st_mtime_ns)
+                    for row in table.itertuples()]
+        valid_table = table[is_valid] if len(table) > 0 else table
+        to_probe = sorted(set(stats.keys()) - set(valid_table['filename']))
+        if len(to_probe) == 0 and len(valid_table) == num_indexed:
+            return valid_table.reset_index(drop=True)
+
+        paths = [os.path.join(self.path_to_videos, filename) for filename in to_probe]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            probed = list(tqdm(executor.map(lambda x: probe_video(x, self.probe_audio), paths),
+                               total=len(paths), desc='Probing videos'))
+        new_rows = pd.DataFrame([{
+            'filename': filename,
+            'name': filename.split('.')[0],
+            'path': path,
+            'size': stats[filename].st_size,
+            'mtime_ns': stats[filename].st_mtime_ns,
+            **metadata,
+        } for filename, path, metadata in zip(to_probe, paths, probed)], columns=INDEX_COLUMNS)
+        table = pd.concat([valid_table, new_rows], ignore_index=True) if len(valid_table) > 0 else new_rows
+        table = table.sort_values('filename').reset_index(drop=True)
+        self.__save(table)
+        return table
+
+    def __save(self, table:pd.DataFrame)->None:
+        """ Saves the index atomically. If the folder is read-only, the index is kept only in memory. """
+        tmp_path = '{0}.{1}.tmp'.format(self.index_path, os.getpid())
+        try:
+            table.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def get(self, filename:str)->Dict[str, float]:
+        """ Returns metadata of the video by its filename (with extension).
+
+        :param filename: str
+                filename of the video
+        :return: Dict[str, float]
+                metadata of the video (filename, name, path, size, mtime_ns, fps, num_frames, duration, audio_sr)
+        """
+        return self.__by_filename[filename]
+
+    def find(self, name:str)->Optional[Dict[str, float]]:
+        """ Returns metadata of the video by its name (filename without extension).
+        If there are several videos with the same name, the first one (sorted by filename) is returned.
+
+        :param name: str
+                name of the video
+        :return: Optional[Dict[str, float]]
+                metadata of the video or None if there is no such video
+        """
+        return self.__by_name.get(name, None)
+
+    def get_fps_dict(self)->Dict[str, float]:
+        """ Returns a dictionary with fps for all videos, with filenames (with extension) as keys.
+
+        :return: Dict[str, float]
+                dictionary with filenames as keys and fps as values.
+        """
+        return dict(zip(self.table['filename'], self.table['fps']))
+
+
+def read_fps_dict(path:str)->Dict[str, float]:
+    """ Reads a dictionary with fps for all videos from the video metadata index.
+
+    :param path: str
+            path to the index csv file or path to the folder with videos (the index is updated in this case).
+    :return: Dict[str, float]
+            dictionary with filenames (with extension) as keys and fps as values.
+    """
+    if os.path.isdir(path):
+        return VideoMetadataIndex(path).get_fps_dict()
+    table = pd.read_csv(path, dtype={'filename': str})
+    return dict(zip(table['filename'], table['fps']))
+
+
+def load_fps_file(path_to_fps_file:str)->Dict[str, float]:
+    """ Loads the video_to_fps file from the provided path. This is the only loader of the fps metadata:
+    the training and post-processing modules import it from here.
+
+    :param path_to_fps_file: str
+        Path to the video_to_fps file (.pkl). Also, it can be the path to the video metadata index (.csv)
+        or to the folder with videos (the video metadata index of the folder is used).
+    :return: Dict[str, float]
+        Dictionary with video names (without extension) as keys and fps as values.
+    """
+    if path_to_fps_file.endswith('.pkl'):
+        with open(path_to_fps_file, 'rb') as f:
+            fps_dict = pickle.load(f)
+    else:
+        fps_dict = read_fps_dict(path_to_fps_file)
+    fps_dict = {''.join(key.split('.')[:-1]): value for key, value in fps_dict.items()}
+    return fps_dict
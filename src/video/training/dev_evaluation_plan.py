@@ -0,0 +1,176 @@
+"""
+Precomputed evaluation on the development set. Everything except the model predictions is the same in every epoch:
+the windows of the dev videos, averaging of the predictions of the overlapping windows, the interpolation to 100 FPS
+and the synchronization with the ground truth. DevEvaluationPlan keeps all of it as index arrays, so the evaluation
+after every epoch is a batched forward pass over all windows plus several vectorized gathers and reductions.
+
+The result is the same as of cutting every video on windows, __average_predictions_on_timesteps and
+evaluate_predictions_on_dev_set_full_fps (see evaluation_development.py).
+"""
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import torch
+
+from src.evaluation_dynamic import calculate_metric_on_dev_set, get_interpolation_to_100_fps_indices, \
+    timesteps_to_centiseconds, TimestepAlignment
+from src.hamming_smoothing import apply_hamming_smoothing
+from src.video.training.temporal_window_index import TemporalWindowIndex, get_video_window_starts
+
+
+class DevEvaluationPlan:
+    """ Precomputed indices for the evaluation on the development set (see create_dev_evaluation_plan).
+
+    :param features: Dict[str, torch.Tensor]
+        group name -> features of all frames of all videos (with zero padding), stored on the device
+    :param window_rows: torch.Tensor
+        rows of the features for every window. Shape: (num_windows, window_size)
+    :param timestep_indices: np.ndarray
+        index of the averaged prediction for every prediction of the model (flattened). Shape: (num_predictions,)
+    :param num_timesteps: int
+        number of averaged predictions (unique timesteps of all videos)
+    :param interpolation: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        lower and upper indices of the averaged predictions, offsets and distances for the interpolation to 100 FPS
+        of every synchronized timestep (see get_interpolation_to_100_fps_indices)
+    :param labels: np.ndarray
+        synchronized ground truth of all videos
+    :param video_bounds: List[Tuple[int, int]]
+        start and end of every video in the synchronized arrays
+    :param smoothing_window_sizes: List[float]
+        size of the hamming window for every video
+    :param labels_type: str
+        The type of the labels. Either "Exp" or "VA".
+    """
+    def __init__(self, features:Dict[str, torch.Tensor], window_rows:torch.Tensor, timestep_indices:np.ndarray,
+                 num_timesteps:int, interpolation:Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+                 labels:np.ndarray, video_bounds:List[Tuple[int, int]], smoothing_window_sizes:List[float],
+                 labels_type:str):
+        self.features = features
+        self.window_rows = window_rows
+        self.timestep_indices = timestep_indices
+        self.timestep_counts = np.bincount(timestep_indices, minlength=num_timesteps)
+        self.num_timesteps = num_timesteps
+        self.interpolation = interpolation
+        self.labels = labels
+        self.video_bounds = video_bounds
+        self.smoothing_window_sizes = smoothing_window_sizes
+        self.labels_type = labels_type
+
+    def __len__(self)->int:
+        return len(self.window_rows)
+
+
+def create_dev_evaluation_plan(dev_set_full_fps:Dict[str, pd.DataFrame], dev_set_resampled:Dict[str, pd.DataFrame],
+                               column_groups:Dict[str, List[str]], labels_type:str, window_size:int, stride:int,
+                               device:torch.device, downgrade_to_1_fps:Optional[bool]=None)->DevEvaluationPlan:
+    """ Precomputes the evaluation on the development set. Should be called once before the training.
+
+    :param dev_set_full_fps: Dict[str, pd.DataFrame]
+        The labels with full fps. The dataframes have columns ["timestep", ...] + labels columns.
+    :param dev_set_resampled: Dict[str, pd.DataFrame]
+        The resampled dev set with features, which is cut on windows.
+    :param column_groups: Dict[str, List[str]]
+        Groups of feature columns (group name -> columns), one group per input of the model.
+    :param labels_type: str
+        The type of the labels. Either "Exp" or "VA".
+    :param window_size: int
+        Size of the window. Given in number of frames.
+    :param stride: int
+        Stride of the window. Given in number of frames.
+    :param device: torch.device
+        The device to store the features on.
+    :param downgrade_to_1_fps: Optional[bool]
+        If not False, the model makes predictions for every 5th frame of the window.
+    :return: DevEvaluationPlan
+    """
+    labels_columns = [f"category_{i}" for i in range(8)] if labels_type == 'Exp' else ["valence", "arousal"]
+    groups = dict((name, (columns, np.float32)) for name, columns in column_groups.items())
+    groups['timestep'] = ('timestep', np.float64)
+    windows = TemporalWindowIndex.from_dataframes(
+        dev_set_resampled, groups, window_size,
+        starts_fn=lambda video: get_video_window_starts(video['frame_num'].values, window_size=window_size, stride=stride))
+    # all videos are concatenated, windows are given as rows of the concatenated arrays
+    video_offsets = np.cumsum([0] + [len(video['timestep']) for video in windows.videos])
+    window_rows = video_offsets[windows.windows[:, 0]][:, np.newaxis] + windows.windows[:, 1:2] + np.arange(window_size)
+    features = {name: torch.from_numpy(np.concatenate([video[name] for video in windows.videos])).to(device)
+                for name in column_groups}
+    window_timesteps = np.concatenate([video['timestep'] for video in windows.videos])[window_rows]
+    if downgrade_to_1_fps is not False:
+        window_timesteps = window_timesteps[:, 4::5]
+
+    timestep_indices = np.zeros(window_timesteps.size, dtype=np.int64)
+    interpolation, labels, video_bounds, smoothing_window_sizes = [], [], [], []
+    num_timesteps, num_synchronized = 0, 0
+    for video_id, video_name in enumerate(windows.video_keys):
+        # averaging of the predictions on the same timesteps (see __average_predictions_on_timesteps)
+        video_windows = windows.windows[:, 0] == video_id
+        mask = np.repeat(video_windows, window_timesteps.shape[1])
+        unique_keys, inverse = np.unique(timesteps_to_centiseconds(window_timesteps[video_windows].reshape((-1,))),
+                                         return_inverse=True)
+        timestep_indices[mask] = inverse.reshape((-1,)) + num_timesteps
+        prediction_timesteps = unique_keys / 100.
+        averaged_indices = np.arange(len(unique_keys)) + num_timesteps
+        num_timesteps += len(unique_keys)
+        # the timestep 0 of the zero padding does not correspond to any frame, such prediction is removed
+        num_frames = dev_set_resampled[video_name]['timestep'].isin(prediction_timesteps).sum()
+        if num_frames != len(prediction_timesteps):
+            prediction_timesteps = prediction_timesteps[1:]
+            averaged_indices = averaged_indices[1:]
+        # interpolation to 100 fps and synchronization with the ground truth (see evaluate_predictions_on_dev_set_full_fps)
+        ground_truth_timesteps = np.round(dev_set_full_fps[video_name]['timestep'].values, 2)
+        fps = 1 / min(np.diff(ground_truth_timesteps))
+        grid_timesteps, lower, upper, offsets, distances = \
+            get_interpolation_to_100_fps_indices(np.round(prediction_timesteps, 2))
+        grid_indices, ground_truth_indices = TimestepAlignment.calculate_indices(
+            timesteps_to_centiseconds(grid_timesteps), timesteps_to_centiseconds(ground_truth_timesteps))
+        interpolation.append((averaged_indices[lower[grid_indices]], averaged_indices[upper[grid_indices]],
+                              offsets[grid_indices], distances[grid_indices]))
+        labels.append(dev_set_full_fps[video_name][labels_columns].values[ground_truth_indices])
+        video_bounds.append((num_synchronized, num_synchronized + len(grid_indices)))
+        smoothing_window_sizes.append(fps // 2)
+        num_synchronized += len(grid_indices)
+    interpolation = tuple(np.concatenate(item) for item in zip(*interpolation))
+    return DevEvaluationPlan(features=features, window_rows=torch.from_numpy(window_rows).to(device),
+                             timestep_indices=timestep_indices, num_timesteps=num_timesteps,
+                             interpolation=interpolation, labels=np.concatenate(labels, axis=0),
+                             video_bounds=video_bounds, smoothing_window_sizes=smoothing_window_sizes,
+                             labels_type=labels_type)
+
+
+def evaluate_with_dev_evaluation_plan(plan:DevEvaluationPlan, predict_fn:Callable[..., torch.Tensor],
+                                      batch_size:int=32)->Union[float, Tuple[float, float]]:
+    """ Evaluates the model on the development set using the precomputed plan.
+
+    :param plan: DevEvaluationPlan
+        The plan created by create_dev_evaluation_plan.
+    :param predict_fn: Callable[..., torch.Tensor]
+        Function, which gets the batches of windows of every group of features (in the order of column_groups)
+        and returns predictions of the model. Shape: (batch_size, num_timesteps, num_classes or 2)
+    :param batch_size: int
+        Number of windows in one batch.
+    :return: Union[float, Tuple[float, float]]
+        Either F1 score or CCC scores.
+    """
+    predictions = []
+    with torch.no_grad():
+        for window_idx in range(0, len(plan), batch_size):
+            rows = plan.window_rows[window_idx:window_idx + batch_size]
+            batch_predictions = predict_fn(*[features[rows] for features in plan.features.values()])
+            predictions.append(batch_predictions.detach().cpu().numpy())
+    predictions = np.concatenate(predictions, axis=0)
+    predictions = predictions.reshape((-1, predictions.shape[-1]))
+    # average the predictions of the overlapping windows
+    averaged_predictions = np.stack([np.bincount(plan.timestep_indices, weights=predictions[:, i],
+                                                 minlength=plan.num_timesteps)
+                                     for i in range(predictions.shape[-1])], axis=1) / plan.timestep_counts[:, np.newaxis]
+    # interpolate to 100 fps only the timesteps synchronized with the ground truth
+    lower, upper, offsets, distances = plan.interpolation
+    lower_values, upper_values = averaged_predictions[lower], averaged_predictions[upper]
+    synchronized_predictions = (upper_values - lower_values) / distances[:, np.newaxis] * offsets[:, np.newaxis] \
+                               + lower_values
+    # apply hamming window to every video
+    for (start, end), smoothing_window_size in zip(plan.video_bounds, plan.smoothing_window_sizes):
+        synchronized_predictions[start:end] = apply_hamming_smoothing(synchronized_predictions[start:end],
+                                                                      smoothing_window_size=smoothing_window_size)
+    return calculate_metric_on_dev_set(synchronized_predictions, plan.labels, plan.labels_type)
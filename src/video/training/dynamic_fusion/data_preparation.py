@@ -11,15 +11,19 @@ import torch
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from tqdm import tqdm
 from pytorch_utils.data_loaders.TemporalEmbeddingsLoader import TemporalEmbeddingsLoader
+from src.video.post_processing.embedding_store import read_embeddings_table
+from src.video.preprocessing.video_metadata_index import load_fps_file
 from src.video.training.dynamic_fusion.FusionDataLoader import FusionDataLoader
 
 
 def load_train_dev(config)-> Tuple[pd.DataFrame, pd.DataFrame]:
     # load train and dev data
-    train_facial = pd.read_csv(config['train_embeddings_facial'])
-    dev_facial = pd.read_csv(config['dev_embeddings_facial'])
-    train_kinesics = pd.read_csv(config['train_embeddings_kinesics'])
-    dev_kinesics = pd.read_csv(config['dev_embeddings_kinesics'])
+    # if the embeddings are in the EmbeddingStore, the kinesics embeddings are the pose embeddings
+    num_classes = config.get('num_classes', 8)
+    train_facial = read_embeddings_table(config['train_embeddings_facial'], 'facial', num_classes)
+    dev_facial = read_embeddings_table(config['dev_embeddings_facial'], 'facial', num_classes)
+    train_kinesics = read_embeddings_table(config['train_embeddings_kinesics'], 'pose', num_classes)
+    dev_kinesics = read_embeddings_table(config['dev_embeddings_kinesics'], 'pose', num_classes)
     # create video_name column
     train_facial["video_name"] = train_facial["path"].apply(lambda x: x.split("/")[-2])
     dev_facial["video_name"] = dev_facial["path"].apply(lambda x: x.split("/")[-2])
@@ -227,19 +231,6 @@ def get_dev_resampled_and_full_fps_dicts(config:dict)->Tuple[Dict[str, pd.DataFr
     return dev_resampled, dev_full_fps
 
 
-def load_fps_file(path_to_fps_file:str)->Dict[str, float]:
-    """ Loads the video_to_fps file from the provided path.
-
-    :param path_to_fps_file: str
-        Path to the video_to_fps file.
-    :return: Dict[str, float]
-        Dictionary with video names as keys and fps as values.
-    """
-    with open(path_to_fps_file, 'rb') as f:
-        fps_dict = pickle.load(f)
-        fps_dict = {''.join(key.split('.')[:-1]): value for key, value in fps_dict.items()}
-    return fps_dict
-
 
 
 def __calculate_class_weights(df, labels_columns)->torch.Tensor:
@@ -21,7 +21,8 @@ import numpy as np
 
 from src.video.training.dynamic_fusion.data_preparation import load_fps_file, get_train_dev_dataloaders, \
     get_dev_resampled_and_full_fps_dicts
-from src.video.training.dynamic_fusion.evaluation_development import evaluate_on_dev_set_full_fps
+from src.video.training.dynamic_fusion.evaluation_development import evaluate_on_dev_set_full_fps, \
+    create_dev_set_evaluation_plan
 from src.video.training.dynamic_fusion.models import VisualFusionModel_v1, VisualFusionModel_v2
 
 from src.video.training.dynamic_fusion.training_utils import train_epoch
@@ -130,6 +131,11 @@ def train_model(train_generator: torch.utils.data.DataLoader,
     early_stopping_callback = TorchEarlyStopping(verbose=True, patience=config.early_stopping_patience,
                                                  save_path=config.best_model_save_path,
                                                  mode="max")
+    # windows, averaging and synchronization with labels of the dev set are the same in every epoch
+    dev_evaluation_plan = create_dev_set_evaluation_plan(dev_data_full_fps, dev_data_resampled, config.challenge,
+                                                         config.feature_columns_mod1, config.feature_columns_mod2,
+                                                         window_size=config.window_size, device=device,
+                                                         downgrade_to_1_fps=True if "1_fps" in config.model_type else False)
     # train model
     for epoch in range(config.num_epochs):
         print("Epoch: %i" % epoch)
@@ -146,13 +152,13 @@ def train_model(train_generator: torch.utils.data.DataLoader,
         model.eval()
         print("Evaluation of the model on dev set.")
         val_metrics = evaluate_on_dev_set_full_fps(dev_set_full_fps=dev_data_full_fps, dev_set_resampled=dev_data_resampled,
-                                 video_to_fps=training_config['video_to_fps_dict'], model=model, labels_type=config.challenge,
+                                 model=model, labels_type=config.challenge,
                                  feature_columns_mod1=config.feature_columns_mod1,
                                  feature_columns_mod2=config.feature_columns_mod2,
-                                 labels_columns=config.labels_columns,
                                  window_size=config.window_size, device=device,
                                  batch_size=config.batch_size,
-                                 downgrade_to_1_fps=True if "1_fps" in config.model_type else False)
+                                 downgrade_to_1_fps=True if "1_fps" in config.model_type else False,
+                                 plan=dev_evaluation_plan)
         print(val_metrics)
 
         # update best val metrics got on validation set and log them using wandb # TODO: write separate function on updating wandb metrics
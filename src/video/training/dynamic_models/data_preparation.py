@@ -1,38 +1,32 @@
-import glob
-import os
 import pickle
 from typing import Tuple, Dict, Optional
 
-import cv2
 import numpy as np
 import pandas as pd
 import torch
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from tqdm import tqdm
 
 from pytorch_utils.data_loaders.TemporalDataLoader import TemporalDataLoader
 from pytorch_utils.data_loaders.TemporalEmbeddingsLoader import TemporalEmbeddingsLoader
+from src.video.post_processing.embedding_store import read_embeddings_table
 from src.video.preprocessing.labels_preprocessing import load_train_dev_AffWild2_labels_with_frame_paths
+from src.video.preprocessing.video_metadata_index import VideoMetadataIndex, load_fps_file
 
 
-def generate_fps_file(path_to_videos:str, output_path:str)->None:
+def generate_fps_file(path_to_videos:str, output_path:str, num_workers:int=8)->None:
     """ Generates a dictionary with fps for all videos in the provided folder and saves it to the output_path
-    as a pickle file.
+    as a pickle file. The fps values are taken from the video metadata index of the folder, so the videos
+    are probed only once (the index is built or updated if needed).
 
     :param path_to_videos: str
         Path to the folder with videos.
     :param output_path: str
         Path for the result dictionary to be saved. Should end with .pkl
+    :param num_workers: int
+        Number of threads for probing of new or changed videos.
     :return: None
     """
-    filenames = glob.glob(os.path.join(path_to_videos, '*'))
-    fps_dict = {}
-    for filename in tqdm(filenames):
-        cap = cv2.VideoCapture(filename)
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        fps_dict[os.path.basename(filename)] = fps
-        # release the video capture
-        cap.release()
+    fps_dict = VideoMetadataIndex(path_to_videos, num_workers=num_workers).get_fps_dict()
 
     with open(output_path, 'wb') as f:
         pickle.dump(fps_dict, f)
@@ -40,8 +34,9 @@ def generate_fps_file(path_to_videos:str, output_path:str)->None:
 
 def load_train_dev(config)-> Tuple[pd.DataFrame, pd.DataFrame]:
     # load train and dev data
-    train = pd.read_csv(config['train_embeddings'])
-    dev = pd.read_csv(config['dev_embeddings'])
+    embeddings_type = config.get('embeddings_type', 'facial') # used if the embeddings are in the EmbeddingStore
+    train = read_embeddings_table(config['train_embeddings'], embeddings_type, config.get('num_classes', 8))
+    dev = read_embeddings_table(config['dev_embeddings'], embeddings_type, config.get('num_classes', 8))
     # round timestamps to two decimal places
     train['timestamp'] = train['timestamp'].apply(lambda x: round(x, 2))
     dev['timestamp'] = dev['timestamp'].apply(lambda x: round(x, 2))
@@ -150,6 +145,8 @@ def get_train_dev_dataloaders(config:dict, get_class_weights:Optional[bool]=Fals
         Dictionary with configuration parameters. It should contain the following keys:
         - train_embeddings: str, path to the train embeddings file
         - dev_embeddings: str, path to the dev embeddings file
+        - embeddings_type: str, optional, 'facial' or 'pose' embeddings taken if the embeddings files are EmbeddingStore
+          directories. Defaults to 'facial'.
         - exp_train_labels_path: str, path to the expression part of the train labels
         - exp_dev_labels_path: str, path to the expression part of the dev labels
         - va_train_labels_path: str, path to the VA part of the train labels
@@ -200,6 +197,8 @@ def get_dev_resampled_and_full_fps_dicts(config:dict)->Tuple[Dict[str, pd.DataFr
         Dictionary with configuration parameters. It should contain the following keys:
         - train_embeddings: str, path to the train embeddings file
         - dev_embeddings: str, path to the dev embeddings file
+        - embeddings_type: str, optional, 'facial' or 'pose' embeddings taken if the embeddings files are EmbeddingStore
+          directories. Defaults to 'facial'.
         - exp_train_labels_path: str, path to the expression part of the train labels
         - exp_dev_labels_path: str, path to the expression part of the dev labels
         - va_train_labels_path: str, path to the VA part of the train labels
@@ -224,19 +223,6 @@ def get_dev_resampled_and_full_fps_dicts(config:dict)->Tuple[Dict[str, pd.DataFr
     return dev_resampled, dev_full_fps
 
 
-def load_fps_file(path_to_fps_file:str)->Dict[str, float]:
-    """ Loads the video_to_fps file from the provided path.
-
-    :param path_to_fps_file: str
-        Path to the video_to_fps file.
-    :return: Dict[str, float]
-        Dictionary with video names as keys and fps as values.
-    """
-    with open(path_to_fps_file, 'rb') as f:
-        fps_dict = pickle.load(f)
-        fps_dict = {''.join(key.split('.')[:-1]): value for key, value in fps_dict.items()}
-    return fps_dict
-
 
 
 def __calculate_class_weights(df, labels_columns)->torch.Tensor:
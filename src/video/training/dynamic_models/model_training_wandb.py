@@ -30,7 +30,8 @@ from src.video.training.dynamic_models.training_utils import train_epoch
 from utils.configuration_loading import load_config_file
 from src.video.training.dynamic_models.data_preparation import get_train_dev_dataloaders, \
     get_dev_resampled_and_full_fps_dicts, load_fps_file
-from src.video.training.dynamic_models.evaluation_development import evaluate_on_dev_set_full_fps
+from src.video.training.dynamic_models.evaluation_development import evaluate_on_dev_set_full_fps, \
+    create_dev_set_evaluation_plan
 
 from src.video.training.dynamic_models.dynamic_models import UniModalTemporalModel_v1, UniModalTemporalModel_v2, \
     UniModalTemporalModel_v3, UniModalTemporalModel_v4, UniModalTemporalModel_v5, UniModalTemporalModel_v6_1_fps, \
@@ -139,6 +140,11 @@ def train_model(train_generator: torch.utils.data.DataLoader,
     early_stopping_callback = TorchEarlyStopping(verbose=True, patience=config.early_stopping_patience,
                                                  save_path=config.best_model_save_path,
                                                  mode="max")
+    # windows, averaging and synchronization with labels of the dev set are the same in every epoch
+    dev_evaluation_plan = create_dev_set_evaluation_plan(dev_data_full_fps, dev_data_resampled, config.challenge,
+                                                         config.feature_columns,
+                                                         window_size=config.window_size, device=device,
+                                                         downgrade_to_1_fps=True if "1_fps" in config.model_type else False)
     # train model
     for epoch in range(config.num_epochs):
         print("Epoch: %i" % epoch)
@@ -155,12 +161,12 @@ def train_model(train_generator: torch.utils.data.DataLoader,
         model.eval()
         print("Evaluation of the model on dev set.")
         val_metrics = evaluate_on_dev_set_full_fps(dev_set_full_fps=dev_data_full_fps, dev_set_resampled=dev_data_resampled,
-                                 video_to_fps=training_config['video_to_fps_dict'], model=model, labels_type=config.challenge,
+                                 model=model, labels_type=config.challenge,
                                  feature_columns=config.feature_columns,
-                                 labels_columns=config.labels_columns,
                                  window_size=config.window_size, device=device,
                                  batch_size=config.batch_size,
-                                 downgrade_to_1_fps=True if "1_fps" in config.model_type else False)
+                                 downgrade_to_1_fps=True if "1_fps" in config.model_type else False,
+                                 plan=dev_evaluation_plan)
         print(val_metrics)
 
         # update best val metrics got on validation set and log them using wandb # TODO: write separate function on updating wandb metrics
@@ -0,0 +1,218 @@
+"""
+Array-backed index of temporal windows. The features of every video are kept as contiguous arrays
+(one array per group of columns), while the windows are stored as integer triples (video_id, start, step).
+A window is a strided view of the video array: rows start, start+step, ..., start+window_size-step.
+Thus, the memory scales with the number of frames instead of windows x window_size x columns.
+
+The functions get_*_window_starts reproduce the window cutting of FusionDataLoader and __cut_video_on_windows
+functions, but compute only the start positions of the windows.
+"""
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+def get_mode_of_differences(values:np.ndarray)->float:
+    """ Calculates the most often difference between consecutive values rounded to 2 digits
+    (the same as values.diff().round(2).mode().values[0] in pandas).
+
+    :param values: np.ndarray
+        1D array of values (f.e. frame numbers)
+    :return: float
+        the most often difference. If there are several, the smallest one is taken.
+    """
+    differences = np.round(np.diff(np.asarray(values, dtype=np.float64)), 2)
+    differences = differences[~np.isnan(differences)]
+    unique_differences, counts = np.unique(differences, return_counts=True)
+    return unique_differences[np.argmax(counts)]
+
+
+def __get_windows_modes_of_differences(values:np.ndarray, starts:np.ndarray, window_size:int)->np.ndarray:
+    """ Calculates get_mode_of_differences for every window at once. """
+    differences = np.round(np.diff(np.asarray(values, dtype=np.float64)), 2)
+    windows = np.sort(np.lib.stride_tricks.sliding_window_view(differences, window_size - 1)[starts], axis=1)
+    # number of occurrences of every value in the window. Since the windows are sorted, argmax gives the smallest mode
+    counts = (windows[:, :, np.newaxis] == windows[:, np.newaxis, :]).sum(axis=2)
+    return windows[np.arange(len(windows)), np.argmax(counts, axis=1)]
+
+
+def get_window_starts(length:int, window_size:int, stride:int)->Union[np.ndarray, None]:
+    """ Start positions of the windows cut with the fixed stride. If there is not enough values to fill the last
+    window, the window starting from length-window_size is added as a last window.
+    (see FusionDataLoader.__cut_sequence_on_windows)
+
+    :param length: int
+        number of values in the sequence
+    :param window_size: int
+        size of the window in number of values
+    :param stride: int
+        stride of the window in number of values
+    :return: Union[np.ndarray, None]
+        start positions of the windows. None if the sequence is shorter than window_size.
+    """
+    if length < window_size:
+        return None
+    starts = np.arange(0, length - window_size + 1, stride)
+    # the start of the first window that does not fit
+    if starts[-1] + stride < length:
+        starts = np.append(starts, length - window_size)
+    return starts
+
+
+def get_consecutive_window_starts(frame_nums:np.ndarray, window_size:int, stride:int)->Union[np.ndarray, None]:
+    """ Start positions of the windows, within which frame numbers increase monotonically with the same step
+    (see FusionDataLoader.__cut_sequence_on_consecutive_windows).
+
+    :param frame_nums: np.ndarray
+        frame numbers of the sequence
+    :param window_size: int
+        size of the window in number of values
+    :param stride: int
+        stride of the window in number of values
+    :return: Union[np.ndarray, None]
+        start positions of the windows. None if the sequence is shorter than window_size.
+    """
+    length = len(frame_nums)
+    if length < window_size:
+        return None
+    frame_nums = np.asarray(frame_nums, dtype=np.float64)
+    starts = np.arange(0, length - window_size + 1, stride)
+    if window_size > 1:
+        actual_ranges = np.round(frame_nums[starts + window_size - 1] - frame_nums[starts], 2)
+        reference_ranges = np.round(__get_windows_modes_of_differences(frame_nums, starts, window_size)
+                                    * (window_size - 1), 2)
+        starts = starts[actual_ranges == reference_ranges]
+    # also add the last window as it is usually ignored
+    start_timestamp, end_timestamp = frame_nums[length - window_size], frame_nums[length - 1]
+    if start_timestamp + (window_size - 1) * (end_timestamp - start_timestamp) == end_timestamp:
+        starts = np.append(starts, length - window_size)
+    return starts
+
+
+def get_video_window_starts(frame_nums:np.ndarray, window_size:int, stride:int,
+                            replace_last:Optional[bool]=True)->Tuple[np.ndarray, int]:
+    """ Start positions of the windows used for the inference on the whole video (see __cut_video_on_windows).
+    Only windows with the same range of frame numbers as the reference one are included. The last window always
+    ends with the last frame. If the video is not longer than window_size, it is padded with zeros at the start.
+
+    :param frame_nums: np.ndarray
+        frame numbers of the video
+    :param window_size: int
+        size of the window in number of frames
+    :param stride: int
+        stride of the window in number of frames
+    :param replace_last: bool
+        if True, the last found window is replaced with the window ending at the last frame
+        (evaluation_development.__cut_video_on_windows). Otherwise, this window is appended
+        (embeddings_extraction_dynamic.__cut_video_on_windows).
+    :return: Tuple[np.ndarray, int]
+        start positions of the windows (in the padded video) and the number of zero rows to pad the video with
+    """
+    length = len(frame_nums)
+    if length <= window_size:
+        return np.zeros(1, dtype=np.int64), window_size - length
+    frame_nums = np.asarray(frame_nums, dtype=np.float64)
+    reference_range = np.round(get_mode_of_differences(frame_nums) * (window_size - 1), 2)
+    # only full windows are considered
+    starts = np.arange(0, length - window_size if replace_last else length - window_size + 1, stride)
+    actual_ranges = np.round(frame_nums[starts + window_size - 1] - frame_nums[starts], 2)
+    starts = starts[actual_ranges == reference_range]
+    last_start = length - window_size
+    # sometimes, there are no windows at all (because the video is ultra short and most of the labels are missing)
+    if len(starts) == 0:
+        starts = np.array([last_start])
+    if replace_last:
+        starts[-1] = last_start
+    else:
+        starts = np.append(starts, last_start)
+    return starts, 0
+
+
+class TemporalWindowIndex:
+    """ Index of the windows of several videos. Every video is stored as a dict of contiguous arrays
+    (group name -> num_frames x num_columns array), the windows are stored as (video_id, start, step) triples.
+
+    :param window_size: int
+        size of the window in number of frames of the stored videos (the window contains window_size/step rows)
+    :param step: int
+        step between the rows of the window (f.e. to take every n-th frame of the window)
+    """
+    def __init__(self, window_size:int, step:Optional[int]=1):
+        self.window_size = window_size
+        self.step = step
+        self.video_keys = []
+        self.videos = []
+        self.windows = np.zeros((0, 3), dtype=np.int64)
+
+    @classmethod
+    def from_dataframes(cls, data:Dict[str, pd.DataFrame], column_groups:Dict[str, Tuple[List[str], type]],
+                        window_size:int, starts_fn, step:Optional[int]=1)->'TemporalWindowIndex':
+        """ Creates the index from the dataframes of videos.
+
+        :param data: Dict[str, pd.DataFrame]
+            video name -> dataframe with frames of the video
+        :param column_groups: Dict[str, Tuple[List[str], type]]
+            group name -> (columns, dtype). Every group is stored as a separate contiguous array
+        :param window_size: int
+            size of the window in number of frames
+        :param starts_fn: Callable[[pd.DataFrame], Union[np.ndarray, Tuple[np.ndarray, int], None]]
+            function that returns the start positions of windows for the video (and optionally the number of zero
+            rows to pad the video with at the start). Videos with None are skipped.
+        :param step: int
+            step between the rows of the window
+        :return: TemporalWindowIndex
+        """
+        index = cls(window_size, step)
+        for key, frames in data.items():
+            starts = starts_fn(frames)
+            if starts is None:
+                continue
+            starts, padding = starts if isinstance(starts, tuple) else (starts, 0)
+            arrays = {name: frames[columns].to_numpy(dtype=dtype) for name, (columns, dtype) in column_groups.items()}
+            index.add_video(key, arrays, starts, padding)
+        return index
+
+    def add_video(self, key:str, arrays:Dict[str, np.ndarray], starts:np.ndarray, padding:Optional[int]=0)->int:
+        """ Adds the video and its windows to the index.
+
+        :param key: str
+            name of the video
+        :param arrays: Dict[str, np.ndarray]
+            group name -> num_frames x num_columns array
+        :param starts: np.ndarray
+            start positions of the windows
+        :param padding: int
+            number of zero rows added at the start of every array
+        :return: int
+            id of the video in the index
+        """
+        if padding > 0:
+            arrays = {name: np.concatenate([np.zeros((padding,) + array.shape[1:], dtype=array.dtype), array])
+                      for name, array in arrays.items()}
+        video_id = len(self.videos)
+        self.video_keys.append(key)
+        self.videos.append({name: np.ascontiguousarray(array) for name, array in arrays.items()})
+        starts = np.asarray(starts, dtype=np.int64)
+        self.windows = np.concatenate([self.windows, np.stack([np.full_like(starts, video_id), starts,
+                                                               np.full_like(starts, self.step)], axis=1)])
+        return video_id
+
+    def __len__(self)->int:
+        return len(self.windows)
+
+    def get_window(self, idx:int, group:str)->np.ndarray:
+        """ Returns the window as the strided view of the video array (without copying). """
+        video_id, start, step = self.windows[idx]
+        return self.videos[video_id][group][start:start + self.window_size:step]
+
+    def get_windows(self, indices:Union[List[int], np.ndarray, slice], group:str)->np.ndarray:
+        """ Returns several windows stacked into one array (num_windows x rows x num_columns). """
+        windows = self.windows[indices]
+        return np.stack([self.videos[video_id][group][start:start + self.window_size:step]
+                         for video_id, start, step in windows])
+
+    def get_video_windows(self, key:str)->np.ndarray:
+        """ Returns indices of the windows of the video. """
+        video_id = self.video_keys.index(key)
+        return np.flatnonzero(self.windows[:, 0] == video_id)
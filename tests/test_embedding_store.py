@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from src.video.post_processing.embedding_store import EmbeddingStore, read_embeddings_table
+
+
+STATIC_COLUMNS = (['video_name', 'frame_num', 'timestep'] + [f"facial_embedding_{i}" for i in range(256)] +
+                  [f"pose_embedding_{i}" for i in range(256)] + ["category"])
+
+
+def generate_static_features(video:str, num_frames:int)->pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'video_name': [video] * num_frames,
+                         'frame_num': np.arange(num_frames),
+                         'timestep': np.round(np.arange(num_frames) * 0.04, 2),
+                         **{i: rng.random(num_frames) for i in range(512)},
+                         'category': np.arange(num_frames) % 9 - 1})
+
+
+def write_store(path:str, videos:dict)->None:
+    for video, num_frames in videos.items():
+        EmbeddingStore(path).save(video, generate_static_features(video, num_frames), columns=STATIC_COLUMNS,
+                                  feature_columns=STATIC_COLUMNS[3:3 + 512])
+
+
+def test_read_embeddings_table_has_training_schema(tmp_path):
+    path = str(tmp_path / 'train')
+    write_store(path, {'video_1': 12, 'video_2': 7})
+    table = read_embeddings_table(path, 'pose')
+    assert len(table) == 19
+    assert {'path', 'frame_num', 'timestamp'} <= set(table.columns)
+    assert [f'embedding_{i}' for i in range(256)] == [column for column in table.columns if 'embedding' in column]
+    assert [f'category_{i}' for i in range(8)] == [column for column in table.columns if 'category' in column]
+    video_1 = table[table['path'].str.split('/').str[-2] == 'video_1']
+    expected = generate_static_features('video_1', 12)
+    np.testing.assert_allclose(video_1['embedding_3'], expected[256 + 3].astype(np.float32))
+    np.testing.assert_array_equal(video_1[[f'category_{i}' for i in range(8)]].to_numpy().argmax(axis=1)[1:9],
+                                  np.arange(8))
+    # frames without label get no category
+    assert video_1[[f'category_{i}' for i in range(8)]].iloc[0].sum() == 0
+
+
+def test_store_round_trip_to_load_train_dev(tmp_path):
+    pytest.importorskip('cv2')
+    pytest.importorskip('pytorch_utils')
+    from src.video.training.dynamic_models.data_preparation import load_train_dev
+    write_store(str(tmp_path / 'train'), {'video_1': 12, 'video_2': 7})
+    write_store(str(tmp_path / 'dev'), {'video_3': 5})
+    config = {'train_embeddings': str(tmp_path / 'train'), 'dev_embeddings': str(tmp_path / 'dev'),
+              'embeddings_type': 'facial', 'num_classes': 8, 'normalization': 'standard'}
+    train, dev = load_train_dev(config)
+    assert len(train) == 19 and len(dev) == 5
+    assert 'timestep' in train.columns and 'timestamp' not in train.columns
+    assert np.isfinite(train[[f'embedding_{i}' for i in range(256)]].to_numpy()).all()